@@ -3,20 +3,35 @@
 Import only standard modules to run install.py directly.
 """
 import contextlib
+import copy
+import errno
+import fcntl
 import fnmatch
 import glob
-import io
+import hashlib
 import json
 import os
 import re
 import shutil
+import socket
+import struct
 import subprocess
 import sys
+import sysconfig
 import tarfile
 import tempfile
+import threading
+import time
+import zipfile
 from distutils.spawn import find_executable
 from distutils.sysconfig import get_python_lib
 
+try:
+    import sqlite3
+except ImportError:
+    # Python built without the sqlite3 module.
+    sqlite3 = None
+
 
 class Application(object):
     """A class for main applicaton logic."""
@@ -28,25 +43,34 @@ class Application(object):
     def run(self):
         """Run install process."""
         try:
-            self.linux.verify_system_status()
+            pythons = self.linux.verify_system_status(pythons=self.pythons)
         except InstallSkipError:
             Log.info('Install skipped.')
             return
+        if len(pythons) < len(self.pythons):
+            self.rpm_py.select_pythons(pythons)
 
         work_dir = tempfile.mkdtemp(suffix='-rpm-py-installer')
         Log.info("Created working directory '{0}'".format(work_dir))
 
         with Cmd.pushd(work_dir):
             self.rpm_py.download_and_install()
-            if not self.python.is_python_binding_installed():
-                message = (
-                    'RPM Python binding failed to install '
-                    'with unknown reason.'
-                )
-                raise InstallError(message)
+            for python in pythons:
+                if not python.is_python_binding_installed():
+                    message = (
+                        'RPM Python binding failed to install '
+                        'with unknown reason.'
+                    )
+                    if len(pythons) > 1:
+                        message += " Python: '{0}'".format(
+                            python.python_path)
+                    raise InstallError(message)
 
             # TODO: Print installed module name and version as INFO.
 
+        Log.debug('System facts saved {0} subprocesses.'.format(
+                  self.linux.facts.saved_subprocesses))
+
         if self.is_work_dir_removed:
             shutil.rmtree(work_dir)
             Log.info("Removed working directory '{0}'".format(work_dir))
@@ -72,6 +96,24 @@ class Application(object):
 
         # Python's path that the module is installed on.
         python = Python()
+        # Pythons that the module is installed on, building the module
+        # concurrently. Default: None (the Python running this script)
+        pythons = [python]
+        if os.environ.get('RPM_PY_PYTHONS'):
+            pythons = []
+            for python_path in re.split(
+                    r'[\s,]+', os.environ.get('RPM_PY_PYTHONS').strip()):
+                abs_python_path = Cmd.which(python_path)
+                if not abs_python_path:
+                    raise InstallError('Python not found: {0}'.format(
+                                       python_path))
+                pythons.append(Python(abs_python_path))
+            python = pythons[0]
+        # The binary package is only for the Python running this script.
+        if is_installed_from_bin and len(pythons) > 1:
+            raise InstallError(
+                'RPM_PY_INSTALL_BIN=true does not support '
+                'several Pythons in RPM_PY_PYTHONS.')
 
         # Linked rpm's path. Default: rpm.
         rpm_path = os.environ.get('RPM_PY_RPM_BIN', 'rpm')
@@ -97,6 +139,17 @@ class Application(object):
         if 'RPM_PY_GIT_BRANCH' in os.environ:
             git_branch = os.environ.get('RPM_PY_GIT_BRANCH')
 
+        # Git tag name or commit hash. Default: None
+        git_ref = None
+        if 'RPM_PY_GIT_REF' in os.environ:
+            git_ref = os.environ.get('RPM_PY_GIT_REF')
+
+        # Download only the needed files by git partial clone and
+        # sparse checkout? Default: false
+        git_sparse = False
+        if 'RPM_PY_GIT_SPARSE' in os.environ:
+            git_sparse = os.environ.get('RPM_PY_GIT_SPARSE') == 'true'
+
         # Use optimized setup.py?
         # Default: true
         optimized = True
@@ -108,13 +161,121 @@ class Application(object):
             is_work_dir_removed = \
                 os.environ.get('RPM_PY_WORK_DIR_REMOVED') == 'true'
 
+        # Extract the archive while downloading it?
+        # Default: false
+        stream_extracted = False
+        if 'RPM_PY_STREAM_EXTRACT' in os.environ:
+            stream_extracted = \
+                os.environ.get('RPM_PY_STREAM_EXTRACT') == 'true'
+
+        # Extract all the files in the archive?
+        # Default: false, extracting only the files to build the binding.
+        extracted_all = False
+        if 'RPM_PY_EXTRACT_ALL' in os.environ:
+            extracted_all = os.environ.get('RPM_PY_EXTRACT_ALL') == 'true'
+
+        # Number of the retries when a download is interrupted. Default: 3
+        if 'RPM_PY_DOWNLOAD_RETRIES' in os.environ:
+            try:
+                Cmd.download_retries = int(
+                    os.environ.get('RPM_PY_DOWNLOAD_RETRIES'))
+            except ValueError:
+                raise InstallError(
+                    'Invalid RPM_PY_DOWNLOAD_RETRIES: {0}'.format(
+                        os.environ.get('RPM_PY_DOWNLOAD_RETRIES')))
+
+        # Mirrors of the archives, URLs or local directories with
+        # an index file. Default: None
+        mirrors = []
+        if os.environ.get('RPM_PY_MIRRORS'):
+            mirrors = re.split(r'[\s,]+',
+                               os.environ.get('RPM_PY_MIRRORS').strip())
+
+        # Persistent cache directory. Default: None (no cache)
+        cache = None
+        if os.environ.get('RPM_PY_CACHE_DIR'):
+            cache_size_limit = Cache.DEFAULT_SIZE_LIMIT_MB
+            if 'RPM_PY_CACHE_SIZE_LIMIT' in os.environ:
+                try:
+                    cache_size_limit = int(
+                        os.environ.get('RPM_PY_CACHE_SIZE_LIMIT'))
+                except ValueError:
+                    raise InstallError(
+                        'Invalid RPM_PY_CACHE_SIZE_LIMIT: {0}'.format(
+                            os.environ.get('RPM_PY_CACHE_SIZE_LIMIT')))
+            cache = Cache(os.environ.get('RPM_PY_CACHE_DIR'),
+                          size_limit_mb=cache_size_limit)
+
+        # Keep a local mirror of the RPM git repository in the cache
+        # directory? Default: false
+        git_cached = False
+        if 'RPM_PY_GIT_CACHE' in os.environ:
+            git_cached = os.environ.get('RPM_PY_GIT_CACHE') == 'true'
+        if git_cached and not cache:
+            raise InstallError('RPM_PY_GIT_CACHE requires RPM_PY_CACHE_DIR.')
+
+        # Cache the built binding in the cache directory? Default: true
+        build_cached = True
+        if 'RPM_PY_BUILD_CACHE' in os.environ:
+            build_cached = os.environ.get('RPM_PY_BUILD_CACHE') == 'true'
+        # Number of the parallel jobs to build the binding. Default: 1
+        # "auto" is the number of the CPUs available for the process.
+        jobs = 1
+        if 'RPM_PY_JOBS' in os.environ:
+            jobs_str = os.environ.get('RPM_PY_JOBS')
+            if jobs_str == 'auto':
+                jobs = Utils.cpu_count()
+            else:
+                try:
+                    jobs = int(jobs_str)
+                except ValueError:
+                    raise InstallError(
+                        'Invalid RPM_PY_JOBS: {0}'.format(jobs_str))
+        # Compile with ccache? Default: false
+        ccache = False
+        if 'RPM_PY_CCACHE' in os.environ:
+            ccache = os.environ.get('RPM_PY_CCACHE') == 'true'
+        # Link the binding of the system package such as python3-rpm
+        # if it is built for the same Python ABI? Default: false
+        linked = False
+        if 'RPM_PY_LINK' in os.environ:
+            linked = os.environ.get('RPM_PY_LINK') == 'true'
+        # Install the files by the hard links to the content-addressed store
+        # in the cache directory? Default: false
+        stored = False
+        if 'RPM_PY_STORE' in os.environ:
+            stored = os.environ.get('RPM_PY_STORE') == 'true'
+        if stored and not cache:
+            raise InstallError('RPM_PY_STORE requires RPM_PY_CACHE_DIR.')
+        # Resolve the tag name of the RPM source archive by git ls-remote
+        # before downloading it? Default: false
+        tag_resolved = False
+        if 'RPM_PY_TAG_RESOLVED' in os.environ:
+            tag_resolved = os.environ.get('RPM_PY_TAG_RESOLVED') == 'true'
+
         self.python = python
+        self.pythons = pythons
         self.linux = linux
+        self.cache = cache
         self.rpm_py = RpmPy(rpm_py_version_str, python, linux,
+                            pythons=pythons,
+                            linked=linked,
+                            stored=stored,
                             is_installed_from_bin=is_installed_from_bin,
                             git_branch=git_branch,
+                            git_ref=git_ref,
+                            git_sparse=git_sparse,
+                            git_cached=git_cached,
+                            tag_resolved=tag_resolved,
+                            build_cached=build_cached,
+                            jobs=jobs,
+                            ccache=ccache,
                             optimized=optimized,
-                            verbose=verbose)
+                            verbose=verbose,
+                            cache=cache,
+                            stream_extracted=stream_extracted,
+                            extracted_all=extracted_all,
+                            mirrors=mirrors)
         self.is_work_dir_removed = is_work_dir_removed
 
 
@@ -138,17 +299,72 @@ class RpmPy(object):
 
         is_installed_from_bin = kwargs.get('is_installed_from_bin', False)
         git_branch = kwargs.get('git_branch')
+        git_ref = kwargs.get('git_ref')
+        git_sparse = kwargs.get('git_sparse', False)
+        git_cached = kwargs.get('git_cached', False)
+        tag_resolved = kwargs.get('tag_resolved', False)
+        build_cached = kwargs.get('build_cached', True)
+        jobs = kwargs.get('jobs', 1)
+        ccache = kwargs.get('ccache', False)
         optimized = kwargs.get('optimized', True)
         verbose = kwargs.get('verbose', False)
+        cache = kwargs.get('cache')
+        stream_extracted = kwargs.get('stream_extracted', False)
+        extracted_all = kwargs.get('extracted_all', False)
+        mirrors = kwargs.get('mirrors', [])
+        pythons = kwargs.get('pythons', [python])
+        linked = kwargs.get('linked', False)
+        stored = kwargs.get('stored', False)
 
         rpm_py_version = RpmPyVersion(version)
 
         self.version = rpm_py_version
         self.is_installed_from_bin = is_installed_from_bin
-        self.downloader = Downloader(rpm_py_version, git_branch=git_branch)
+        self.linked = linked
+        self.downloader = Downloader(rpm_py_version, git_branch=git_branch,
+                                     git_ref=git_ref,
+                                     git_sparse=git_sparse,
+                                     git_cached=git_cached,
+                                     tag_resolved=tag_resolved,
+                                     cache=cache,
+                                     stream_extracted=stream_extracted,
+                                     extracted_all=extracted_all,
+                                     mirrors=mirrors)
+        build_cache = None
+        # The build cache key is by the RPM version. Do not use it for the
+        # source of the git branch or ref, that can be another source.
+        if build_cached and not (git_branch or git_ref):
+            build_cache = cache
+        ccache_dir = None
+        if ccache and cache:
+            ccache_dir = cache.get_ccache_dir()
+        store = None
+        if stored:
+            store = cache
         self.installer = linux.create_installer(rpm_py_version,
                                                 optimized=optimized,
-                                                verbose=verbose)
+                                                verbose=verbose,
+                                                cache=build_cache,
+                                                jobs=jobs,
+                                                ccache=ccache,
+                                                ccache_dir=ccache_dir,
+                                                store=store)
+        # The installers for each Python sharing the staged files.
+        self.installers = [self.installer]
+        for other_python in pythons[1:]:
+            self.installers.append(
+                self.installer.copy_for_python(other_python))
+
+    def select_pythons(self, pythons):
+        """Install the binding only for the Pythons in pythons.
+
+        It is used to skip the Pythons with the binding already installed.
+        """
+        self.installers = [
+            installer for installer in self.installers
+            if installer.python in pythons
+        ]
+        self.installer = self.installers[0]
 
     def download_and_install(self):
         """Download and install RPM Python binding."""
@@ -159,6 +375,21 @@ class RpmPy(object):
             except RpmPyPackageNotFoundError as exc:
                 Log.warn('RPM Py Package not found. reason: {0}'.format(exc))
 
+        installers = self.installers
+        # Link the binding of the system package without building it.
+        if self.linked:
+            installers = [
+                installer for installer in installers
+                if not installer.install_by_link()
+            ]
+        # Install the binding built before without downloading the source.
+        installers = [
+            installer for installer in installers
+            if not installer.install_from_build_cache()
+        ]
+        if not installers:
+            return
+
         # Download and install from the source.
         top_dir_name = self.downloader.download_and_expand()
         rpm_py_dir = os.path.join(top_dir_name, 'python')
@@ -167,11 +398,66 @@ class RpmPy(object):
         with Cmd.pushd(rpm_py_dir):
             if self.installer.setup_py.exists_in_path():
                 setup_py_in_found = True
-                self.installer.run()
+                if len(self.installers) == 1:
+                    self.installer.run()
+                else:
+                    self.installer.prepare()
+                    self._build_and_install_for_pythons(installers)
 
         if not setup_py_in_found:
+            # The binary package is only for the Python running this script.
+            if len(self.installers) > 1:
+                raise InstallError(
+                    'setup.py.in not found in the RPM source. Installing '
+                    'from the binary package does not support several '
+                    'Pythons in RPM_PY_PYTHONS.')
             self.installer.install_from_rpm_py_package()
 
+    def _build_and_install_for_pythons(self, installers):
+        """Build and install the binding for each Python concurrently.
+
+        Each build runs in a copy of the prepared python directory.
+        """
+        results = {}
+
+        def build_and_install(index, installer, build_dir):
+            start_time = time.time()
+            error = None
+            try:
+                installer.build_and_install(build_dir=build_dir)
+            except Exception as exc:
+                error = exc
+            results[index] = (error, time.time() - start_time)
+
+        threads = []
+        for index, installer in enumerate(installers):
+            build_dir = os.path.abspath(os.path.join(
+                '..', 'python-{0}'.format(index)))
+            shutil.copytree('.', build_dir, symlinks=True)
+            Log.info("Building for Python '{0}' in '{1}'".format(
+                     installer.python.python_path, build_dir))
+            thread = threading.Thread(target=build_and_install,
+                                      args=(index, installer, build_dir))
+            thread.start()
+            threads.append(thread)
+        for thread in threads:
+            thread.join()
+
+        failed_python_paths = []
+        for index, installer in enumerate(installers):
+            python_path = installer.python.python_path
+            error, seconds = results[index]
+            if error:
+                Log.error("Python '{0}': failed in {1:.1f} seconds. "
+                          "reason: {2}".format(python_path, seconds, error))
+                failed_python_paths.append(python_path)
+            else:
+                Log.info("Python '{0}': installed in {1:.1f} seconds.".format(
+                         python_path, seconds))
+        if failed_python_paths:
+            raise InstallError('Install failed for Pythons: {0}'.format(
+                               ', '.join(failed_python_paths)))
+
 
 class RpmPyVersion(object):
     """A class to manage RPM Python binding version."""
@@ -208,18 +494,85 @@ class RpmPyVersion(object):
             major=info[0], minor=info[1])
 
 
+class SetupPyPatch(object):
+    """An immutable patch for setup.py file.
+
+    The pattern is compiled once when the patch is defined.
+    The patch is for the RPM versions: min_version <= version < max_version.
+    """
+
+    __slots__ = ('src', 'dest', 'required', 'min_version', 'max_version',
+                 'pattern')
+
+    def __init__(self, src, dest, **kwargs):
+        """Initialize this class."""
+        pattern = kwargs.get('pattern') or re.compile(src, re.MULTILINE)
+        values = {
+            'src': src,
+            'dest': dest,
+            'required': kwargs.get('required', False),
+            'min_version': kwargs.get('min_version'),
+            'max_version': kwargs.get('max_version'),
+            'pattern': pattern,
+        }
+        for name in self.__slots__:
+            object.__setattr__(self, name, values[name])
+
+    def __setattr__(self, name, value):
+        """Prevent the patch from being changed."""
+        raise AttributeError('SetupPyPatch is immutable.')
+
+    def __copy__(self):
+        """Return itself as the patch is immutable."""
+        return self
+
+    def __deepcopy__(self, memo):
+        """Return itself as the patch is immutable."""
+        return self
+
+    def __repr__(self):
+        """Return the string representation."""
+        return 'SetupPyPatch({0!r}, required={1})'.format(
+            self.src, self.required)
+
+    def is_for_version(self, version_info):
+        """Return if the patch is for the RPM version info."""
+        if self.min_version and version_info < self.min_version:
+            return False
+        if self.max_version and version_info >= self.max_version:
+            return False
+        return True
+
+    def format(self, **kwargs):
+        """Return a patch with the formatted dest sharing the pattern."""
+        return SetupPyPatch(self.src, self.dest.format(**kwargs),
+                            required=self.required,
+                            min_version=self.min_version,
+                            max_version=self.max_version,
+                            pattern=self.pattern)
+
+    def apply(self, content):
+        """Apply the patch to the content.
+
+        Return a tuple of the patched content and applied or not.
+        """
+        (content, subs_num) = self.pattern.subn(self.dest, content)
+        return (content, subs_num > 0)
+
+
 class SetupPy(object):
     """A class for the RPM Python binding's setup.py file.
 
     It does parsing and patching for setup.py file.
     """
 
-    PATCHES_DEFAULT = [
+    # The registry of the patches selected by the RPM version.
+    PATCHES = (
         # Use setuptools to prevent deprecation message when uninstalling.
         # https://github.com/rpm-software-management/rpm/pull/323
-        {
-            'src': r'\nfrom distutils.core import setup, Extension *?\n',
-            'dest': '''
+        SetupPyPatch(
+            r'\nfrom distutils.core import setup, Extension *?\n',
+            '''
 import sys
 if sys.version_info >= (3, 0):
     try:
@@ -229,32 +582,31 @@ if sys.version_info >= (3, 0):
 else:
     from distutils.core import setup, Extension
 ''',
-            'required': True,
-        },
+            required=True,
+        ),
         # Support Python 2.6. subprocess.check_output is new in Python 2.7.
-        {
-            'src': r'\n    pcout = subprocess\.check_output\(cmd.split\(\)\)\.decode\(\) *?\n', # NOQA
-            'dest': '''
+        SetupPyPatch(
+            r'\n    pcout = subprocess\.check_output\(cmd.split\(\)\)\.decode\(\) *?\n', # NOQA
+            '''
     p = subprocess.Popen(cmd.split(), stdout=subprocess.PIPE)
     pcout, _ = p.communicate()
     pcout = pcout.decode()
 ''',
-            'required': True,
-        },
-    ]
-    # RPM version < 4.12
-    # https://github.com/rpm-software-management/rpm/commit/f996665
-    PATCHS_ADD_EXTRA_LINK_ARGS = [
-        {
-            'src': r'\nimport subprocess\n',
-            'dest': '''
+            required=True,
+        ),
+        # RPM version < 4.12
+        # https://github.com/rpm-software-management/rpm/commit/f996665
+        SetupPyPatch(
+            r'\nimport subprocess\n',
+            '''
 import subprocess
 import os
-'''
-        },
-        {
-            'src': r'\ncflags = \[.*\]\n',
-            'dest': '''
+''',
+            max_version=(4, 12),
+        ),
+        SetupPyPatch(
+            r'\ncflags = \[.*\]\n',
+            '''
 cflags = ['-std=c99']
 additional_link_args = []
 
@@ -266,20 +618,88 @@ if os.access('Makefile.am', os.F_OK):
                                  '-Wl,-L../build/.libs',
                                  '-Wl,-L../sign/.libs'])
     os.environ['PKG_CONFIG_PATH'] = '..'
-'''
-        },
-        {
-            'src': r'''
+''',
+            max_version=(4, 12),
+        ),
+        SetupPyPatch(
+            r'''
                    extra_compile_args = cflags
 ''',
-            'dest': '''
+            '''
                    extra_compile_args = cflags,
                    extra_link_args = additional_link_args
-'''
-        },
-    ]
+''',
+            max_version=(4, 12),
+        ),
+    )
+    # The patches to build without pkg-config, formatted with
+    # lib_dir and include_dir.
+    PATCHES_BUILD_WITHOUT_PKG_CONFIG = (
+        SetupPyPatch(
+            r"pkgconfig\('--libs-only-L'\)",
+            "['{lib_dir}']",
+        ),
+        # Considering -libs-only-l and -libs-only-L
+        # https://github.com/rpm-software-management/rpm/pull/327
+        SetupPyPatch(
+            r"pkgconfig\('--libs(-only-l)?'\)",
+            "['rpm', 'rpmio']",
+            required=True,
+        ),
+        SetupPyPatch(
+            r"pkgconfig\('--cflags'\)",
+            "['{include_dir}']",
+            required=True,
+        ),
+    )
+    # Compile the source files of each extension in parallel.
+    # The number of the running compilers in all the extensions is
+    # limited by the jobs, as "build -j" builds the extensions in parallel.
+    PATCH_COMPILE_IN_PARALLEL_FORMAT = SetupPyPatch(
+        r'\ndef pkgconfig\(',
+        '''
+
+def _compile_in_parallel(jobs):
+    try:
+        from concurrent.futures import ThreadPoolExecutor
+        import distutils.ccompiler
+        import threading
+    except ImportError:
+        return
+    semaphore = threading.BoundedSemaphore(jobs)
+
+    def compile(self, sources, output_dir=None, macros=None,
+                include_dirs=None, debug=0, extra_preargs=None,
+                extra_postargs=None, depends=None):
+        (macros, objects, extra_postargs, pp_opts,
+         build) = self._setup_compile(output_dir, macros, include_dirs,
+                                      sources, depends, extra_postargs)
+        cc_args = self._get_cc_args(pp_opts, debug, extra_preargs)
+
+        def compile_one(obj):
+            if obj not in build:
+                return
+            src, ext = build[obj]
+            with semaphore:
+                self._compile(obj, src, ext, cc_args, extra_postargs,
+                              pp_opts)
+
+        with ThreadPoolExecutor(jobs) as executor:
+            list(executor.map(compile_one, objects))
+        return objects
+
+    distutils.ccompiler.CCompiler.compile = compile
+
+
+_compile_in_parallel({jobs})
+
+
+def pkgconfig(''',
+    )
     IN_PATH = 'setup.py.in'
     OUT_PATH = 'setup.py'
+    # The patched setup.py contents in this process by the key.
+    _outputs = {}
 
     def __init__(self, version, **kwargs):
         """Initialize this class."""
@@ -294,12 +714,17 @@ if os.access('Makefile.am', os.F_OK):
             '@PACKAGE_BUGREPORT@': 'rpm-maint@lists.rpm.org',
         }
         optimized = kwargs.get('optimized', True)
+        self.jobs = kwargs.get('jobs', 1)
+        # The cache to store the patched setup.py content.
+        self.cache = kwargs.get('cache')
         patches = []
         if optimized:
-            patches = self.PATCHES_DEFAULT
-            if version.info < (4, 12):
-                patches.extend(self.PATCHS_ADD_EXTRA_LINK_ARGS)
+            version_info = version.info
+            patches = [patch for patch in self.PATCHES
+                       if patch.is_for_version(version_info)]
         self.patches = patches
+        # The results of the last apply_and_save: [(patch, applied), ...]
+        self.patch_results = []
 
     def exists_in_path(self):
         """Return if setup.py.in exists.
@@ -315,29 +740,39 @@ if os.access('Makefile.am', os.F_OK):
         Replace with given library_path: lib_dir and include_path: include_dir
         without rpm.pc file.
         """
-        additional_patches = [
-            {
-                'src': r"pkgconfig\('--libs-only-L'\)",
-                'dest': "['{0}']".format(lib_dir),
-            },
-            # Considering -libs-only-l and -libs-only-L
-            # https://github.com/rpm-software-management/rpm/pull/327
-            {
-                'src': r"pkgconfig\('--libs(-only-l)?'\)",
-                'dest': "['rpm', 'rpmio']",
-                'required': True,
-            },
-            {
-                'src': r"pkgconfig\('--cflags'\)",
-                'dest': "['{0}']".format(include_dir),
-                'required': True,
-            },
-        ]
+        additional_patches = self._get_patches_to_build_without_pkg_config(
+            lib_dir, include_dir)
         self.patches.extend(additional_patches)
 
+    def get_patches_digest(self, lib_dir, include_dir):
+        """Return the SHA-256 digest of the patches.
+
+        The patches to build without pkg-config are included.
+        """
+        patches = self.patches + self._get_patches_to_build_without_pkg_config(
+            lib_dir, include_dir)
+        patch_items = [
+            [patch.src, patch.dest, patch.required] for patch in patches
+        ]
+        patches_json = json.dumps(patch_items, sort_keys=True)
+        return hashlib.sha256(patches_json.encode('utf-8')).hexdigest()
+
+    def _get_patches_to_build_without_pkg_config(self, lib_dir, include_dir):
+        return [
+            patch.format(lib_dir=lib_dir, include_dir=include_dir)
+            for patch in self.PATCHES_BUILD_WITHOUT_PKG_CONFIG
+        ]
+
     def apply_and_save(self):
-        """Apply replaced words and patches, and save setup.py file."""
-        patches = self.patches
+        """Apply replaced words and patches, and save setup.py file.
+
+        The patched content is cached by the hash of setup.py.in content,
+        the replaced words and the patches.
+        """
+        patches = list(self.patches)
+        if self.jobs > 1:
+            patches.append(
+                self.PATCH_COMPILE_IN_PARALLEL_FORMAT.format(jobs=self.jobs))
 
         content = None
         with open(self.IN_PATH) as f_in:
@@ -345,31 +780,66 @@ if os.access('Makefile.am', os.F_OK):
             # it's fine to read entire content.
             content = f_in.read()
 
-        # Replace words.
-        for key in self.replaced_word_dict:
-            content = content.replace(key, self.replaced_word_dict[key])
-
-        # Apply patches.
-        out_patches = []
-        for patch in patches:
-            pattern = re.compile(patch['src'], re.MULTILINE)
-            (content, subs_num) = re.subn(pattern, patch['dest'],
-                                          content)
-            if subs_num > 0:
-                patch['applied'] = True
-            out_patches.append(patch)
+        key = self._get_output_key(content, patches)
+        output = self._get_cached_output(key)
+        if output:
+            Log.debug('Using cached setup.py: {0}'.format(key))
+            content = output['content']
+            applied_list = output['applied']
+        else:
+            # Replace words.
+            for key_word in self.replaced_word_dict:
+                content = content.replace(
+                    key_word, self.replaced_word_dict[key_word])
+
+            # Apply patches.
+            applied_list = []
+            for patch in patches:
+                (content, applied) = patch.apply(content)
+                applied_list.append(applied)
+            self._put_cached_output(key, {
+                'content': content,
+                'applied': applied_list,
+            })
 
-        for patch in out_patches:
-            if patch.get('required') and not patch.get('applied'):
-                Log.warn('Patch not applied {0}'.format(patch['src']))
+        # The results are kept in this instance, not in the shared patches.
+        patch_results = list(zip(patches, applied_list))
+        for (patch, applied) in patch_results:
+            Log.debug('Patch {0}: {1}'.format(
+                'applied' if applied else 'not applied', patch.src))
+            if patch.required and not applied:
+                Log.warn('Patch not applied {0}'.format(patch.src))
 
         with open(self.OUT_PATH, 'w') as f_out:
             f_out.write(content)
 
-        self.patches = out_patches
+        self.patch_results = patch_results
         # Release content data to make it released by GC quickly.
         content = None
 
+    def _get_output_key(self, content, patches):
+        items = [
+            content,
+            sorted(self.replaced_word_dict.items()),
+            [[patch.src, patch.dest] for patch in patches],
+        ]
+        items_json = json.dumps(items)
+        return hashlib.sha256(items_json.encode('utf-8')).hexdigest()
+
+    def _get_cached_output(self, key):
+        output = self._outputs.get(key)
+        if not output and self.cache:
+            output = self.cache.get_value(self.cache.SETUP_PY_NAMESPACE, key)
+            if output:
+                self._outputs[key] = output
+        return output
+
+    def _put_cached_output(self, key, output):
+        self._outputs[key] = output
+        if self.cache:
+            self.cache.put_value(self.cache.SETUP_PY_NAMESPACE, key, output,
+                                 self.cache.SETUP_PY_EXPIRED_SECONDS)
+
 
 class Downloader(object):
     """A class to download RPM Python binding."""
@@ -387,6 +857,24 @@ class Downloader(object):
         RPM_GIT_HUB_BASE_URL + '/archive/{tag_name}.tar.gz'
     )
     RPM_GIT_HUB_ARCHIVE_TOP_DIR_NAME_FORMAT = 'rpm-{tag_name}'
+    # mirror
+    MIRROR_INDEX_FILE_NAME = 'index.json'
+    # Seconds to keep the resolved tag names, and the not found result.
+    TAG_EXPIRED_SECONDS = 7 * 24 * 60 * 60
+    TAG_NOT_FOUND_EXPIRED_SECONDS = 60 * 60
+    # Sub directories in the archive used to build the Python binding.
+    # python: the Python binding, include: the header files,
+    # rpmio, lib, build, sign: the header files and the library files,
+    # misc: the header files included by system.h.
+    EXTRACTED_SUB_DIRS = [
+        'python',
+        'include',
+        'rpmio',
+        'lib',
+        'build',
+        'sign',
+        'misc',
+    ]
 
     def __init__(self, rpm_py_version, **kwargs):
         """Initialize this class."""
@@ -397,11 +885,20 @@ class Downloader(object):
 
         self.rpm_py_version = rpm_py_version
         self.git_branch = kwargs.get('git_branch')
+        self.git_ref = kwargs.get('git_ref')
+        self.git_sparse = kwargs.get('git_sparse', False)
+        self.cache = kwargs.get('cache')
+        self.git_cached = kwargs.get('git_cached', False)
+        self.tag_resolved = kwargs.get('tag_resolved', False)
+        self._tag_names_cache = {}
+        self.stream_extracted = kwargs.get('stream_extracted', False)
+        self.extracted_all = kwargs.get('extracted_all', False)
+        self.mirrors = kwargs.get('mirrors', [])
 
     def download_and_expand(self):
         """Download and expand RPM Python binding."""
         top_dir_name = None
-        if self.git_branch:
+        if self.git_branch or self.git_ref:
             # Download a source by git clone.
             top_dir_name = self._download_and_expand_by_git()
         else:
@@ -418,41 +915,136 @@ class Downloader(object):
 
     def _download_and_expand_from_archive_url(self):
         archive_dicts = self._get_candidate_archive_dicts()
+        found_archive_dict, archive_file_path = \
+            self._find_cached_archive(archive_dicts)
+        if found_archive_dict:
+            Cmd.tar_extract(archive_file_path,
+                            sub_dirs=self._get_extracted_sub_dirs())
+        else:
+            found_archive_dict = self._download_archive(archive_dicts)
+            archive_file_path = found_archive_dict['file_path']
+            if not self.stream_extracted:
+                Cmd.tar_extract(archive_file_path,
+                                sub_dirs=self._get_extracted_sub_dirs())
+            if self.cache and archive_file_path:
+                self.cache.put_archive(found_archive_dict['url'],
+                                       archive_file_path,
+                                       checksum=found_archive_dict['sha256'])
+
+        return found_archive_dict['top_dir_name']
+
+    def _find_cached_archive(self, archive_dicts):
+        if not self.cache:
+            return (None, None)
+        for archive_dict in archive_dicts:
+            cached_file_path = self.cache.get_archive(archive_dict['url'])
+            if cached_file_path:
+                Log.info("Using cached archive. '{0}'.".format(
+                         archive_dict['url']))
+                return (archive_dict, cached_file_path)
+        return (None, None)
+
+    def _download_archive(self, archive_dicts):
+        if not archive_dicts:
+            # Such as no tag of a non-release version is resolved.
+            raise RemoteFileNotFoundError('No candidate archive URL found.')
+        archive_dicts = self._sort_archive_dicts_by_probe(archive_dicts)
         max_num = len(archive_dicts)
-        found_index = None
+        found_archive_dict = None
         for index, archive_dict in enumerate(archive_dicts):
             url = archive_dict['url']
             Log.info("Downloading archive. '{0}'.".format(url))
+            sha256 = hashlib.sha256()
             try:
-                Cmd.curl_remote_name(url)
-            except RemoteFileNotFoundError as exc:
+                file_path = self._download_archive_file(url, sha256)
+            except InstallError as exc:
+                is_next_tried = (
+                    isinstance(exc, RemoteFileNotFoundError)
+                    or archive_dict['site'] == 'mirror'
+                )
+                if not is_next_tried:
+                    raise exc
                 Log.info('Archive not found. URL: {0}'.format(url))
                 if index + 1 < max_num:
                     Log.info('Try to download next candidate URL.')
                 else:
-                    raise exc
+                    raise RemoteFileNotFoundError(str(exc))
             else:
-                found_index = index
+                found_archive_dict = archive_dict.copy()
+                found_archive_dict['file_path'] = file_path
+                found_archive_dict['sha256'] = sha256.hexdigest()
                 break
 
-        found_archive_dict = archive_dicts[found_index]
-        archive_file_name = os.path.basename(found_archive_dict['url'])
-        Cmd.tar_extract(archive_file_name)
+        return found_archive_dict
 
-        return found_archive_dict['top_dir_name']
+    def _sort_archive_dicts_by_probe(self, archive_dicts):
+        """Move the candidate found by probing the URLs to the top.
+
+        Probe all the candidate URLs concurrently, not to wait for the
+        timeouts of the not found or slow URLs one by one.
+        Raise RemoteFileNotFoundError if all the URLs are not found surely.
+        """
+        if len(archive_dicts) <= 1:
+            return archive_dicts
+        if archive_dicts[0].get('resolved'):
+            # The first candidate is already known to exist.
+            return archive_dicts
+        urls = [archive_dict['url'] for archive_dict in archive_dicts]
+        found_index = Cmd.probe_urls(urls)
+        if found_index is None:
+            Log.debug('No candidate URL found by probing.')
+            return archive_dicts
+        Log.debug("Found candidate URL by probing. '{0}'".format(
+                  urls[found_index]))
+        sorted_archive_dicts = list(archive_dicts)
+        sorted_archive_dicts.insert(0, sorted_archive_dicts.pop(found_index))
+        return sorted_archive_dicts
+
+    def _download_archive_file(self, url, hash_obj):
+        if not self.stream_extracted:
+            kwargs = {}
+            if self.cache:
+                # Keep the partial file to resume it on the next install.
+                kwargs['part_file_path'] = self.cache.get_partial_file_path(
+                    url)
+            return Cmd.curl_remote_name(url, hash_obj=hash_obj, **kwargs)
+
+        # Extract the archive while downloading.
+        # Save the archive file only to store it in the cache.
+        file_path = None
+        if self.cache:
+            file_path = os.path.basename(url)
+        Cmd.curl_tar_extract(url, hash_obj=hash_obj, file_path=file_path,
+                             sub_dirs=self._get_extracted_sub_dirs())
+        return file_path
+
+    def _get_extracted_sub_dirs(self):
+        if self.extracted_all:
+            return None
+        return self.EXTRACTED_SUB_DIRS
 
     def _get_candidate_archive_dicts(self):
-        archive_dicts = []
+        # Set the mirrors as primary servers.
+        archive_dicts = self._get_mirror_archive_dicts()
 
         tag_names = self._predict_candidate_git_tag_names()
+        is_resolved = False
+        if self.tag_resolved:
+            resolved_tag_names = self._resolve_git_tag_names(tag_names)
+            if resolved_tag_names is not None:
+                tag_names = resolved_tag_names
+                is_resolved = True
         for tag_name in tag_names:
             url = self._get_git_hub_archive_url(tag_name)
             top_dir_name = self._get_git_hub_archive_top_dir_name(tag_name)
-            archive_dicts.append({
+            archive_dict = {
                 'site': 'github',
                 'url': url,
                 'top_dir_name': top_dir_name,
-            })
+            }
+            if is_resolved:
+                archive_dict['resolved'] = True
+            archive_dicts.append(archive_dict)
 
         # Set rpm.org server as a secondary server, because it takes long time
         # to download an archive. GitHub is better to download the archive.
@@ -467,6 +1059,99 @@ class Downloader(object):
 
         return archive_dicts
 
+    def _resolve_git_tag_names(self, tag_names):
+        """Return the existing tag names in the candidate tag names.
+
+        The tag names are resolved by one "git ls-remote --tags" instead of
+        trying to download the archive of each tag name. The result is
+        cached with the TTL including the empty result.
+        Return None if the tag names can not be resolved.
+        """
+        key = ' '.join(tag_names)
+        if key in self._tag_names_cache:
+            return self._tag_names_cache[key]
+        if self.cache:
+            resolved_tag_names = self.cache.get_value(
+                self.cache.TAG_NAMESPACE, key)
+            if resolved_tag_names is not None:
+                Log.debug('Using cached tag names: {0}'.format(
+                          resolved_tag_names))
+                self._tag_names_cache[key] = resolved_tag_names
+                return resolved_tag_names
+
+        if not Cmd.which('git'):
+            Log.debug('git command not found. Skip resolving tag names.')
+            return None
+
+        # The local mirror is used as the tag index if it exists.
+        repo_url = self.RPM_GIT_HUB_REPO_URL
+        if self.git_cached and os.path.isdir(
+                self.cache.get_git_mirror_dir()):
+            repo_url = self.cache.get_git_mirror_dir()
+        cmd = 'git ls-remote --tags {0} {1}'.format(repo_url, key)
+        try:
+            stdout = Cmd.sh_e_out(cmd)
+        except InstallError as exc:
+            Log.warn('Failed to resolve tag names. reason: {0}'.format(exc))
+            return None
+
+        existing_tag_names = set()
+        for line in stdout.splitlines():
+            # "<commit hash>\trefs/tags/<tag name>" or the peeled tag
+            # "<commit hash>\trefs/tags/<tag name>^{}".
+            match = re.match(r'^\w+\s+refs/tags/([^\^]+)', line)
+            if match:
+                existing_tag_names.add(match.group(1))
+        resolved_tag_names = [
+            tag_name for tag_name in tag_names
+            if tag_name in existing_tag_names
+        ]
+        Log.debug('Resolved tag names: {0}'.format(resolved_tag_names))
+
+        self._tag_names_cache[key] = resolved_tag_names
+        if self.cache:
+            if resolved_tag_names:
+                expired_seconds = self.TAG_EXPIRED_SECONDS
+            else:
+                # The tag might be pushed later.
+                expired_seconds = self.TAG_NOT_FOUND_EXPIRED_SECONDS
+            self.cache.put_value(self.cache.TAG_NAMESPACE, key,
+                                 resolved_tag_names, expired_seconds)
+        return resolved_tag_names
+
+    def _get_mirror_archive_dicts(self):
+        archive_dicts = []
+        version = self.rpm_py_version.version
+        for mirror in self.mirrors:
+            mirror_url = Utils.path_to_url(mirror)
+            index_url = '{0}/{1}'.format(mirror_url.rstrip('/'),
+                                         self.MIRROR_INDEX_FILE_NAME)
+            try:
+                response = Cmd.urlopen(index_url)
+                try:
+                    index = json.loads(response.read().decode('utf-8'))
+                finally:
+                    response.close()
+            except (InstallError, ValueError) as exc:
+                Log.warn("Skip mirror '{0}'. reason: {1}".format(mirror, exc))
+                continue
+
+            for archive in index.get('archives', []):
+                if archive.get('version') != version:
+                    continue
+                url = '{0}/{1}'.format(mirror_url.rstrip('/'),
+                                       archive['file'])
+                top_dir_name = archive.get('top_dir_name')
+                if not top_dir_name:
+                    top_dir_name = self._get_rpm_org_archive_top_dir_name()
+                archive_dicts.append({
+                    'site': 'mirror',
+                    'url': url,
+                    'top_dir_name': top_dir_name,
+                })
+                break
+        return archive_dicts
+
     def _get_rpm_org_archive_url(self):
         url = self.RPM_ORG_ARCHIVE_URL_FORMAT.format(
             branch_name=self.rpm_py_version.git_branch,
@@ -493,6 +1178,8 @@ class Downloader(object):
         return top_dir_name
 
     def _download_and_expand_by_git(self):
+        if self.git_cached:
+            self._update_git_mirror()
         self._do_git_clone()
         return 'rpm'
 
@@ -517,16 +1204,37 @@ class Downloader(object):
         if not Cmd.which('git'):
             raise InstallError('git command not found. Install git.')
 
+        is_sparse = self.git_sparse and self._is_git_sparse_checkout_ok()
+
+        if self.git_ref:
+            self._do_git_fetch_ref(self.git_ref, is_sparse)
+            return
+
         branch = None
         if self.git_branch:
             branch = self.git_branch
         else:
             branch = self._predict_git_branch()
 
-        git_clone_cmd = 'git clone -b {branch} --depth=1 {repo_url}'.format(
+        if self.git_cached:
+            # Share the objects with the local mirror without copying them.
+            git_clone_cmd = 'git clone -q --shared -b {branch} {repo_url}'
+            if is_sparse:
+                git_clone_cmd += ' --no-checkout'
+        elif is_sparse:
+            # Download the file contents only for the checked out files.
+            git_clone_cmd = (
+                'git clone -b {branch} --depth=1 --filter=blob:none '
+                '--no-checkout {repo_url}'
+            )
+        else:
+            git_clone_cmd = 'git clone -b {branch} --depth=1 {repo_url}'
+        git_clone_cmd = git_clone_cmd.format(
             branch=branch,
-            repo_url=self.RPM_GIT_HUB_REPO_URL,
+            repo_url=self._get_git_repo_url(),
         )
+        if self.git_cached:
+            git_clone_cmd += ' rpm'
         Log.info("Downloading source by git clone. 'branch: {0}'".format(
                  branch))
         _, stderr = Cmd.sh_e(git_clone_cmd)
@@ -542,6 +1250,88 @@ class Downloader(object):
             )
             raise InstallError(message_format.format(branch))
 
+        if is_sparse:
+            with Cmd.pushd('rpm'):
+                self._set_git_sparse_checkout()
+                Cmd.sh_e('git checkout -q {0}'.format(branch))
+
+    def _do_git_fetch_ref(self, git_ref, is_sparse):
+        """Download the source of the tag or the commit by git fetch."""
+        Log.info("Downloading source by git fetch. 'ref: {0}'".format(
+                 git_ref))
+        if self.git_cached:
+            # The local mirror already has the ref.
+            Cmd.sh_e('git clone -q --shared --no-checkout {0} rpm'.format(
+                     self._get_git_repo_url()))
+            with Cmd.pushd('rpm'):
+                if is_sparse:
+                    self._set_git_sparse_checkout()
+                Cmd.sh_e('git -c advice.detachedHead=false checkout -q '
+                         '{0}'.format(git_ref))
+            return
+
+        Cmd.sh_e('git init -q rpm')
+        with Cmd.pushd('rpm'):
+            Cmd.sh_e('git remote add origin {0}'.format(
+                     self.RPM_GIT_HUB_REPO_URL))
+            git_fetch_cmd = 'git fetch -q --depth=1 origin {0}'.format(
+                git_ref)
+            if is_sparse:
+                self._set_git_sparse_checkout()
+                git_fetch_cmd = (
+                    'git fetch -q --depth=1 --filter=blob:none origin {0}'
+                ).format(git_ref)
+            Cmd.sh_e(git_fetch_cmd)
+            Cmd.sh_e('git -c advice.detachedHead=false checkout -q '
+                     'FETCH_HEAD')
+
+    def _get_git_repo_url(self):
+        if self.git_cached:
+            return self.cache.get_git_mirror_dir()
+        return self.RPM_GIT_HUB_REPO_URL
+
+    def _update_git_mirror(self):
+        """Create or update the local mirror of the RPM git repository.
+
+        The first install clones the entire repository as a bare mirror.
+        The next installs fetch only the new commits.
+        """
+        if not Cmd.which('git'):
+            raise InstallError('git command not found. Install git.')
+
+        mirror_dir = self.cache.get_git_mirror_dir()
+        with Cmd.lock_file(mirror_dir + '.lock'):
+            if os.path.isdir(mirror_dir):
+                Log.info("Updating git mirror '{0}'".format(mirror_dir))
+                Cmd.sh_e('git --git-dir={0} fetch -q --prune origin'.format(
+                         mirror_dir))
+            else:
+                Log.info("Creating git mirror '{0}'".format(mirror_dir))
+                Cmd.sh_e('git clone -q --mirror {0} {1}'.format(
+                         self.RPM_GIT_HUB_REPO_URL, mirror_dir))
+
+    def _set_git_sparse_checkout(self):
+        """Set the sparse checkout to check out only the needed files.
+
+        The files in the top directory are also checked out in cone mode.
+        """
+        Cmd.sh_e('git sparse-checkout init --cone')
+        Cmd.sh_e('git sparse-checkout set {0}'.format(
+                 ' '.join(self.EXTRACTED_SUB_DIRS)))
+
+    def _is_git_sparse_checkout_ok(self):
+        """Check if git supports the sparse checkout command.
+
+        "git sparse-checkout" is new in git 2.25.0.
+        """
+        stdout = Cmd.sh_e_out('git --version')
+        match = re.search(r'(\d+\.\d+(\.\d+)?)', stdout)
+        if match and Utils.version_str2tuple(match.group(1)) >= (2, 25):
+            return True
+        Log.warn('git >= 2.25 is required for the sparse checkout. '
+                 'Download all the files.')
+        return False
+
     def _predict_git_branch(self):
         git_branch = None
 
@@ -550,8 +1340,9 @@ class Downloader(object):
             major=version_info[0],
             minor=version_info[1],
         )
+        # It is answered from the local refs with the local mirror.
         git_ls_remote_cmd = 'git ls-remote --heads {repo_url} {branch}'.format(
-            repo_url=self.RPM_GIT_HUB_REPO_URL,
+            repo_url=self._get_git_repo_url(),
             branch=stable_branch,
         )
         stdout = Cmd.sh_e_out(git_ls_remote_cmd)
@@ -563,9 +1354,465 @@ class Downloader(object):
         return git_branch
 
 
+class Cache(object):
+    """A class for the persistent cache directory.
+
+    The cache directory is shared by the installs on the same host.
+    Each entry is stored in a directory with a meta data file, and verified
+    by the SHA-256 checksum when it is used. The least recently used entries
+    are removed when the total size is over the size limit.
+
+    cache_dir/
+        archives/
+            <SHA-256 of the URL>/
+                meta.json
+                rpm-N.N.N.tar.gz
+        partial/
+            <SHA-256 of the URL>.part
+        git/
+            rpm.git/
+        tags/
+            <SHA-256 of the key>.json
+        setup_py/
+            <SHA-256 of the key>.json
+        builds/
+            <SHA-256 of the build key>/
+                meta.json
+                rpm-py-build.tar.gz
+        ccache/
+        store/
+            <first 2 characters of the file key>/
+                <SHA-256 of the file content>[-x]
+    """
+
+    DEFAULT_SIZE_LIMIT_MB = 512
+    ARCHIVE_NAMESPACE = 'archives'
+    PARTIAL_NAMESPACE = 'partial'
+    GIT_NAMESPACE = 'git'
+    TAG_NAMESPACE = 'tags'
+    BUILD_NAMESPACE = 'builds'
+    CCACHE_NAMESPACE = 'ccache'
+    STORE_NAMESPACE = 'store'
+    SETUP_PY_NAMESPACE = 'setup_py'
+    META_FILE_NAME = 'meta.json'
+    # Partial files not updated for the seconds are removed.
+    PARTIAL_EXPIRED_SECONDS = 24 * 60 * 60
+    SETUP_PY_EXPIRED_SECONDS = 30 * 24 * 60 * 60
+
+    def __init__(self, cache_dir, **kwargs):
+        """Initialize this class."""
+        if not cache_dir:
+            raise ValueError('cache_dir required.')
+        size_limit_mb = kwargs.get('size_limit_mb',
+                                   self.DEFAULT_SIZE_LIMIT_MB)
+        self.cache_dir = os.path.abspath(cache_dir)
+        self.size_limit = size_limit_mb * 1024 * 1024
+        self.namespaces = [self.ARCHIVE_NAMESPACE, self.BUILD_NAMESPACE]
+
+    def get_archive(self, url):
+        """Return the cached archive file path for the URL.
+
+        Return None if the archive is not cached.
+        """
+        return self._get_file(self.ARCHIVE_NAMESPACE, url)
+
+    def put_archive(self, url, file_path, **kwargs):
+        """Store the archive file downloaded from the URL.
+
+        Return the cached archive file path.
+        """
+        return self._put_file(self.ARCHIVE_NAMESPACE, url, file_path,
+                              **kwargs)
+
+    def get_build(self, key):
+        """Return the cached build artifact file path for the build key.
+
+        Return None if the build artifact is not cached.
+        """
+        return self._get_file(self.BUILD_NAMESPACE, key)
+
+    def put_build(self, key, file_path):
+        """Store the build artifact file for the build key.
+
+        Return the cached build artifact file path.
+        """
+        return self._put_file(self.BUILD_NAMESPACE, key, file_path)
+
+    def get_git_mirror_dir(self):
+        """Return the local mirror directory of the RPM git repository.
+
+        It is not removed by the eviction.
+        """
+        git_dir = os.path.join(self.cache_dir, self.GIT_NAMESPACE)
+        if not os.path.isdir(git_dir):
+            Cmd.mkdir_p(git_dir)
+        return os.path.join(git_dir, 'rpm.git')
+
+    def get_value(self, namespace, key):
+        """Return the JSON serializable value stored for the key.
+
+        Return None if the value is not stored or expired.
+        """
+        value_path = self._get_value_path(namespace, key)
+        if not os.path.isfile(value_path):
+            return None
+        try:
+            with open(value_path) as f_in:
+                data = json.load(f_in)
+        except ValueError:
+            return None
+        if data.get('key') != key or data['expired_time'] < time.time():
+            return None
+        return data['value']
+
+    def put_value(self, namespace, key, value, expired_seconds):
+        """Store the JSON serializable value for the key with the TTL."""
+        value_path = self._get_value_path(namespace, key)
+        namespace_dir = os.path.dirname(value_path)
+        if not os.path.isdir(namespace_dir):
+            Cmd.mkdir_p(namespace_dir)
+        data = {
+            'key': key,
+            'value': value,
+            'expired_time': time.time() + expired_seconds,
+        }
+        f_tmp = tempfile.NamedTemporaryFile(mode='w', dir=namespace_dir,
+                                            prefix='.tmp-', delete=False)
+        try:
+            with f_tmp:
+                json.dump(data, f_tmp)
+            os.rename(f_tmp.name, value_path)
+        except OSError as exc:
+            Log.warn("Failed to store cache value '{0}'. reason: {1}".format(
+                     value_path, exc))
+            if os.path.isfile(f_tmp.name):
+                os.remove(f_tmp.name)
+
+    def get_ccache_dir(self):
+        """Return the ccache directory.
+
+        It is managed by ccache with its own size limit, and not removed by
+        the eviction.
+        """
+        return os.path.join(self.cache_dir, self.CCACHE_NAMESPACE)
+
+    def link_tree(self, src_dir, dst_dir):
+        """Install the files in src_dir to dst_dir by the store.
+
+        Each file is stored once in the content-addressed store, and linked
+        to the destination. The same files installed to many directories
+        such as virtualenvs use the disk space once.
+        """
+        counts = {}
+        for root_dir, dir_names, file_names in os.walk(src_dir):
+            rel_dir = os.path.relpath(root_dir, src_dir)
+            dst_root_dir = os.path.normpath(os.path.join(dst_dir, rel_dir))
+            if not os.path.isdir(dst_root_dir):
+                Cmd.mkdir_p(dst_root_dir)
+            for name in dir_names + file_names:
+                src_path = os.path.join(root_dir, name)
+                dst_path = os.path.join(dst_root_dir, name)
+                if os.path.islink(src_path):
+                    os.symlink(os.readlink(src_path), dst_path)
+                elif os.path.isfile(src_path):
+                    method = self.link_file(src_path, dst_path)
+                    counts[method] = counts.get(method, 0) + 1
+        Log.debug("Installed '{0}' from the store: {1}".format(
+                  dst_dir, counts))
+
+    def link_file(self, src_file_path, dst_file_path):
+        """Install the file by the link to the file in the store.
+
+        Return the method to link: hardlink, reflink or copy.
+        """
+        if os.path.lexists(dst_file_path):
+            os.remove(dst_file_path)
+        store_file_path = self._put_store_file(src_file_path)
+        try:
+            return Cmd.link_file(store_file_path, dst_file_path)
+        except (IOError, OSError) as exc:
+            if exc.errno != errno.ENOENT:
+                raise
+            # The store file was evicted by another process. Store it again.
+            Log.debug('Store file not found: {0}'.format(exc))
+            store_file_path = self._put_store_file(src_file_path)
+            return Cmd.link_file(store_file_path, dst_file_path)
+
+    def _put_store_file(self, file_path):
+        key = Utils.sha256_file(file_path)
+        if os.stat(file_path).st_mode & 0o111:
+            # The files with the same content share the mode.
+            key += '-x'
+        store_dir = os.path.join(self.cache_dir, self.STORE_NAMESPACE,
+                                 key[:2])
+        store_file_path = os.path.join(store_dir, key)
+        # Update the time of the store file to put or reuse, not to evict
+        # it as an old file before it is linked.
+        try:
+            os.utime(store_file_path, None)
+            return store_file_path
+        except OSError as exc:
+            if exc.errno != errno.ENOENT:
+                raise
+
+        if not os.path.isdir(store_dir):
+            Cmd.mkdir_p(store_dir)
+        fd, tmp_file_path = tempfile.mkstemp(dir=store_dir, prefix='.tmp-')
+        os.close(fd)
+        shutil.copy2(file_path, tmp_file_path)
+        os.utime(tmp_file_path, None)
+        os.rename(tmp_file_path, store_file_path)
+        return store_file_path
+
+    def get_partial_file_path(self, url):
+        """Return the partial file path to download the URL."""
+        partial_dir = os.path.join(self.cache_dir, self.PARTIAL_NAMESPACE)
+        if not os.path.isdir(partial_dir):
+            Cmd.mkdir_p(partial_dir)
+        key_hash = hashlib.sha256(url.encode('utf-8')).hexdigest()
+        return os.path.join(partial_dir, '{0}.part'.format(key_hash))
+
+    def evict(self):
+        """Remove the least recently used entries over the size limit.
+
+        Remove the expired partial files, store files, values and the
+        staging entries left by the crashed installs too.
+        """
+        expired_time = time.time() - self.PARTIAL_EXPIRED_SECONDS
+        partial_dir = os.path.join(self.cache_dir, self.PARTIAL_NAMESPACE)
+        if os.path.isdir(partial_dir):
+            for name in os.listdir(partial_dir):
+                file_path = os.path.join(partial_dir, name)
+                if name.endswith('.lock'):
+                    self._remove_expired_partial_files(file_path,
+                                                       expired_time)
+                    continue
+                part_file_path = re.sub(r'\.validator$', '', file_path)
+                if os.path.exists(part_file_path + '.lock'):
+                    # It is removed with the lock file.
+                    continue
+                self._remove_expired_file(file_path, expired_time)
+
+        # Remove the old store files not hard linked from any install.
+        store_dir = os.path.join(self.cache_dir, self.STORE_NAMESPACE)
+        if os.path.isdir(store_dir):
+            for sub_dir_name in os.listdir(store_dir):
+                sub_dir = os.path.join(store_dir, sub_dir_name)
+                for name in os.listdir(sub_dir):
+                    store_file_path = os.path.join(sub_dir, name)
+                    # The file can be removed by another process.
+                    try:
+                        stat = os.stat(store_file_path)
+                        if (stat.st_nlink <= 1 and
+                                stat.st_mtime < expired_time):
+                            os.remove(store_file_path)
+                    except OSError as exc:
+                        if exc.errno != errno.ENOENT:
+                            raise
+
+        self._remove_stale_entries(expired_time)
+
+        entries = []
+        total_size = 0
+        for namespace in self.namespaces:
+            namespace_dir = os.path.join(self.cache_dir, namespace)
+            if not os.path.isdir(namespace_dir):
+                continue
+            for name in os.listdir(namespace_dir):
+                if name.startswith('.tmp-'):
+                    continue
+                entry_dir = os.path.join(namespace_dir, name)
+                meta = self._load_meta(entry_dir)
+                if not meta:
+                    continue
+                meta_path = os.path.join(entry_dir, self.META_FILE_NAME)
+                entries.append((os.path.getmtime(meta_path),
+                                meta['size'], entry_dir))
+                total_size += meta['size']
+
+        entries.sort()
+        for _, size, entry_dir in entries:
+            if total_size <= self.size_limit:
+                break
+            Log.debug("Evict cache entry '{0}'".format(entry_dir))
+            shutil.rmtree(entry_dir, ignore_errors=True)
+            total_size -= size
+
+    def _remove_stale_entries(self, expired_time):
+        """Remove the staging entries older than expired_time.
+
+        Remove the expired values too, that are only ignored by get_value.
+        """
+        namespaces = self.namespaces + [self.TAG_NAMESPACE,
+                                        self.SETUP_PY_NAMESPACE]
+        for namespace in namespaces:
+            namespace_dir = os.path.join(self.cache_dir, namespace)
+            if not os.path.isdir(namespace_dir):
+                continue
+            for name in os.listdir(namespace_dir):
+                path = os.path.join(namespace_dir, name)
+                if name.startswith('.tmp-') and os.path.isdir(path):
+                    try:
+                        if os.path.getmtime(path) < expired_time:
+                            Log.debug("Remove staging entry '{0}'".format(
+                                      path))
+                            shutil.rmtree(path, ignore_errors=True)
+                    except OSError as exc:
+                        if exc.errno != errno.ENOENT:
+                            raise
+                elif name.startswith('.tmp-'):
+                    self._remove_expired_file(path, expired_time)
+                elif name.endswith('.json') and self._is_value_expired(path):
+                    self._remove_expired_file(path, None)
+
+    def _is_value_expired(self, value_path):
+        try:
+            with open(value_path) as f_in:
+                data = json.load(f_in)
+        except IOError as exc:
+            if exc.errno == errno.ENOENT:
+                return False
+            raise
+        except ValueError:
+            # The broken value is never used.
+            return True
+        return data.get('expired_time', 0) < time.time()
+
+    def _remove_expired_partial_files(self, lock_file_path, expired_time):
+        """Remove the partial files and the lock file not in use.
+
+        They are removed while locking the lock file. A process waiting for
+        the removed lock file locks the new lock file by Cmd.lock_file.
+        """
+        try:
+            f_lock = open(lock_file_path, 'r')
+        except IOError as exc:
+            if exc.errno == errno.ENOENT:
+                return
+            raise
+        with f_lock:
+            try:
+                fcntl.flock(f_lock.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except IOError as exc:
+                if exc.errno in (errno.EAGAIN, errno.EACCES):
+                    Log.debug("Skip the lock file in use '{0}'".format(
+                              lock_file_path))
+                    return
+                raise
+            try:
+                if os.fstat(f_lock.fileno()).st_mtime >= expired_time:
+                    return
+                part_file_path = lock_file_path[:-len('.lock')]
+                for file_path in [part_file_path,
+                                  part_file_path + '.validator',
+                                  lock_file_path]:
+                    self._remove_expired_file(file_path, None)
+            finally:
+                fcntl.flock(f_lock.fileno(), fcntl.LOCK_UN)
+
+    def _remove_expired_file(self, file_path, expired_time):
+        """Remove the file older than expired_time, or any time if None.
+
+        The file can be removed by another process at the same time.
+        """
+        try:
+            if (expired_time is None or
+                    os.path.getmtime(file_path) < expired_time):
+                os.remove(file_path)
+        except OSError as exc:
+            if exc.errno != errno.ENOENT:
+                raise
+
+    def _get_entry_dir(self, namespace, key):
+        key_hash = hashlib.sha256(key.encode('utf-8')).hexdigest()
+        return os.path.join(self.cache_dir, namespace, key_hash)
+
+    def _get_value_path(self, namespace, key):
+        return '{0}.json'.format(self._get_entry_dir(namespace, key))
+
+    def _load_meta(self, entry_dir):
+        meta_path = os.path.join(entry_dir, self.META_FILE_NAME)
+        if not os.path.isfile(meta_path):
+            return None
+        try:
+            with open(meta_path) as f_in:
+                return json.load(f_in)
+        except ValueError:
+            return None
+
+    def _get_file(self, namespace, key):
+        entry_dir = self._get_entry_dir(namespace, key)
+        meta = self._load_meta(entry_dir)
+        if not meta or meta.get('key') != key:
+            return None
+
+        file_path = os.path.join(entry_dir, meta['file_name'])
+        if (not os.path.isfile(file_path)
+           or os.path.getsize(file_path) != meta['size']
+           or Utils.sha256_file(file_path) != meta['sha256']):
+            Log.warn("Remove broken cache entry '{0}'".format(entry_dir))
+            shutil.rmtree(entry_dir, ignore_errors=True)
+            return None
+
+        # Update the last used time for the LRU eviction.
+        os.utime(os.path.join(entry_dir, self.META_FILE_NAME), None)
+        return file_path
+
+    def _put_file(self, namespace, key, file_path, **kwargs):
+        checksum = kwargs.get('checksum')
+        if not checksum:
+            checksum = Utils.sha256_file(file_path)
+        file_name = os.path.basename(file_path)
+        meta = {
+            'key': key,
+            'file_name': file_name,
+            'sha256': checksum,
+            'size': os.path.getsize(file_path),
+        }
+
+        entry_dir = self._get_entry_dir(namespace, key)
+        namespace_dir = os.path.dirname(entry_dir)
+        if not os.path.isdir(namespace_dir):
+            Cmd.mkdir_p(namespace_dir)
+        # Create the entry in a temporary directory and rename it,
+        # considering other installs running at the same time.
+        tmp_dir = tempfile.mkdtemp(dir=namespace_dir, prefix='.tmp-')
+        try:
+            shutil.copyfile(file_path, os.path.join(tmp_dir, file_name))
+            with open(os.path.join(tmp_dir, self.META_FILE_NAME), 'w') as f:
+                json.dump(meta, f)
+            if os.path.isdir(entry_dir):
+                shutil.rmtree(entry_dir, ignore_errors=True)
+            os.rename(tmp_dir, entry_dir)
+        except OSError as exc:
+            Log.warn("Failed to store cache entry '{0}'. reason: {1}".format(
+                     entry_dir, exc))
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            return file_path
+        Log.debug("Stored cache entry '{0}'".format(entry_dir))
+
+        self.evict()
+        cached_file_path = os.path.join(entry_dir, file_name)
+        if not os.path.isfile(cached_file_path):
+            # Evicted as the file is bigger than the size limit.
+            return file_path
+        return cached_file_path
+
+
 class Installer(object):
     """A class to install RPM Python binding."""
 
+    BUILD_CACHE_FILE_NAME = 'rpm-py-build.tar.gz'
+    WHEEL_DIR = 'dist'
+    # site-packages directories of the system Python to find the binding
+    # installed by the system package such as python3-rpm.
+    SYS_PYTHON_LIB_DIR_FORMATS = [
+        '/usr/lib64/python{0}.{1}/site-packages',
+        '/usr/lib/python{0}.{1}/site-packages',
+        # Debian based OS
+        '/usr/lib/python{0}/dist-packages',
+    ]
+
     def __init__(self, rpm_py_version, python, rpm, **kwargs):
         """Initialize this class."""
         if not rpm_py_version:
@@ -583,13 +1830,28 @@ class Installer(object):
 
         optimized = kwargs.get('optimized', True)
         verbose = kwargs.get('verbose', False)
+        cache = kwargs.get('cache')
+        jobs = kwargs.get('jobs', 1)
+        ccache = kwargs.get('ccache', False)
+        ccache_dir = kwargs.get('ccache_dir')
+        store = kwargs.get('store')
 
         self.rpm_py_version = rpm_py_version
         self.python = python
         self.rpm = rpm
-        self.setup_py = SetupPy(rpm_py_version, optimized=optimized)
+        self.cache = cache
+        # The key is computed before the patches are added by the install.
+        self._build_cache_key = None
+        self.setup_py = SetupPy(rpm_py_version, optimized=optimized,
+                                jobs=jobs, cache=cache)
         self.setup_py_opts = '-v' if verbose else '-q'
         self.optimized = optimized
+        self.jobs = jobs
+        self.ccache = ccache
+        self.ccache_dir = ccache_dir
+        # The cache to install the files by the links to the store.
+        self.store = store
+        self.lib_resolver = LibResolver()
 
         # Implement these variables on sub class.
         self.package_sys_name = None
@@ -598,6 +1860,11 @@ class Installer(object):
 
     def run(self):
         """Run install main logic."""
+        self.prepare()
+        self._build_and_install()
+
+    def prepare(self):
+        """Prepare the files to build, and save setup.py."""
         self._make_lib_file_symbolic_links()
         self._copy_each_include_files_to_include_dir()
         self._make_dep_lib_file_sym_links_and_copy_include_files()
@@ -605,7 +1872,21 @@ class Installer(object):
             self.rpm.lib_dir, self.rpm.include_dir
         )
         self.setup_py.apply_and_save()
-        self._build_and_install()
+
+    def build_and_install(self, **kwargs):
+        """Build and install in the prepared build_dir.
+
+        It can run for each Python in other threads at the same time,
+        as it does not change the current directory.
+        """
+        self._build_and_install(**kwargs)
+
+    def copy_for_python(self, python):
+        """Return a copy of this installer for the Python."""
+        installer = copy.copy(self)
+        installer.python = python
+        installer._build_cache_key = None
+        return installer
 
     def install_from_rpm_py_package(self):
         """Run install from RPM Python binding system package.
@@ -615,6 +1896,90 @@ class Installer(object):
         """
         raise NotImplementedError('Implement this method.')
 
+    def install_by_link(self):
+        """Run install by linking the binding of the system package.
+
+        Make symbolic links to the binding installed by the system package
+        such as python3-rpm, if the binding is built for the same Python ABI
+        and the same RPM version. It does not download and build anything.
+        Return True if it is installed, False if the binding is not found.
+        """
+        sys_rpm_dir, sys_rpm_metadata = self._find_sys_rpm_py_files()
+        if not sys_rpm_dir:
+            return False
+        dst_dir = self.python.python_lib_dir
+        if (os.path.realpath(os.path.dirname(sys_rpm_dir))
+           == os.path.realpath(dst_dir)):
+            Log.debug('The system binding is in the site-packages directory.')
+            return False
+
+        Log.info("Linking the system RPM Python binding '{0}'".format(
+                 sys_rpm_dir))
+        self._remove_existing_rpm_dirs()
+        self._remove_existing_rpm_metadata()
+        os.symlink(sys_rpm_dir, self.python.python_lib_rpm_dir)
+        os.symlink(sys_rpm_metadata, os.path.join(
+            dst_dir, os.path.basename(sys_rpm_metadata)))
+        return True
+
+    def _find_sys_rpm_py_files(self):
+        """Find the system binding for the Python ABI and RPM version.
+
+        Return the rpm package directory and the metadata file path,
+        or (None, None) if it is not found.
+        """
+        version_info = self.python.version_info
+        if version_info < (3, 0):
+            # The extension file name does not have the ABI tag.
+            Log.debug('Link mode is not supported on Python 2.')
+            return (None, None)
+        ext_file_name = '_rpm.{0}.so'.format(self.python.soabi)
+        version = self.rpm_py_version.version.replace('-', '_')
+        for lib_dir_format in self.SYS_PYTHON_LIB_DIR_FORMATS:
+            lib_dir = lib_dir_format.format(*version_info)
+            rpm_dir = os.path.join(lib_dir, 'rpm')
+            if not os.path.isfile(os.path.join(rpm_dir, ext_file_name)):
+                continue
+            for pattern in ['rpm-*.egg-info', 'rpm-*.dist-info']:
+                for metadata in glob.glob(os.path.join(lib_dir, pattern)):
+                    match = re.match(r'^rpm-([^-]+)',
+                                     os.path.basename(metadata))
+                    if match and match.group(1) == version:
+                        return (rpm_dir, metadata)
+            Log.debug("System binding '{0}' is not version {1}.".format(
+                      rpm_dir, self.rpm_py_version.version))
+        return (None, None)
+
+    def install_from_build_cache(self):
+        """Run install from the build artifact in the cache.
+
+        The artifact is built before for the same RPM version, Python ABI,
+        arch, patches and linked librpm.
+        Return True if it is installed, False if it is not cached.
+        """
+        if not self.cache:
+            return False
+        key = self._get_build_cache_key()
+        self._build_cache_key = key
+        if not key:
+            return False
+        file_path = self.cache.get_build(key)
+        if not file_path:
+            Log.debug('Build cache not found. key: {0}'.format(key))
+            return False
+
+        Log.info("Installing from the build cache '{0}'".format(file_path))
+        if file_path.endswith('.whl'):
+            self._install_wheel(file_path)
+            return True
+        extracted_dir = tempfile.mkdtemp(prefix='build-cache-', dir='.')
+        with Cmd.pushd(extracted_dir):
+            Cmd.tar_extract(file_path)
+            egg_infos = glob.glob('rpm-*.egg-info')
+            self._copy_rpm_py_files('rpm',
+                                    egg_infos[0] if egg_infos else None)
+        return True
+
     def _make_lib_file_symbolic_links(self):
         """Make symbolic links for lib files.
 
@@ -668,9 +2033,9 @@ class Installer(object):
 
         for name in so_file_dict:
             so_dict = so_file_dict[name]
-            pattern = 'lib{0}.so*'.format(name)
-            so_files = Cmd.find(so_dict['sym_src_dir'], pattern)
-            if not so_files:
+            lib_name = 'lib{0}.so'.format(name)
+            so_file = self.lib_resolver.find(so_dict['sym_src_dir'], lib_name)
+            if not so_file:
                 is_required = so_dict.get('require', False)
                 if not is_required:
                     message_format = (
@@ -680,8 +2045,8 @@ class Installer(object):
                     Log.debug(message_format.format(name))
                     continue
 
-                message = 'so file pattern {0} not found at {1}'.format(
-                    pattern, so_dict['sym_src_dir']
+                message = 'so file {0}* not found at {1}'.format(
+                    lib_name, so_dict['sym_src_dir']
                 )
                 raise InstallError(message)
             sym_dst_dir = os.path.abspath('../{0}'.format(
@@ -689,7 +2054,7 @@ class Installer(object):
             if not os.path.isdir(sym_dst_dir):
                 Cmd.mkdir_p(sym_dst_dir)
 
-            cmd = 'ln -sf {0} {1}/lib{2}.so'.format(so_files[0],
+            cmd = 'ln -sf {0} {1}/lib{2}.so'.format(so_file,
                                                     sym_dst_dir,
                                                     name)
             Cmd.sh_e(cmd)
@@ -713,6 +2078,7 @@ class Installer(object):
                     rpm/*.h
         .
         This is a status after running "make" on actual rpm build process.
+        The header files are staged by symbolic links instead of copies.
         """
         src_header_dirs = [
             'rpmio',
@@ -720,29 +2086,26 @@ class Installer(object):
             'build',
             'sign',
         ]
+        staged_num = 0
         with Cmd.pushd('..'):
-            src_include_dir = os.path.abspath('./include')
+            dst_include_dir = os.path.abspath(os.path.join('include', 'rpm'))
             for header_dir in src_header_dirs:
                 if not os.path.isdir(header_dir):
                     message_format = "Skip not existing header directory '{0}'"
                     Log.debug(message_format.format(header_dir))
                     continue
-                header_files = Cmd.find(header_dir, '*.h')
-                for header_file in header_files:
-                    pattern = '^{0}/'.format(header_dir)
-                    (dst_header_file, subs_num) = re.subn(pattern,
-                                                          '', header_file)
-                    if subs_num == 0:
-                        message = 'Failed to replace header_file: {0}'.format(
-                            header_file)
-                        raise ValueError(message)
-                    dst_header_file = os.path.abspath(
-                        os.path.join(src_include_dir, 'rpm', dst_header_file)
-                    )
+                src_dir = os.path.abspath(header_dir)
+                for rel_path in Cmd.scan_files(src_dir, '.h'):
+                    dst_header_file = os.path.join(dst_include_dir, rel_path)
                     dst_dir = os.path.dirname(dst_header_file)
                     if not os.path.isdir(dst_dir):
                         Cmd.mkdir_p(dst_dir)
-                    shutil.copyfile(header_file, dst_header_file)
+                    if os.path.lexists(dst_header_file):
+                        os.remove(dst_header_file)
+                    os.symlink(os.path.join(src_dir, rel_path),
+                               dst_header_file)
+                    staged_num += 1
+        Log.info('Staged {0} header files.'.format(staged_num))
 
     def _make_dep_lib_file_sym_links_and_copy_include_files(self):
         """Make symbolick links for lib files and copy include files.
@@ -791,17 +2154,16 @@ Install the {0} package.
             # /lib/*/libpopt.so* installed at libpopt0-1.16-8ubuntu1
             '/lib',
         ]
-        pattern = 'libpopt.so*'
+        lib_name = 'libpopt.so'
         popt_so_file = None
         for popt_lib_dir in popt_lib_dirs:
-            so_files = Cmd.find(popt_lib_dir, pattern)
-            if so_files:
-                popt_so_file = so_files[0]
+            popt_so_file = self.lib_resolver.find(popt_lib_dir, lib_name)
+            if popt_so_file:
                 break
 
         if not popt_so_file:
-            message = 'so file pattern {0} not found at {1}'.format(
-                pattern, str(popt_lib_dirs)
+            message = 'so file {0}* not found at {1}'.format(
+                lib_name, str(popt_lib_dirs)
             )
             raise InstallError(message)
 
@@ -812,12 +2174,248 @@ Install the {0} package.
         # Copy popt.h to rpm_root/include
         shutil.copy('./usr/include/popt.h', '../include')
 
-    def _build_and_install(self):
+    def _build_and_install(self, **kwargs):
+        build_dir = kwargs.get('build_dir')
         python_path = self.python.python_path
-        Cmd.sh_e('{0} setup.py {1} build'.format(python_path,
-                                                 self.setup_py_opts))
-        Cmd.sh_e('{0} setup.py {1} install'.format(python_path,
-                                                   self.setup_py_opts))
+        build_kwargs = {}
+        ccache_stats = None
+        if self.ccache:
+            build_kwargs = self._get_ccache_build_kwargs()
+            if build_kwargs:
+                ccache_stats = self._get_ccache_stats(build_kwargs['env'])
+        if build_dir:
+            build_kwargs['cwd'] = build_dir
+
+        wheel_path = self._build_wheel(**build_kwargs)
+        if wheel_path:
+            self._install_wheel(wheel_path)
+        else:
+            Cmd.sh_e('{0} setup.py {1} {2}'.format(python_path,
+                                                   self.setup_py_opts,
+                                                   self._get_build_cmd()),
+                     **build_kwargs)
+            Cmd.sh_e('{0} setup.py {1} install'.format(python_path,
+                                                       self.setup_py_opts),
+                     **build_kwargs)
+
+        if ccache_stats is not None:
+            self._log_ccache_stats(ccache_stats,
+                                   self._get_ccache_stats(build_kwargs['env']))
+        if self.cache:
+            self._store_build_cache(wheel_path, build_dir=build_dir)
+
+    def _get_ccache_build_kwargs(self):
+        """Return the arguments to run the build with ccache.
+
+        Return the empty arguments if ccache command is not found.
+        """
+        ccache_path = Cmd.which('ccache')
+        if not ccache_path:
+            Log.warn('ccache command not found. Build without ccache.')
+            return {}
+        cc = self.python.cc or 'cc'
+        env = {
+            'CC': '{0} {1}'.format(ccache_path, cc),
+        }
+        if self.ccache_dir:
+            env['CCACHE_DIR'] = self.ccache_dir
+        return {'env': env}
+
+    def _get_ccache_stats(self, env):
+        """Return the statistics counters of ccache.
+
+        Return None if the statistics are not available.
+        "ccache --print-stats" is available from ccache 3.7.
+        """
+        try:
+            stdout = Cmd.sh_e_out('ccache --print-stats', env=env)
+        except InstallError as exc:
+            Log.debug('ccache statistics not available. reason: {0}'.format(
+                      exc))
+            return None
+        stats = {}
+        for line in stdout.splitlines():
+            items = line.split('\t')
+            if len(items) == 2 and items[1].isdigit():
+                stats[items[0]] = int(items[1])
+        return stats
+
+    def _log_ccache_stats(self, stats_before, stats_after):
+        if stats_after is None:
+            return
+
+        def diff(name):
+            return stats_after.get(name, 0) - stats_before.get(name, 0)
+
+        hits = diff('direct_cache_hit') + diff('preprocessed_cache_hit')
+        misses = diff('cache_miss')
+        Log.info('ccache: {0} hits, {1} misses.'.format(hits, misses))
+
+    def _build_wheel(self, **kwargs):
+        """Build a wheel by one setup.py process.
+
+        Return the wheel file path, or None if bdist_wheel command is not
+        available, such as the wheel package is not installed.
+        """
+        cmd = '{0} setup.py {1} bdist_wheel -d {2}'.format(
+            self.python.python_path, self.setup_py_opts, self.WHEEL_DIR)
+        if self.jobs > 1:
+            # Run the build command with the option before bdist_wheel.
+            cmd = '{0} setup.py {1} {2} bdist_wheel -d {3}'.format(
+                self.python.python_path, self.setup_py_opts,
+                self._get_build_cmd(), self.WHEEL_DIR)
+        try:
+            Cmd.sh_e(cmd, **kwargs)
+        except CmdError as exc:
+            if exc.stderr and 'invalid command' in exc.stderr:
+                Log.debug('bdist_wheel not available. Build by setup.py '
+                          'build and install.')
+                return None
+            raise exc
+        wheel_dir = os.path.join(kwargs.get('cwd', '.'), self.WHEEL_DIR)
+        wheel_paths = glob.glob(os.path.join(wheel_dir, 'rpm-*.whl'))
+        if not wheel_paths:
+            raise InstallError('Built wheel not found in {0}'.format(
+                               wheel_dir))
+        return os.path.normpath(wheel_paths[0])
+
+    def _get_build_cmd(self):
+        # "build -j" is available from Python 3.5.
+        if self.jobs > 1 and self.python.version_info >= (3, 5):
+            return 'build -j {0}'.format(self.jobs)
+        return 'build'
+
+    def _install_wheel(self, wheel_path):
+        """Install the wheel by unpacking it to site-packages directory.
+
+        It behaves like "pip install --no-deps wheel_path" for the wheel
+        without scripts and data files.
+        """
+        dst_dir = self.python.python_lib_dir
+        with contextlib.closing(zipfile.ZipFile(wheel_path)) as whl:
+            names = whl.namelist()
+            for name in names:
+                if name.startswith('/') or '..' in name.split('/'):
+                    raise InstallError('Invalid file {0} in wheel {1}'.format(
+                                       name, wheel_path))
+            self._remove_existing_rpm_dirs()
+            self._remove_existing_rpm_metadata()
+            if not self.store:
+                Log.debug("Unpack wheel '{0}' to '{1}'".format(
+                          wheel_path, dst_dir))
+                whl.extractall(dst_dir)
+                return
+
+            unpacked_dir = tempfile.mkdtemp(prefix='wheel-', dir='.')
+            try:
+                whl.extractall(unpacked_dir)
+                self.store.link_tree(unpacked_dir, dst_dir)
+            finally:
+                shutil.rmtree(unpacked_dir, ignore_errors=True)
+
+    def _get_build_cache_key(self):
+        """Return the key of the build artifact.
+
+        Return None if the linked librpm is not found.
+        """
+        lib_dir = self.rpm.lib_dir
+        if not lib_dir:
+            return None
+        so_file = self.lib_resolver.find(lib_dir, 'librpm.so')
+        match = None
+        if so_file:
+            match = re.match(r'^(librpm\.so\.\d+)', os.path.basename(so_file))
+        if not match:
+            Log.debug('librpm soname not found at {0}'.format(lib_dir))
+            return None
+        key_dict = {
+            'version': self.rpm_py_version.version,
+            'soabi': self.python.soabi,
+            'arch': self.rpm.arch,
+            'patches': self.setup_py.get_patches_digest(
+                lib_dir, self.rpm.include_dir),
+            'librpm': match.group(1),
+        }
+        return json.dumps(key_dict, sort_keys=True)
+
+    def _store_build_cache(self, wheel_path=None, **kwargs):
+        """Store the built wheel or rpm package directory to the cache."""
+        build_dir = kwargs.get('build_dir') or '.'
+        key = self._build_cache_key
+        if key and wheel_path:
+            self.cache.put_build(key, wheel_path)
+            return
+
+        built_rpm_dirs = glob.glob(os.path.join(build_dir, 'build', 'lib*',
+                                                'rpm'))
+        if not key or not built_rpm_dirs:
+            Log.debug('Skip storing the build cache.')
+            return
+
+        egg_info_path = os.path.join(
+            build_dir, 'rpm-{0}-py{1}.{2}.egg-info'.format(
+                self.rpm_py_version.version.replace('-', '_'),
+                self.python.version_info[0], self.python.version_info[1]))
+        with open(egg_info_path, 'w') as f_out:
+            f_out.write('Metadata-Version: 1.0\n')
+            f_out.write('Name: rpm\n')
+            f_out.write('Version: {0}\n'.format(self.rpm_py_version.version))
+            f_out.write('Summary: Python bindings for rpm\n')
+        build_cache_file_path = os.path.join(build_dir,
+                                             self.BUILD_CACHE_FILE_NAME)
+        Cmd.tar_create(build_cache_file_path,
+                       [built_rpm_dirs[0], egg_info_path])
+        self.cache.put_build(key, build_cache_file_path)
+
+    def _copy_rpm_py_files(self, src_rpm_dir, src_egg_info=None):
+        """Copy the rpm package directory and egg info file to Python."""
+        self._remove_existing_rpm_dirs()
+
+        dst_rpm_dir = self.python.python_lib_rpm_dir
+        Log.debug("Copy directory from '{0}' to '{1}'".format(
+                  src_rpm_dir, dst_rpm_dir))
+        if self.store:
+            self.store.link_tree(src_rpm_dir, dst_rpm_dir)
+        else:
+            shutil.copytree(src_rpm_dir, dst_rpm_dir)
+
+        if src_egg_info:
+            existing_rpm_egg_info_pattern = os.path.join(
+                self.python.python_lib_dir, 'rpm-*.egg-info')
+            existing_rpm_egg_infos = glob.glob(existing_rpm_egg_info_pattern)
+            for existing_rpm_egg_info in existing_rpm_egg_infos:
+                Log.debug("Remove existing rpm egg info file '{0}'".format(
+                          existing_rpm_egg_info))
+                os.remove(existing_rpm_egg_info)
+
+            Log.debug("Copy file from '{0}' to '{1}'".format(
+                      src_egg_info, self.python.python_lib_dir))
+            if self.store:
+                self.store.link_file(src_egg_info, os.path.join(
+                    self.python.python_lib_dir,
+                    os.path.basename(src_egg_info)))
+            else:
+                shutil.copy2(src_egg_info, self.python.python_lib_dir)
+
+    def _remove_existing_rpm_dirs(self):
+        # Remove rpm directory for the possible installed directories.
+        for rpm_dir in self.python.python_lib_rpm_dirs:
+            if os.path.islink(rpm_dir):
+                Log.debug("Remove existing rpm link {0}".format(rpm_dir))
+                os.remove(rpm_dir)
+            elif os.path.isdir(rpm_dir):
+                Log.debug("Remove existing rpm directory {0}".format(rpm_dir))
+                shutil.rmtree(rpm_dir)
+
+    def _remove_existing_rpm_metadata(self):
+        for pattern in ['rpm-*.egg-info', 'rpm-*.dist-info']:
+            for path in glob.glob(os.path.join(self.python.python_lib_dir,
+                                               pattern)):
+                Log.debug("Remove existing rpm metadata '{0}'".format(path))
+                if os.path.isdir(path) and not os.path.islink(path):
+                    shutil.rmtree(path)
+                else:
+                    os.remove(path)
 
     def _rpm_py_has_popt_devel_dep(self):
         """Check if the RPM Python binding has a depndency to popt-devel.
@@ -905,12 +2503,7 @@ because these must be already present on the system.
         This *should* always return True on SUSE based distributions, as zypper
         and libsolv depend on popt. Nevertheless, we rather check this via rpm.
         """
-        try:
-            Cmd.sh_e('{0} --query --whatprovides {1} --quiet'
-                     .format(self.rpm.rpm_path, self.package_popt_name))
-            return True
-        except CmdError:
-            return False
+        return self.rpm.is_package_provided(self.package_popt_name)
 
 
 class FedoraInstaller(NativeRpmInstaller):
@@ -923,7 +2516,12 @@ class FedoraInstaller(NativeRpmInstaller):
 
     def run(self):
         """Run install main logic."""
-        try:
+        self.prepare()
+        self.build_and_install()
+
+    def prepare(self):
+        """Prepare the files to build, and save setup.py."""
+        with self._hint_rpm_devel():
             if not self._is_rpm_all_lib_include_files_installed():
                 self._make_lib_file_symbolic_links()
                 self._copy_each_include_files_to_include_dir()
@@ -932,16 +2530,30 @@ class FedoraInstaller(NativeRpmInstaller):
                     self.rpm.lib_dir, self.rpm.include_dir
                 )
             self.setup_py.apply_and_save()
-            self._build_and_install()
+
+    def build_and_install(self, **kwargs):
+        """Build and install in the prepared build_dir."""
+        with self._hint_rpm_devel():
+            self._build_and_install(**kwargs)
+
+    @contextlib.contextmanager
+    def _hint_rpm_devel(self):
+        """Add the hint to install rpm-devel to the failure message.
+
+        It is used for both a Python and each of the Pythons.
+        """
+        try:
+            yield
         except InstallError as exc:
-            if not self._is_rpm_all_lib_include_files_installed():
-                org_message = str(exc)
-                message = '''
+            if self._is_rpm_all_lib_include_files_installed():
+                raise
+            org_message = str(exc)
+            message = '''
 Install failed without rpm-devel package by below reason.
 Can you install the RPM package, and run this installer again?
 '''
-                message += org_message
-                raise InstallError(message)
+            message += org_message
+            raise InstallError(message)
 
     def install_from_rpm_py_package(self):
         """Run install from RPM Python binding RPM package."""
@@ -971,34 +2583,13 @@ Can you install the RPM package, and run this installer again?
             raise RpmPyPackageNotFoundError(message)
         src_rpm_dir = downloaded_rpm_dirs[0]
 
-        # Remove rpm directory for the possible installed directories.
-        for rpm_dir in self.python.python_lib_rpm_dirs:
-            if os.path.isdir(rpm_dir):
-                Log.debug("Remove existing rpm directory {0}".format(rpm_dir))
-                shutil.rmtree(rpm_dir)
-
-        dst_rpm_dir = self.python.python_lib_rpm_dir
-        Log.debug("Copy directory from '{0}' to '{1}'".format(
-                  src_rpm_dir, dst_rpm_dir))
-        shutil.copytree(src_rpm_dir, dst_rpm_dir)
-
-        file_name_pattern = 'rpm-*.egg-info'
         rpm_egg_info_pattern = os.path.join(
-                               python_lib_dir_pattern, file_name_pattern)
+                               python_lib_dir_pattern, 'rpm-*.egg-info')
         downloaded_rpm_egg_infos = glob.glob(rpm_egg_info_pattern)
+        src_egg_info = None
         if downloaded_rpm_egg_infos:
-            existing_rpm_egg_info_pattern = os.path.join(
-                self.python.python_lib_dir, file_name_pattern)
-            existing_rpm_egg_infos = glob.glob(existing_rpm_egg_info_pattern)
-            for existing_rpm_egg_info in existing_rpm_egg_infos:
-                Log.debug("Remove existing rpm egg info file '{0}'".format(
-                          existing_rpm_egg_info))
-                os.remove(existing_rpm_egg_info)
-
-            Log.debug("Copy file from '{0}' to '{1}'".format(
-                      downloaded_rpm_egg_infos[0], self.python.python_lib_dir))
-            shutil.copy2(downloaded_rpm_egg_infos[0],
-                         self.python.python_lib_dir)
+            src_egg_info = downloaded_rpm_egg_infos[0]
+        self._copy_rpm_py_files(src_rpm_dir, src_egg_info)
 
     def _is_rpm_all_lib_include_files_installed(self):
         """Check if all rpm lib and include files are installed.
@@ -1198,6 +2789,8 @@ class Linux(object):
 
     OS_RELEASE_FILE = '/etc/os-release'
     REDHAT_RELEASE_FILE = '/etc/redhat-release'
+    # The system facts only used on the distribution.
+    OPTIONAL_FACTS = []
 
     def __init__(self, python, rpm_path, **kwargs):
         """Initialize this class."""
@@ -1207,6 +2800,8 @@ class Linux(object):
             raise ValueError('rpm_path required.')
 
         self.python = python
+        # The facts shared by the objects for this Linux.
+        self.facts = SystemFacts(rpm_path, optional_facts=self.OPTIONAL_FACTS)
         self.rpm = self.create_rpm(rpm_path)
         self.sys_installed = kwargs.get('sys_installed', False)
 
@@ -1292,20 +2887,48 @@ class Linux(object):
         """Create Installer object."""
         raise NotImplementedError('Implement this method.')
 
-    def verify_system_status(self):
-        """Verify system status."""
+    def verify_system_status(self, **kwargs):
+        """Verify system status.
+
+        Verify each of pythons, the Python of this Linux by default.
+        Return the Pythons to install, except the system Pythons with the
+        binding already installed. Raise InstallSkipError if no Python is
+        left.
+        """
+        pythons = kwargs.get('pythons') or [self.python]
         if not sys.platform.startswith('linux'):
             raise InstallError('Supported platform is Linux only.')
 
+        target_pythons = []
+        for python in pythons:
+            try:
+                self.verify_python_status(python)
+            except InstallSkipError:
+                if len(pythons) == 1:
+                    raise
+                Log.info("Skip Python '{0}'.".format(python.python_path))
+                continue
+            target_pythons.append(python)
+        if not target_pythons:
+            message = 'RPM Python binding already installed on all Pythons.'
+            raise InstallSkipError(message)
+
+        if self.rpm.is_system_rpm():
+            self.verify_package_status()
+        return target_pythons
+
+    def verify_python_status(self, python):
+        """Verify the status of the Python to install."""
         """RPM 4.16.0 dropped the Python 2 compatibility.
         https://github.com/rpm-software-management/rpm/commit/aa71073
         """
-        if self.rpm.version_info >= (4, 16) and sys.version_info < (3, 0):
+        if self.rpm.version_info >= (4, 16) and \
+                python.version_info < (3, 0):
             message = 'RPM version >= 4.16 does not support Python 2.'
             raise InstallError(message)
 
-        if self.python.is_system_python():
-            if self.python.is_python_binding_installed():
+        if python.is_system_python():
+            if python.is_python_binding_installed():
                 message = '''
 RPM Python binding already installed on system Python.
 Nothing to do.
@@ -1322,9 +2945,6 @@ or set a environment variable RPM_PY_SYS=true
 '''
                 raise InstallError(message)
 
-        if self.rpm.is_system_rpm():
-            self.verify_package_status()
-
     def verify_package_status(self):
         """Verify package stauts."""
         raise NotImplementedError('Implement this method.')
@@ -1336,6 +2956,8 @@ class FedoraLinux(Linux):
     including CentOS, Red Hat Enterprise Linux.
     """
 
+    OPTIONAL_FACTS = ['rpm_arch']
+
     def __init__(self, python, rpm_path, **kwargs):
         """Initialize this class."""
         Linux.__init__(self, python, rpm_path, **kwargs)
@@ -1361,7 +2983,7 @@ Install any of those.
 
     def create_rpm(self, rpm_path):
         """Create Rpm object."""
-        return FedoraRpm(rpm_path)
+        return FedoraRpm(rpm_path, facts=self.facts)
 
     def create_installer(self, rpm_py_version, **kwargs):
         """Create Installer object."""
@@ -1374,13 +2996,15 @@ class SuseLinux(Linux):
     This includes openSUSE Tumbleweed, openSUSE Leap and SLE.
     """
 
+    OPTIONAL_FACTS = ['rpm_ndb']
+
     def __init__(self, python, rpm_path, **kwargs):
         """Initialize this class."""
         Linux.__init__(self, python, rpm_path, **kwargs)
 
     def create_rpm(self, rpm_path):
         """Return a initialized SuseRpm object."""
-        return SuseRpm(rpm_path)
+        return SuseRpm(rpm_path, facts=self.facts)
 
     def create_installer(self, rpm_py_version, **kwargs):
         """Return a initialized SuseInstaller object."""
@@ -1414,7 +3038,7 @@ class DebianLinux(Linux):
 
     def create_rpm(self, rpm_path):
         """Create Rpm object."""
-        return DebianRpm(rpm_path)
+        return DebianRpm(rpm_path, facts=self.facts)
 
     def create_installer(self, rpm_py_version, **kwargs):
         """Create Installer object."""
@@ -1422,16 +3046,93 @@ class DebianLinux(Linux):
 
 
 class Python(object):
-    """A class for Python environment."""
+    """A class for Python environment.
+
+    The information of the Python other than the Python running this script
+    is got by running the Python.
+    """
+
+    INFO_SCRIPT = '''
+import json
+import sys
+import sysconfig
+try:
+    from distutils.sysconfig import get_python_lib
+    arch_dir = get_python_lib(plat_specific=True)
+    non_arch_dir = get_python_lib()
+except ImportError:
+    arch_dir = sysconfig.get_paths()['platlib']
+    non_arch_dir = sysconfig.get_paths()['purelib']
+print(json.dumps({
+    'version_info': list(sys.version_info[:3]),
+    'soabi': sysconfig.get_config_var('SOABI'),
+    'maxunicode': sys.maxunicode,
+    'cc': sysconfig.get_config_var('CC'),
+    'arch_dir': arch_dir,
+    'non_arch_dir': non_arch_dir,
+}))
+'''
 
     def __init__(self, python_path=sys.executable):
         """Initialize this class."""
         self.python_path = python_path
+        self._info = None
+
+    @property
+    def is_current(self):
+        """Check if the Python is the Python running this script."""
+        return self.python_path == sys.executable
+
+    @property
+    def info(self):
+        """Information of the Python other than the running Python."""
+        if self._info is None:
+            if sys.version_info >= (3, 3):
+                from shlex import quote
+            else:
+                from pipes import quote
+            cmd = '{0} -c {1}'.format(self.python_path,
+                                      quote(self.INFO_SCRIPT))
+            self._info = json.loads(Cmd.sh_e_out(cmd))
+        return self._info
+
+    @property
+    def version_info(self):
+        """Version info tuple. ex. (3, 9, 7)."""
+        if self.is_current:
+            return tuple(sys.version_info[:3])
+        return tuple(self.info['version_info'])
+
+    @property
+    def cc(self):
+        """C compiler command used to build the Python."""
+        if self.is_current:
+            return sysconfig.get_config_var('CC')
+        return self.info['cc']
 
     def is_system_python(self):
         """Check if the Python is system Python."""
         return self.python_path.startswith('/usr/bin/python')
 
+    @property
+    def soabi(self):
+        """ABI tag of the extension module.
+
+        ex. cpython-39-x86_64-linux-gnu
+        """
+        if self.is_current:
+            soabi = sysconfig.get_config_var('SOABI')
+            maxunicode = sys.maxunicode
+        else:
+            soabi = self.info['soabi']
+            maxunicode = self.info['maxunicode']
+        if not soabi:
+            # Python 2 does not have SOABI.
+            soabi = 'cpython-{0}{1}{2}'.format(
+                self.version_info[0], self.version_info[1],
+                'mu' if maxunicode > 0xffff else 'm')
+        return soabi
+
     @property
     def python_lib_dir(self):
         """site-packages directory."""
@@ -1443,6 +3144,8 @@ class Python(object):
 
         lib{64,32}/pythonN.N/site-packages
         """
+        if not self.is_current:
+            return self.info['arch_dir']
         return get_python_lib(plat_specific=True)
 
     @property
@@ -1451,6 +3154,8 @@ class Python(object):
 
         lib/pythonN.N/site-packages
         """
+        if not self.is_current:
+            return self.info['non_arch_dir']
         return get_python_lib()
 
     @property
@@ -1555,9 +3260,425 @@ class Python(object):
         return lines
 
 
+class SystemFacts(object):
+    """A snapshot of the system facts used by the RPM environment.
+
+    The facts are collected by one shell command at the first access,
+    instead of running a command for each fact on every access.
+    """
+
+    # The fact name and the command printing the value.
+    FACT_COMMANDS = [
+        ('arch', 'uname -m'),
+        ('rpm_version', '"{rpm_path}" --version'),
+        ('rpm_dbpath', '"{rpm_path}" --eval "%{{_dbpath}}"'),
+    ]
+    # The facts only collected for the distributions using them.
+    OPTIONAL_FACT_COMMANDS = {
+        'rpm_arch': 'rpm -q rpm --qf "%{{arch}}"',
+        # 1 if the command succeeded, otherwise 0.
+        'rpm_ndb': 'rpm -q rpm-ndb',
+    }
+    STATUS_FACT_NAMES = ['rpm_ndb']
+    # The facts replacing a command run for each access.
+    REPLACED_FACT_NAMES = ['arch', 'rpm_version', 'rpm_arch', 'rpm_ndb']
+
+    def __init__(self, rpm_path, **kwargs):
+        """Initialize this class."""
+        self.rpm_path = rpm_path
+        self.fact_commands = list(self.FACT_COMMANDS)
+        for name in kwargs.get('optional_facts', []):
+            self.fact_commands.append(
+                (name, self.OPTIONAL_FACT_COMMANDS[name]))
+        self._facts = None
+        self._commands = {}
+        # The number of the replaced facts read from the snapshot.
+        self._hits = 0
+        # The number of the processes started to collect the facts.
+        self._started_processes = 0
+
+    @property
+    def saved_subprocesses(self):
+        """Return the number of the subprocesses saved by the snapshot.
+
+        It is the number of the commands replaced by reading the facts
+        minus the processes started by the snapshot, the shell and the
+        commands in it. It is negative if the snapshot started more.
+        """
+        return self._hits - self._started_processes
+
+    def get(self, name):
+        """Return the fact value, or None if the fact is not collected.
+
+        The caller runs the command by itself for None, to get the error.
+        """
+        if self._facts is None:
+            self._facts = self._collect()
+        value = self._facts.get(name)
+        if value is not None and name in self.REPLACED_FACT_NAMES:
+            self._hits += 1
+        return value
+
+    def set(self, name, value):
+        """Set the fact value found by the caller for the later access."""
+        if self._facts is None:
+            self._facts = self._collect()
+        self._facts[name] = value
+
+    def has_command(self, cmd):
+        """Return if the command exists in the PATH."""
+        if cmd not in self._commands:
+            self._commands[cmd] = bool(Cmd.which(cmd))
+        return self._commands[cmd]
+
+    def _get_script(self):
+        """Return the script printing "name=value" lines.
+
+        A value is printed only when the command succeeded.
+        """
+        lines = []
+        for (name, cmd) in self.fact_commands:
+            cmd = cmd.format(rpm_path=self.rpm_path)
+            if name in self.STATUS_FACT_NAMES:
+                line_format = (
+                    'if {1} > /dev/null; then echo "{0}=1"; '
+                    'else echo "{0}=0"; fi'
+                )
+            else:
+                line_format = 'if out=$({1}); then echo "{0}=$out"; fi'
+            lines.append(line_format.format(name, cmd))
+        return '\n'.join(lines) + '\n'
+
+    def _collect(self):
+        script = self._get_script()
+        self._started_processes = 1 + len(self.fact_commands)
+        try:
+            stdout = Cmd.sh_e_out(script)
+        except InstallError as exc:
+            Log.debug('Failed to collect system facts: {0}'.format(exc))
+            return {}
+        facts = {}
+        for line in stdout.split('\n'):
+            (name, sep, value) = line.partition('=')
+            value = value.strip()
+            if sep and value:
+                facts[name] = value
+        return facts
+
+
+class LdSoCache(object):
+    """A parser for the dynamic linker cache file /etc/ld.so.cache.
+
+    It finds the shared libraries without scanning the directories.
+    Only the new format "glibc-ld.so.cache1.1" is supported, including
+    the file starting with the old format "ld.so-1.7.0" compatible part.
+    """
+
+    FILE_PATH = '/etc/ld.so.cache'
+    OLD_MAGIC = b'ld.so-1.7.0'
+    NEW_MAGIC = b'glibc-ld.so.cache1.1'
+    # magic, nlibs, len_strings, flags, extension_offset
+    NEW_HEADER_FORMAT = '=20sIIB3xI12x'
+    # flags, key, value, osversion, hwcap
+    NEW_ENTRY_FORMAT = '=iIIIQ'
+    # The flags for the 64-bit libraries have the architecture bits.
+    FLAG_ARCH_MASK = 0xff00
+
+    def __init__(self, file_path=None):
+        """Initialize this class."""
+        self.file_path = file_path or self.FILE_PATH
+        self._entries = None
+
+    def get_entries(self):
+        """Return a list of the tuples (soname, path, flags).
+
+        Return an empty list if the cache file is not supported.
+        """
+        if self._entries is None:
+            try:
+                with open(self.file_path, 'rb') as f_in:
+                    data = f_in.read()
+                self._entries = self._parse(data)
+            except (IOError, OSError, ValueError, struct.error) as exc:
+                Log.debug("Can not use '{0}': {1}".format(
+                          self.file_path, exc))
+                self._entries = []
+        return self._entries
+
+    def find(self, lib_name):
+        """Return the paths of the library such as "librpm.so".
+
+        The libraries for the word size of the running Python come first.
+        """
+        is_64bit = sys.maxsize > 2 ** 32
+        found_entries = [
+            (path, flags) for (soname, path, flags) in self.get_entries()
+            if soname.startswith(lib_name)
+        ]
+        found_entries.sort(
+            key=lambda entry: bool(entry[1] & self.FLAG_ARCH_MASK) != is_64bit
+        )
+        return [path for (path, _) in found_entries]
+
+    def _parse(self, data):
+        offset = 0
+        if data.startswith(self.OLD_MAGIC):
+            # Skip the old format entries aligned by 8 bytes.
+            (old_nlibs,) = struct.unpack_from('=I', data, 12)
+            offset = 16 + old_nlibs * 12
+            offset += -offset % 8
+        if data[offset:offset + len(self.NEW_MAGIC)] != self.NEW_MAGIC:
+            raise ValueError('Unsupported format.')
+        (_, nlibs, _, _, _) = struct.unpack_from(self.NEW_HEADER_FORMAT,
+                                                 data, offset)
+        entries_offset = offset + struct.calcsize(self.NEW_HEADER_FORMAT)
+        entry_size = struct.calcsize(self.NEW_ENTRY_FORMAT)
+        entries = []
+        for index in range(nlibs):
+            entry_offset = entries_offset + index * entry_size
+            (flags, key, value, _, _) = struct.unpack_from(
+                self.NEW_ENTRY_FORMAT, data, entry_offset)
+            # The string offsets are from the new format header.
+            entries.append((self._get_string(data, offset + key),
+                            self._get_string(data, offset + value), flags))
+        return entries
+
+    def _get_string(self, data, offset):
+        end = data.index(b'\0', offset)
+        return data[offset:end].decode('utf-8')
+
+
+class LibResolver(object):
+    """A resolver to find a shared library file in the library directory.
+
+    It looks up ld.so.cache, or lists the library directory and
+    the multiarch directories in it such as x86_64-linux-gnu,
+    instead of walking the directory tree.
+    """
+
+    MULTIARCH_DIR_PATTERN = '*-linux-gnu*'
+
+    def __init__(self, ld_so_cache=None):
+        """Initialize this class."""
+        self.ld_so_cache = ld_so_cache or LdSoCache()
+
+    def find(self, lib_dir, lib_name):
+        """Return the library file path of the name such as "librpm.so".
+
+        The path is not a symbolic link. The file with the highest
+        so version is the best match. Return None if it is not found.
+        """
+        real_lib_dir = os.path.realpath(lib_dir)
+        lib_paths = [
+            lib_path for lib_path in self.ld_so_cache.find(lib_name)
+            if self._is_in_lib_dir(lib_path, real_lib_dir)
+        ]
+        if not lib_paths:
+            lib_paths = self._list(real_lib_dir, lib_name)
+        Log.debug('Found {0} at {1}: {2}'.format(
+                  lib_name, lib_dir, lib_paths))
+        return self._select(lib_paths)
+
+    def _is_in_lib_dir(self, lib_path, real_lib_dir):
+        real_dir = os.path.realpath(os.path.dirname(lib_path))
+        if real_dir == real_lib_dir:
+            return True
+        (parent_dir, dir_name) = os.path.split(real_dir)
+        return (parent_dir == real_lib_dir and
+                fnmatch.fnmatch(dir_name, self.MULTIARCH_DIR_PATTERN))
+
+    def _list(self, real_lib_dir, lib_name):
+        if not os.path.isdir(real_lib_dir):
+            return []
+        dir_names = os.listdir(real_lib_dir)
+        searched_dirs = [real_lib_dir] + [
+            os.path.join(real_lib_dir, dir_name) for dir_name in dir_names
+            if fnmatch.fnmatch(dir_name, self.MULTIARCH_DIR_PATTERN) and
+            os.path.isdir(os.path.join(real_lib_dir, dir_name))
+        ]
+        lib_paths = []
+        for searched_dir in searched_dirs:
+            file_names = (dir_names if searched_dir == real_lib_dir
+                          else os.listdir(searched_dir))
+            lib_paths.extend(
+                os.path.join(searched_dir, file_name)
+                for file_name in file_names
+                if file_name == lib_name or
+                file_name.startswith(lib_name + '.'))
+        return lib_paths
+
+    def _select(self, lib_paths):
+        real_lib_paths = set(
+            os.path.realpath(lib_path) for lib_path in lib_paths
+        )
+        real_lib_paths = [path for path in real_lib_paths
+                          if os.path.isfile(path)]
+        if not real_lib_paths:
+            return None
+        return max(real_lib_paths, key=self._get_so_version_key)
+
+    def _get_so_version_key(self, lib_path):
+        """Return the sort key by the so version: libfoo.so.1.2.3 -> (1, 2, 3).
+
+        The path is compared for the same so versions to be stable.
+        """
+        match = re.search(r'\.so\.([\d.]+)$', lib_path)
+        version = ()
+        if match:
+            version = tuple(int(num) for num in match.group(1).split('.')
+                            if num)
+        return (version, lib_path)
+
+
+class RpmDb(object):
+    """A read-only reader for the RPM database rpmdb.sqlite.
+
+    It answers the installed packages without running rpm command.
+    The methods raise RpmDbError if the database format is not supported.
+    """
+
+    FILE_NAME = 'rpmdb.sqlite'
+    # Header tags and types.
+    TAG_NAME = 1000
+    TAG_VERSION = 1001
+    TAG_RELEASE = 1002
+    TAG_DIRINDEXES = 1116
+    TAG_BASENAMES = 1117
+    TAG_DIRNAMES = 1118
+    TYPE_INT32 = 4
+    TYPE_STRING = 6
+    TYPE_STRING_ARRAY = 8
+    TYPE_I18NSTRING = 9
+
+    def __init__(self, db_path):
+        """Initialize this class."""
+        if not db_path:
+            raise ValueError('db_path required.')
+        self.db_path = db_path
+        self._conn = None
+
+    @classmethod
+    def find(cls, db_dir):
+        """Return the reader for the database directory.
+
+        Return None if the database is not rpmdb.sqlite.
+        """
+        if not db_dir or not sqlite3:
+            return None
+        db_path = os.path.join(db_dir, cls.FILE_NAME)
+        if not os.path.isfile(db_path):
+            return None
+        return cls(db_path)
+
+    def query_packages(self, package_names):
+        """Return the installed versions of the packages.
+
+        Return a dict of the package name and the version-release,
+        or None if the package is not installed.
+        """
+        versions = {}
+        for package_name in package_names:
+            hnums = self._select('SELECT hnum FROM Name WHERE key = ?',
+                                 package_name)
+            version = None
+            for (hnum,) in hnums:
+                header = self._get_header(hnum)
+                version = '{0}-{1}'.format(header[self.TAG_VERSION],
+                                           header[self.TAG_RELEASE])
+            versions[package_name] = version
+        return versions
+
+    def is_provided(self, name):
+        """Return if any installed package provides the name."""
+        rows = self._select('SELECT hnum FROM Providename WHERE key = ?',
+                            name)
+        return bool(rows)
+
+    def get_file_owners(self, file_path):
+        """Return the names of the installed packages owning the file.
+
+        The directories are compared by the real path, as a directory
+        such as /lib64 can be a symbolic link to /usr/lib64.
+        """
+        (dir_name, base_name) = os.path.split(file_path)
+        real_dir_name = os.path.realpath(dir_name)
+        rows = self._select('SELECT hnum, idx FROM Basenames WHERE key = ?',
+                            base_name)
+        owners = []
+        for (hnum, idx) in rows:
+            header = self._get_header(hnum)
+            dir_index = header[self.TAG_DIRINDEXES][idx]
+            owned_dir_name = header[self.TAG_DIRNAMES][dir_index]
+            if os.path.realpath(owned_dir_name) != real_dir_name:
+                continue
+            if header[self.TAG_NAME] not in owners:
+                owners.append(header[self.TAG_NAME])
+        return owners
+
+    def close(self):
+        """Close the database."""
+        if self._conn:
+            self._conn.close()
+            self._conn = None
+
+    def _connect(self):
+        if not self._conn:
+            uri = 'file:{0}?mode=ro'.format(self.db_path)
+            try:
+                self._conn = sqlite3.connect(uri, uri=True)
+            except TypeError:
+                # Python < 3.4 can not open the database as read-only.
+                raise RpmDbError('Read-only sqlite3 is not supported.')
+        return self._conn
+
+    def _select(self, sql, *params):
+        try:
+            return self._connect().execute(sql, params).fetchall()
+        except sqlite3.Error as exc:
+            raise RpmDbError('Failed to read {0}: {1}'.format(
+                             self.db_path, exc))
+
+    def _get_header(self, hnum):
+        rows = self._select('SELECT blob FROM Packages WHERE hnum = ?', hnum)
+        if not rows:
+            raise RpmDbError('Package {0} not found.'.format(hnum))
+        try:
+            return self._parse_header(bytes(rows[0][0]))
+        except (struct.error, IndexError, UnicodeDecodeError) as exc:
+            raise RpmDbError('Invalid header {0}: {1}'.format(hnum, exc))
+
+    def _parse_header(self, blob):
+        """Parse the header blob: the index entries and the data store."""
+        (index_length, data_length) = struct.unpack_from('>ii', blob, 0)
+        data_start = 8 + index_length * 16
+        data = blob[data_start:data_start + data_length]
+        header = {}
+        for index in range(index_length):
+            (tag, tag_type, offset, count) = struct.unpack_from(
+                '>iiii', blob, 8 + index * 16)
+            if tag_type == self.TYPE_INT32:
+                header[tag] = list(struct.unpack_from(
+                    '>{0}i'.format(count), data, offset))
+            elif tag_type in (self.TYPE_STRING, self.TYPE_STRING_ARRAY,
+                              self.TYPE_I18NSTRING):
+                values = []
+                for _ in range(count):
+                    end = data.index(b'\0', offset)
+                    values.append(data[offset:end].decode('utf-8'))
+                    offset = end + 1
+                header[tag] = (values[0] if tag_type == self.TYPE_STRING
+                               else values)
+        return header
+
+
 class Rpm(object):
     """A class for RPM environment including DNF and Yum."""
 
+    # The packages queried together in one rpm command
+    # when a package is queried first.
+    QUERIED_PACKAGE_NAMES = []
+    QUERY_FORMAT = '%{NAME} %{VERSION}-%{RELEASE}\\n'
+
     def __init__(self, rpm_path, **kwargs):
         """Initialize this class."""
         is_file_checked = kwargs.get('check', True)
@@ -1565,13 +3686,19 @@ class Rpm(object):
             raise InstallError("RPM binary command '{0}' not found.".format(
                                rpm_path))
         self.rpm_path = rpm_path
-        self.arch = Cmd.sh_e_out('uname -m').rstrip()
+        self.facts = kwargs.get('facts') or SystemFacts(rpm_path)
+        self.arch = (self.facts.get('arch') or
+                     Cmd.sh_e_out('uname -m').rstrip())
         self._lib_dir = None
+        # The queried package versions in this run. None: not installed.
+        self._package_versions = {}
+        self.db = RpmDb.find(self.facts.get('rpm_dbpath'))
 
     @property
     def version(self):
         """RPM vesion string."""
-        stdout = Cmd.sh_e_out('{0} --version'.format(self.rpm_path))
+        stdout = (self.facts.get('rpm_version') or
+                  Cmd.sh_e_out('{0} --version'.format(self.rpm_path)))
         rpm_version = stdout.split()[2]
         return rpm_version
 
@@ -1604,13 +3731,81 @@ class Rpm(object):
         if not package_name:
             raise ValueError('package_name required.')
 
-        installed = True
+        versions = self.query_packages([package_name])
+        return versions[package_name] is not None
+
+    def query_packages(self, package_names):
+        """Return the installed versions of the RPM packages.
+
+        Return a dict of the package name and the version-release,
+        or None if the package is not installed. The packages not queried
+        yet in this run, including QUERIED_PACKAGE_NAMES, are queried
+        by one rpm command.
+        """
+        if not package_names:
+            raise ValueError('package_names required.')
+
+        names = [name for name in package_names + self.QUERIED_PACKAGE_NAMES
+                 if name not in self._package_versions]
+        names = sorted(set(names))
+        if names and self.db:
+            try:
+                self._package_versions.update(self.db.query_packages(names))
+                names = []
+            except RpmDbError as exc:
+                Log.debug('Can not use RPM database: {0}'.format(exc))
+                self.db = None
+        if names:
+            cmd = "{0} --query --queryformat '{1}' {2}".format(
+                self.rpm_path, self.QUERY_FORMAT, ' '.join(names))
+            try:
+                (stdout, _) = Cmd.sh_e(cmd, stdout=subprocess.PIPE)
+            except InstallError as exc:
+                # The exit status is the number of not installed packages.
+                stdout = getattr(exc, 'stdout', None)
+            versions = dict((name, None) for name in names)
+            for line in (stdout or '').split('\n'):
+                items = line.split()
+                if len(items) == 2 and items[0] in versions:
+                    versions[items[0]] = items[1]
+            self._package_versions.update(versions)
+
+        return dict((name, self._package_versions[name])
+                    for name in package_names)
+
+    def is_package_provided(self, name):
+        """Check if any installed RPM package provides the name."""
+        if self.db:
+            try:
+                return self.db.is_provided(name)
+            except RpmDbError as exc:
+                Log.debug('Can not use RPM database: {0}'.format(exc))
+                self.db = None
+
+        provided = True
         try:
-            Cmd.sh_e('{0} --query {1} --quiet'.format(self.rpm_path,
-                                                      package_name))
+            Cmd.sh_e('{0} --query --whatprovides {1} --quiet'
+                     .format(self.rpm_path, name))
         except InstallError:
-            installed = False
-        return installed
+            provided = False
+        return provided
+
+    def get_file_owners(self, file_path):
+        """Return the names of the installed RPM packages owning the file."""
+        if self.db:
+            try:
+                return self.db.get_file_owners(file_path)
+            except RpmDbError as exc:
+                Log.debug('Can not use RPM database: {0}'.format(exc))
+                self.db = None
+
+        cmd = "{0} --query --file --queryformat '%{{NAME}}\\n' {1}".format(
+            self.rpm_path, file_path)
+        try:
+            stdout = Cmd.sh_e_out(cmd)
+        except InstallError:
+            return []
+        return [line for line in stdout.split('\n') if line]
 
     def verify_packages_installed(self, package_names):
         """Check if the RPM packages are installed.
@@ -1620,10 +3815,11 @@ class Rpm(object):
         if not package_names:
             raise ValueError('package_names required.')
 
-        missing_packages = []
-        for package_name in package_names:
-            if not self.is_package_installed(package_name):
-                missing_packages.append(package_name)
+        versions = self.query_packages(package_names)
+        missing_packages = [
+            package_name for package_name in package_names
+            if versions[package_name] is None
+        ]
 
         if missing_packages:
             comma_packages = ', '.join(missing_packages)
@@ -1662,6 +3858,16 @@ Install the RPM package.
 class NativeRpm(Rpm):
     """A class for a RPM environment for RPM based distributions."""
 
+    QUERIED_PACKAGE_NAMES = [
+        'rpm-libs',
+        'rpm-build-libs',
+        'rpm-devel',
+        'popt',
+        'popt-devel',
+        'dnf-plugins-core',
+        'yum-utils',
+    ]
+
     def __init__(self, rpm_path, **kwargs):
         """Initialize this class."""
         Rpm.__init__(self, rpm_path, **kwargs)
@@ -1673,19 +3879,40 @@ class NativeRpm(Rpm):
         TODO: Support non-system RPM.
         """
         if not self._lib_dir:
-            rpm_lib_dir = None
-            cmd = '{rpm_path} -ql {rpm_lib}'.format(
-                rpm_path=self.rpm_path, rpm_lib=self.rpm_lib_pkg_name
-            )
-            out = Cmd.sh_e_out(cmd)
-            lines = out.split('\n')
-            for line in lines:
-                if 'librpm.so' in line:
-                    rpm_lib_dir = os.path.dirname(line)
-                    break
+            rpm_lib_dir = self.facts.get('rpm_lib_dir')
+            if not rpm_lib_dir:
+                lib_path = (self._find_lib_path_from_ld_so_cache() or
+                            self._find_lib_path_from_package())
+                if lib_path:
+                    # Use the real directory not to change the build cache
+                    # key by the symbolic link such as /lib64.
+                    rpm_lib_dir = os.path.realpath(os.path.dirname(lib_path))
+                    self.facts.set('rpm_lib_dir', rpm_lib_dir)
             self._lib_dir = rpm_lib_dir
         return self._lib_dir
 
+    def _find_lib_path_from_ld_so_cache(self):
+        """Return librpm.so path in ld.so.cache owned by the RPM libs package.
+
+        Only the found paths are checked, instead of the package file list.
+        """
+        for lib_path in LdSoCache().find('librpm.so'):
+            if self.rpm_lib_pkg_name in self.get_file_owners(lib_path):
+                return lib_path
+        return None
+
+    def _find_lib_path_from_package(self):
+        # Filter the output here, not to hide the failure of the command
+        # by a pipe.
+        cmd = '{rpm_path} -ql {rpm_lib}'.format(
+            rpm_path=self.rpm_path, rpm_lib=self.rpm_lib_pkg_name
+        )
+        out = Cmd.sh_e_out(cmd)
+        for line in out.split('\n'):
+            if 'librpm.so' in line:
+                return line
+        return None
+
     def download_and_extract(self, package_name):
         """Download and extract given package."""
         self.download(package_name)
@@ -1713,10 +3940,11 @@ class FedoraRpm(NativeRpm):
         """Initialize this class."""
         NativeRpm.__init__(self, rpm_path, **kwargs)
         self.rpm_lib_pkg_name = 'rpm-libs'
-        self.is_dnf = bool(Cmd.which('dnf'))
+        self.is_dnf = self.facts.has_command('dnf')
         # Overide arch with user space architecture, considering
         # a case of that kernel and user space arhitecture are different.
-        self.arch = Cmd.sh_e_out('rpm -q rpm --qf "%{arch}"')
+        self.arch = (self.facts.get('rpm_arch') or
+                     Cmd.sh_e_out('rpm -q rpm --qf "%{arch}"'))
 
     def has_composed_rpm_bulid_libs(self):
         """Return if the system RPM has composed rpm-build-libs package.
@@ -1788,13 +4016,16 @@ class SuseRpm(NativeRpm):
     def __init__(self, rpm_path, **kwargs):
         """Initialize this class and set the necessary constants."""
         NativeRpm.__init__(self, rpm_path, **kwargs)
-        try:
-            # Leap has rpm-ndb installed by default
-            Cmd.sh_e('rpm -q rpm-ndb')
-        except CmdError:
-            self.rpm_lib_pkg_name = 'rpm'
-        else:
-            self.rpm_lib_pkg_name = 'rpm-ndb'
+        # Leap has rpm-ndb installed by default
+        rpm_ndb = self.facts.get('rpm_ndb')
+        if rpm_ndb is None:
+            try:
+                Cmd.sh_e('rpm -q rpm-ndb')
+            except CmdError:
+                rpm_ndb = '0'
+            else:
+                rpm_ndb = '1'
+        self.rpm_lib_pkg_name = 'rpm-ndb' if rpm_ndb == '1' else 'rpm'
 
     @property
     def package_cmd(self):
@@ -1929,6 +4160,12 @@ class CmdError(InstallError):
         self.sterr = None
 
 
+class RpmDbError(InstallError):
+    """A exception class for the unsupported RPM database."""
+
+    pass
+
+
 class RemoteFileNotFoundError(InstallError):
     """A exception class for remote file not found on the server.
 
@@ -1939,6 +4176,21 @@ class RemoteFileNotFoundError(InstallError):
     pass
 
 
+class DownloadError(InstallError):
+    """A exception class for the failed download.
+
+    status_code is the HTTP status code if the server responded.
+    retryable is False when retrying the download does not help,
+    such as the unknown host or the refused connection.
+    """
+
+    def __init__(self, message, **kwargs):
+        """Initialize this class."""
+        InstallError.__init__(self, message)
+        self.status_code = kwargs.get('status_code')
+        self.retryable = kwargs.get('retryable', True)
+
+
 class RpmPyPackageNotFoundError(InstallError):
     """A exception class for RPM Python binding package not found."""
 
@@ -1948,6 +4200,9 @@ class RpmPyPackageNotFoundError(InstallError):
 class Cmd(object):
     """A utility class like a UNIX command."""
 
+    # Number of the retries when a download is interrupted.
+    download_retries = 3
+
     @classmethod
     def sh_e(cls, cmd, **kwargs):
         """Run the command. It behaves like "sh -e".
@@ -1991,7 +4246,7 @@ class Cmd(object):
 
             if returncode != 0:
                 message = 'CMD: [{0}], Return Code: [{1}] at [{2}]'.format(
-                    cmd, returncode, os.getcwd())
+                    cmd, returncode, kwargs.get('cwd', os.getcwd()))
                 if stderr is not None:
                     message += ' Stderr: [{0}]'.format(stderr)
                 ie = CmdError(message)
@@ -2042,6 +4297,69 @@ class Cmd(object):
         finally:
             cls.cd(previous_dir)
 
+    @classmethod
+    @contextlib.contextmanager
+    def lock_file(cls, lock_file_path):
+        """Lock the file exclusively, and unlock it.
+
+        It behaves like "flock lock_file_path something".
+        """
+        while True:
+            with open(lock_file_path, 'a') as f_lock:
+                Log.debug('Lock {0}'.format(lock_file_path))
+                fcntl.flock(f_lock.fileno(), fcntl.LOCK_EX)
+                if not cls._is_locked_file(f_lock, lock_file_path):
+                    # The lock file was removed by the cache eviction
+                    # while waiting. Lock the new lock file.
+                    continue
+                # Update the time not to remove the lock file in use
+                # as an expired file.
+                os.utime(lock_file_path, None)
+                try:
+                    yield
+                finally:
+                    fcntl.flock(f_lock.fileno(), fcntl.LOCK_UN)
+                return
+
+    @classmethod
+    def _is_locked_file(cls, f_lock, lock_file_path):
+        """Return if the file on the path is still the locked file."""
+        try:
+            stat = os.stat(lock_file_path)
+        except OSError as exc:
+            if exc.errno == errno.ENOENT:
+                return False
+            raise
+        return os.fstat(f_lock.fileno()).st_ino == stat.st_ino
+
+    @classmethod
+    def link_file(cls, src_file_path, dst_file_path):
+        """Link the file, or copy it.
+
+        Try a hard link, a reflink (copy-on-write clone) and copying in
+        the order. The reflink is available on such as Btrfs and XFS.
+        Return the method: hardlink, reflink or copy.
+        """
+        try:
+            os.link(src_file_path, dst_file_path)
+            return 'hardlink'
+        except OSError as exc:
+            Log.debug('Hard link failed: {0}'.format(exc))
+
+        # FICLONE ioctl request of Linux.
+        ficlone = 0x40049409
+        try:
+            with open(src_file_path, 'rb') as f_src:
+                with open(dst_file_path, 'wb') as f_dst:
+                    fcntl.ioctl(f_dst.fileno(), ficlone, f_src.fileno())
+            shutil.copystat(src_file_path, dst_file_path)
+            return 'reflink'
+        except (IOError, OSError) as exc:
+            Log.debug('Reflink failed: {0}'.format(exc))
+
+        shutil.copy2(src_file_path, dst_file_path)
+        return 'copy'
+
     @classmethod
     def which(cls, cmd):
         """Return an absolute path of the command.
@@ -2056,48 +4374,349 @@ class Cmd(object):
         return abs_path_cmd
 
     @classmethod
-    def curl_remote_name(cls, file_url):
+    def curl_remote_name(cls, file_url, **kwargs):
         """Download file_url, and save as a file name of the URL.
 
         It behaves like "curl -O or --remote-name".
         It raises HTTPError if the file_url not found.
+        The response is written to the file by chunk, so the memory usage
+        does not depend on the file size. Set hash_obj such as
+        hashlib.sha256() to calculate the checksum while downloading.
+
+        The data is written to the partial file part_file_path first.
+        When the download is interrupted, it retries with exponential
+        backoff, resuming from the partial file by a HTTP Range request.
+        A partial file left by a previous run is resumed too, only if the
+        remote file is not changed. The ETag or Last-Modified of the remote
+        file is saved as the validator file to check it by If-Range.
+        The partial file given by part_file_path such as in the cache
+        directory is locked while downloading, as it can be shared.
         """
+        part_file_path = kwargs.get('part_file_path')
+        if not part_file_path:
+            return cls._curl_remote_name(file_url, **kwargs)
+
+        with cls.lock_file(part_file_path + '.lock'):
+            return cls._curl_remote_name(file_url, **kwargs)
+
+    @classmethod
+    def _curl_remote_name(cls, file_url, **kwargs):
+        hash_obj = kwargs.get('hash_obj')
         tar_gz_file_name = file_url.split('/')[-1]
+        part_file_path = kwargs.get('part_file_path') or \
+            tar_gz_file_name + '.part'
+        validator_file_path = part_file_path + '.validator'
+        retries = kwargs.get('retries', cls.download_retries)
+        backoff = kwargs.get('backoff', 1)
+
+        if sys.version_info >= (3, 0):
+            from http.client import HTTPException
+        else:
+            from httplib import HTTPException
+
+        # Size of the data updating the hash_obj.
+        hashed_size = 0
+        # The partial file is written in this run.
+        is_part_written = False
+        for attempt in range(retries + 1):
+            part_size = 0
+            if os.path.isfile(part_file_path):
+                part_size = os.path.getsize(part_file_path)
+            validator = None
+            if os.path.isfile(validator_file_path):
+                with open(validator_file_path) as f_in:
+                    validator = f_in.read().strip()
+            headers = {}
+            if part_size > 0 and validator:
+                headers['Range'] = 'bytes={0}-'.format(part_size)
+                headers['If-Range'] = validator
+            elif part_size > 0 and is_part_written:
+                # The remote file has no validator. Resume it only in
+                # this run.
+                headers['Range'] = 'bytes={0}-'.format(part_size)
+
+            try:
+                response = cls.urlopen(file_url, headers=headers)
+                try:
+                    if part_size > 0 and response.getcode() == 206:
+                        Log.info('Resume downloading from {0} bytes.'.format(
+                                 part_size))
+                        mode = 'ab'
+                    else:
+                        # The server does not support the Range request,
+                        # or the remote file is changed.
+                        part_size = 0
+                        mode = 'wb'
+                        cls._save_validator(response, validator_file_path)
+                    is_part_written = True
+
+                    if hash_obj is not None and hashed_size < part_size:
+                        # Hash the partial file left by a previous run.
+                        cls._update_hash_by_file(hash_obj, part_file_path,
+                                                 offset=hashed_size)
+                        hashed_size = part_size
+
+                    with open(part_file_path, mode) as f_out:
+                        # Do not hash the data again, when downloading
+                        # the data already hashed from the beginning.
+                        if hash_obj is not None and hashed_size > part_size:
+                            cls.copy_stream(response, f_out,
+                                            max_size=hashed_size - part_size)
+                        cls.copy_stream(response, f_out, hash_obj=hash_obj)
+                finally:
+                    response.close()
+                    if hash_obj is not None:
+                        hashed_size = max(hashed_size,
+                                          os.path.getsize(part_file_path))
+            except RemoteFileNotFoundError:
+                raise
+            except (DownloadError, HTTPException, IOError, OSError) as exc:
+                if isinstance(exc, DownloadError):
+                    if exc.status_code == 416:
+                        # The partial file is not valid for the remote file.
+                        os.remove(part_file_path)
+                        is_part_written = False
+                    if not exc.retryable or attempt >= retries:
+                        raise
+                    # The message already has the URL.
+                    message = str(exc)
+                else:
+                    message = 'Download failed: URL: {0}, reason: {1}'.format(
+                        file_url, exc)
+                    if attempt >= retries:
+                        raise InstallError(message)
+                wait_seconds = backoff * (2 ** attempt)
+                Log.warn('{0}. Retry in {1} seconds.'.format(message,
+                                                             wait_seconds))
+                time.sleep(wait_seconds)
+            else:
+                break
+
+        shutil.move(part_file_path, tar_gz_file_name)
+        if os.path.isfile(validator_file_path):
+            os.remove(validator_file_path)
+        return tar_gz_file_name
+
+    @classmethod
+    def _save_validator(cls, response, validator_file_path):
+        """Save ETag or Last-Modified of the response to check by If-Range.
+
+        A weak ETag can not be used for If-Range.
+        """
+        headers = response.info()
+        validator = headers.get('ETag')
+        if not validator or validator.startswith('W/'):
+            validator = headers.get('Last-Modified')
+        if validator:
+            with open(validator_file_path, 'w') as f_out:
+                f_out.write(validator)
+        elif os.path.isfile(validator_file_path):
+            os.remove(validator_file_path)
+
+    @classmethod
+    def _update_hash_by_file(cls, hash_obj, file_path, **kwargs):
+        offset = kwargs.get('offset', 0)
+        with open(file_path, 'rb') as f_in:
+            f_in.seek(offset)
+            for chunk in iter(lambda: f_in.read(64 * 1024), b''):
+                hash_obj.update(chunk)
+
+    @classmethod
+    def urlopen(cls, file_url, **kwargs):
+        """Open file_url, and return the response.
+
+        It raises RemoteFileNotFoundError if the file_url not found,
+        otherwise DownloadError with the HTTP status code if any.
+        """
+        timeout = kwargs.get('timeout', 10)
+        headers = kwargs.get('headers', {})
 
         if sys.version_info >= (3, 2):
-            from urllib.error import HTTPError
-            from urllib.request import urlopen
+            from urllib.error import HTTPError, URLError
+            from urllib.request import Request, urlopen
         else:
-            from urllib2 import HTTPError, urlopen
+            from urllib2 import HTTPError, Request, URLError, urlopen
 
-        response = None
         try:
-            response = urlopen(file_url, timeout=10)
+            return urlopen(Request(file_url, headers=headers),
+                           timeout=timeout)
         except HTTPError as exc:
             message = 'Download failed: URL: {0}, reason: {1}'.format(
                       file_url, exc)
-            if 'HTTP Error 404' in str(exc):
+            if exc.code == 404:
                 raise RemoteFileNotFoundError(message)
             else:
-                raise InstallError(message)
+                raise DownloadError(message, status_code=exc.code)
+        except URLError as exc:
+            message = 'Download failed: URL: {0}, reason: {1}'.format(
+                      file_url, exc)
+            if file_url.startswith('file:'):
+                raise RemoteFileNotFoundError(message)
+            # The unknown host or the refused connection is not recovered
+            # by a retry.
+            retryable = not (
+                isinstance(exc.reason, socket.gaierror) or
+                getattr(exc.reason, 'errno', None) == errno.ECONNREFUSED
+            )
+            raise DownloadError(message, retryable=retryable)
 
-        tar_gz_file_obj = io.BytesIO(response.read())
-        with open(tar_gz_file_name, 'wb') as f_out:
-            f_out.write(tar_gz_file_obj.read())
-        return tar_gz_file_name
+    @classmethod
+    def probe_urls(cls, urls, **kwargs):
+        """Check if the URLs exist concurrently by HEAD requests.
+
+        Return the index of the URL found first in the order of the URLs.
+        A found URL is returned without waiting for the earlier URLs
+        in the order to respond, after the grace seconds.
+        The redirect is not followed, as a HEAD request is redirected
+        as a GET request by urllib. A redirected URL is found.
+        Raise RemoteFileNotFoundError if all the URLs are not found surely,
+        by such as HTTP 404 or the timeout.
+        Return None if no URL is found by other errors.
+        """
+        timeout = kwargs.get('timeout', 10)
+        grace = kwargs.get('grace', 1)
+
+        if sys.version_info >= (3, 0):
+            from queue import Empty, Queue
+        else:
+            from Queue import Empty, Queue
+
+        result_queue = Queue()
+
+        def probe(index, url):
+            result_queue.put((index, cls._probe_url(url, timeout)))
+
+        for index, url in enumerate(urls):
+            thread = threading.Thread(target=probe, args=(index, url))
+            # Do not wait for the slow URLs at the exit.
+            thread.daemon = True
+            thread.start()
+
+        results = {}
+        deadline = None
+        while len(results) < len(urls):
+            wait_seconds = None
+            if deadline is not None:
+                wait_seconds = max(0, deadline - time.time())
+            try:
+                index, found = result_queue.get(timeout=wait_seconds)
+            except Empty:
+                break
+            results[index] = found
+            if found and deadline is None:
+                deadline = time.time() + grace
+            for index in range(len(urls)):
+                if index not in results:
+                    break
+                if results[index]:
+                    return index
+
+        found_indexes = [index for index in results if results[index]]
+        if found_indexes:
+            return min(found_indexes)
+        if (len(results) == len(urls) and
+                all(found is False for found in results.values())):
+            raise RemoteFileNotFoundError(
+                'Probe failed: URLs not found: {0}'.format(', '.join(urls)))
+        return None
+
+    @classmethod
+    def _probe_url(cls, url, timeout):
+        """Return True if the URL is found, False if it is not found surely.
+
+        Return None if it is unknown.
+        """
+        if sys.version_info >= (3, 0):
+            from urllib.error import HTTPError, URLError
+            from urllib.request import (HTTPRedirectHandler, Request,
+                                        build_opener)
+        else:
+            from urllib2 import (HTTPError, HTTPRedirectHandler, Request,
+                                 URLError, build_opener)
+
+        class HeadRequest(Request):
+            def get_method(self):
+                return 'HEAD'
+
+        class NoRedirectHandler(HTTPRedirectHandler):
+            def redirect_request(self, *args, **kwargs):
+                return None
+
+        found = True
+        try:
+            opener = build_opener(NoRedirectHandler)
+            response = opener.open(HeadRequest(url), timeout=timeout)
+            response.close()
+        except HTTPError as exc:
+            # The redirect not followed raises the HTTPError.
+            if 300 <= exc.code < 400:
+                return True
+            found = False if exc.code in (404, 410) else None
+            Log.debug('Probe failed: URL: {0}, reason: {1}'.format(url, exc))
+        except (URLError, socket.timeout) as exc:
+            reason = getattr(exc, 'reason', exc)
+            is_not_found = (
+                isinstance(reason, socket.timeout) or
+                url.startswith('file:')
+            )
+            found = False if is_not_found else None
+            Log.debug('Probe failed: URL: {0}, reason: {1}'.format(url, exc))
+        except Exception as exc:
+            found = None
+            Log.debug('Probe failed: URL: {0}, reason: {1}'.format(url, exc))
+        return found
 
     @classmethod
-    def tar_extract(cls, tar_comp_file_path):
+    def copy_stream(cls, f_in, f_out, **kwargs):
+        """Copy the data from f_in to f_out by chunk.
+
+        Copy the data up to max_size bytes if it is set.
+        Return the copied data size.
+        """
+        hash_obj = kwargs.get('hash_obj')
+        chunk_size = kwargs.get('chunk_size', 64 * 1024)
+        max_size = kwargs.get('max_size')
+
+        size = 0
+        while True:
+            read_size = chunk_size
+            if max_size is not None:
+                read_size = min(chunk_size, max_size - size)
+                if read_size <= 0:
+                    break
+            chunk = f_in.read(read_size)
+            if not chunk:
+                break
+            if hash_obj is not None:
+                hash_obj.update(chunk)
+            f_out.write(chunk)
+            size += len(chunk)
+        return size
+
+    @classmethod
+    def tar_extract(cls, tar_comp_file_path, **kwargs):
         """Extract tar.gz or tar bz2 file.
 
         It behaves like
           - tar xzf tar_gz_file_path
           - tar xjf tar_bz2_file_path
         It raises tarfile.ReadError if the file is broken.
+        Set sub_dirs to extract only the files in the top directory and
+        the given sub directories of the top directory.
         """
+        sub_dirs = kwargs.get('sub_dirs')
         try:
             with contextlib.closing(tarfile.open(tar_comp_file_path)) as tar:
-                tar.extractall()
+                members = tar.getmembers()
+                if sub_dirs:
+                    extracted_members = [
+                        member for member in members
+                        if cls._is_tar_member_extracted(member, sub_dirs)
+                    ]
+                    Log.debug('Extract {0} of {1} members.'.format(
+                              len(extracted_members), len(members)))
+                    members = extracted_members
+                tar.extractall(members=members)
         except tarfile.ReadError as exc:
             message_format = (
                 'Extract failed: '
@@ -2105,6 +4724,73 @@ class Cmd(object):
             )
             raise InstallError(message_format.format(tar_comp_file_path, exc))
 
+    @classmethod
+    def tar_create(cls, tar_gz_file_path, paths):
+        """Create tar.gz file of the files and directories.
+
+        It behaves like "tar czf tar_gz_file_path paths".
+        The paths are stored with the base names.
+        """
+        with contextlib.closing(tarfile.open(tar_gz_file_path, 'w:gz')) as tar:
+            for path in paths:
+                tar.add(path, arcname=os.path.basename(path))
+
+    @classmethod
+    def _is_tar_member_extracted(cls, member, sub_dirs):
+        names = [n for n in member.name.split('/') if n and n != '.']
+        if len(names) <= 1:
+            # The top directory.
+            return True
+        if len(names) == 2 and not member.isdir():
+            # The files in the top directory such as config.h.
+            return True
+        return names[1] in sub_dirs
+
+    @classmethod
+    def curl_tar_extract(cls, file_url, **kwargs):
+        """Download file_url, and extract it while downloading.
+
+        It behaves like
+          - curl file_url | tar xz
+          - curl file_url | tar xj
+        The archive file is not saved, unless file_path is set.
+        Set hash_obj to calculate the checksum of the archive.
+        Set sub_dirs to extract only the files in the top directory and
+        the given sub directories of the top directory.
+        """
+        hash_obj = kwargs.get('hash_obj')
+        file_path = kwargs.get('file_path')
+        sub_dirs = kwargs.get('sub_dirs')
+
+        response = cls.urlopen(file_url)
+        f_out = None
+        try:
+            if file_path:
+                f_out = open(file_path, 'wb')
+            reader = TeeReader(response, f_out=f_out, hash_obj=hash_obj)
+            try:
+                with contextlib.closing(
+                        tarfile.open(fileobj=reader, mode='r|*')) as tar:
+                    for member in tar:
+                        if (not sub_dirs
+                           or cls._is_tar_member_extracted(member,
+                                                           sub_dirs)):
+                            tar.extract(member)
+            except tarfile.TarError as exc:
+                message_format = (
+                    'Extract failed: '
+                    'file_url: {0}, reason: {1}'
+                )
+                raise InstallError(message_format.format(file_url, exc))
+            # Read the rest of the archive such as the padding
+            # to save the entire file and calculate the checksum.
+            while reader.read(64 * 1024):
+                pass
+        finally:
+            if f_out:
+                f_out.close()
+            response.close()
+
     @classmethod
     def find(cls, searched_dir, pattern):
         """Find matched files.
@@ -2123,6 +4809,46 @@ class Cmd(object):
         matched_files.sort()
         return matched_files
 
+    @classmethod
+    def scan_files(cls, searched_dir, suffix):
+        """Return the relative paths of the files with the suffix.
+
+        It scans the directory recursively in one pass, and does not include
+        symbolic files like find method.
+        """
+        rel_paths = []
+        dirs = [(searched_dir, '')]
+        while dirs:
+            abs_dir, rel_dir = dirs.pop()
+            if hasattr(os, 'scandir'):
+                scandir_it = os.scandir(abs_dir)
+                try:
+                    entries = [
+                        (entry.name, entry.is_dir(follow_symlinks=False),
+                         entry.is_symlink())
+                        for entry in scandir_it
+                    ]
+                finally:
+                    # Close the directory now, not by the garbage collection.
+                    # The iterator has close from Python 3.6.
+                    if hasattr(scandir_it, 'close'):
+                        scandir_it.close()
+            else:
+                entries = [
+                    (name, os.path.isdir(os.path.join(abs_dir, name))
+                     and not os.path.islink(os.path.join(abs_dir, name)),
+                     os.path.islink(os.path.join(abs_dir, name)))
+                    for name in os.listdir(abs_dir)
+                ]
+            for name, is_dir, is_symlink in entries:
+                rel_path = os.path.join(rel_dir, name)
+                if is_dir:
+                    dirs.append((os.path.join(abs_dir, name), rel_path))
+                elif not is_symlink and name.endswith(suffix):
+                    rel_paths.append(rel_path)
+        rel_paths.sort()
+        return rel_paths
+
     @classmethod
     def mkdir_p(cls, path):
         """Make directory with recursively.
@@ -2132,9 +4858,41 @@ class Cmd(object):
         os.makedirs(path)
 
 
+class TeeReader(object):
+    """A file-like class to read data from a file object.
+
+    It writes the read data to another file object, and updates the hash
+    object too, like "tee" command.
+    """
+
+    def __init__(self, f_in, **kwargs):
+        """Initialize this class."""
+        self.f_in = f_in
+        self.f_out = kwargs.get('f_out')
+        self.hash_obj = kwargs.get('hash_obj')
+
+    def read(self, size=-1):
+        """Read the data up to size bytes."""
+        data = self.f_in.read(size)
+        if data:
+            if self.f_out is not None:
+                self.f_out.write(data)
+            if self.hash_obj is not None:
+                self.hash_obj.update(data)
+        return data
+
+
 class Utils(object):
     """A general utility class."""
 
+    # cgroup v2: "max 100000" or "<quota> <period>"
+    # cgroup v1: cpu.cfs_quota_us is -1 without the quota.
+    CGROUP_CPU_QUOTA_FILES = [
+        ('/sys/fs/cgroup/cpu.max', None),
+        ('/sys/fs/cgroup/cpu/cpu.cfs_quota_us',
+         '/sys/fs/cgroup/cpu/cpu.cfs_period_us'),
+    ]
+
     @staticmethod
     def version_str2tuple(version_str):
         """Convert a version string to a tuple.
@@ -2157,6 +4915,68 @@ class Utils(object):
 
         return tuple(version_info_list)
 
+    @staticmethod
+    def path_to_url(path):
+        """Convert a local path to a file URL.
+
+        Return the value as it is, if it is already a URL.
+        """
+        if re.match(r'^[a-z]+://', path):
+            return path
+        if sys.version_info >= (3, 0):
+            from urllib.request import pathname2url
+        else:
+            from urllib import pathname2url
+        return 'file://' + pathname2url(os.path.abspath(path))
+
+    @staticmethod
+    def cpu_count():
+        """Return the number of the CPUs available for the process.
+
+        Consider the CPU affinity and the cgroup CPU quota in a container.
+        """
+        if hasattr(os, 'sched_getaffinity'):
+            count = len(os.sched_getaffinity(0))
+        else:
+            import multiprocessing
+            count = multiprocessing.cpu_count()
+        quota = Utils._get_cgroup_cpu_quota()
+        if quota:
+            count = min(count, quota)
+        return max(count, 1)
+
+    @staticmethod
+    def _get_cgroup_cpu_quota():
+        """Return the CPU quota of the cgroup rounded up, or None."""
+        for quota_file, period_file in Utils.CGROUP_CPU_QUOTA_FILES:
+            try:
+                with open(quota_file) as f_in:
+                    values = f_in.read().split()
+                if period_file:
+                    with open(period_file) as f_in:
+                        values += f_in.read().split()
+            except (IOError, OSError):
+                continue
+            if len(values) < 2 or values[0] in ('max', '-1'):
+                return None
+            try:
+                quota, period = int(values[0]), int(values[1])
+            except ValueError:
+                return None
+            if quota <= 0 or period <= 0:
+                return None
+            return (quota + period - 1) // period
+        return None
+
+    @staticmethod
+    def sha256_file(file_path):
+        """Return the SHA-256 hex digest of the file."""
+        sha256 = hashlib.sha256()
+        with open(file_path, 'rb') as f_in:
+            for chunk in iter(lambda: f_in.read(1024 * 1024), b''):
+                sha256.update(chunk)
+        return sha256.hexdigest()
+
     @staticmethod
     def version_greater(version_1, version_2):
         """Compare whether version_1 is greater than version_2."""
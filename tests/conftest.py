@@ -5,9 +5,12 @@ import getpass
 import os
 import re
 import shutil
+import sqlite3
+import struct
 import subprocess
 import sys
 import tempfile
+import threading
 from contextlib import contextmanager
 
 import pytest
@@ -20,6 +23,7 @@ from install import (Application,
                      FedoraRpm,
                      Linux,
                      Python,
+                     RpmDb,
                      RpmPy,
                      RpmPyVersion,
                      SetupPy,
@@ -206,6 +210,80 @@ def file_url():
     return url
 
 
+@pytest.fixture(scope='session')
+def http_server_url():
+    """Return the URL of a local HTTP server serving tests/fixtures."""
+    if sys.version_info >= (3, 0):
+        from http.server import HTTPServer, SimpleHTTPRequestHandler
+    else:
+        from BaseHTTPServer import HTTPServer
+        from SimpleHTTPServer import SimpleHTTPRequestHandler
+
+    fixtures_dir = os.path.abspath('tests/fixtures')
+
+    class FixturesHandler(SimpleHTTPRequestHandler):
+        def translate_path(self, path):
+            path = path.split('?', 1)[0].split('#', 1)[0]
+            names = [n for n in path.split('/') if n and n != '..']
+            return os.path.join(fixtures_dir, *names)
+
+        def send_redirect(self):
+            # "/redirect/<path>" is redirected to "/<path>".
+            match = re.match(r'^/redirect(/.*)$', self.path)
+            if not match:
+                return False
+            self.send_response(302)
+            self.send_header('Location', match.group(1))
+            self.end_headers()
+            return True
+
+        def do_HEAD(self):  # NOQA: N802
+            if self.send_redirect():
+                return
+            return SimpleHTTPRequestHandler.do_HEAD(self)
+
+        def do_GET(self):  # NOQA: N802
+            if self.send_redirect():
+                return
+            # Support a simple HTTP Range request: "bytes=N-".
+            match = re.match(r'^bytes=(\d+)-$',
+                             self.headers.get('Range') or '')
+            file_path = self.translate_path(self.path)
+            if not match or not os.path.isfile(file_path):
+                return SimpleHTTPRequestHandler.do_GET(self)
+            # Send the entire file if the file is changed.
+            if_range = self.headers.get('If-Range')
+            last_modified = self.date_time_string(
+                int(os.path.getmtime(file_path)))
+            if if_range and if_range != last_modified:
+                return SimpleHTTPRequestHandler.do_GET(self)
+            with open(file_path, 'rb') as f_in:
+                content = f_in.read()
+            start = int(match.group(1))
+            if start >= len(content):
+                self.send_error(416)
+                return
+            self.send_response(206)
+            self.send_header('Content-Range', 'bytes {0}-{1}/{2}'.format(
+                             start, len(content) - 1, len(content)))
+            self.send_header('Content-Length', str(len(content) - start))
+            self.end_headers()
+            self.wfile.write(content[start:])
+
+        def log_message(self, *args):
+            pass
+
+    server = HTTPServer(('127.0.0.1', 0), FixturesHandler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    try:
+        yield 'http://127.0.0.1:{0}'.format(server.server_port)
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
 @pytest.fixture
 def archive_file_path_dicts():
     archive_dir = os.path.abspath('tests/fixtures/archive')
@@ -219,6 +297,9 @@ def archive_file_path_dicts():
             'valid': os.path.join(archive_dir, 'valid.tar.bz2'),
             'invalid': os.path.join(archive_dir, 'invalid.tar.bz2'),
         },
+        'rpm': {
+            'valid': os.path.join(archive_dir, 'rpm-1.0.tar.gz'),
+        },
     }
     return path_dicts
 
@@ -316,6 +397,61 @@ def pushd(target_dir):
         os.chdir(current_dir)
 
 
+@pytest.helpers.register
+def create_rpmdb(db_dir, packages):
+    """Create rpmdb.sqlite with the package dicts.
+
+    The dict has name, version, release, files and provides.
+    """
+    db_path = os.path.join(db_dir, RpmDb.FILE_NAME)
+    conn = sqlite3.connect(db_path)
+    conn.execute('CREATE TABLE Packages '
+                 '(hnum INTEGER PRIMARY KEY AUTOINCREMENT, blob BLOB)')
+    for table in ('Name', 'Basenames', 'Providename'):
+        conn.execute('CREATE TABLE {0} '
+                     '(key TEXT, hnum INTEGER, idx INTEGER)'.format(table))
+    for package in packages:
+        files = package.get('files', [])
+        dir_names = sorted(set(os.path.dirname(f) + '/' for f in files))
+        base_names = [os.path.basename(f) for f in files]
+        dir_indexes = [dir_names.index(os.path.dirname(f) + '/')
+                       for f in files]
+        blob = create_rpm_header([
+            (RpmDb.TAG_NAME, RpmDb.TYPE_STRING, [package['name']]),
+            (RpmDb.TAG_VERSION, RpmDb.TYPE_STRING, [package['version']]),
+            (RpmDb.TAG_RELEASE, RpmDb.TYPE_STRING, [package['release']]),
+            (RpmDb.TAG_DIRINDEXES, RpmDb.TYPE_INT32, dir_indexes),
+            (RpmDb.TAG_BASENAMES, RpmDb.TYPE_STRING_ARRAY, base_names),
+            (RpmDb.TAG_DIRNAMES, RpmDb.TYPE_STRING_ARRAY, dir_names),
+        ])
+        hnum = conn.execute('INSERT INTO Packages (blob) VALUES (?)',
+                            (blob,)).lastrowid
+        rows = [('Name', package['name'], 0)]
+        rows += [('Basenames', name, i) for i, name in enumerate(base_names)]
+        rows += [('Providename', name, i)
+                 for i, name in enumerate(package.get('provides', []))]
+        for (table, key, idx) in rows:
+            conn.execute('INSERT INTO {0} VALUES (?, ?, ?)'.format(table),
+                         (key, hnum, idx))
+    conn.commit()
+    conn.close()
+    return db_path
+
+
+def create_rpm_header(entries):
+    index = b''
+    data = b''
+    for (tag, tag_type, values) in entries:
+        if tag_type == RpmDb.TYPE_INT32:
+            data += b'\0' * (-len(data) % 4)
+            value_bytes = struct.pack('>{0}i'.format(len(values)), *values)
+        else:
+            value_bytes = b''.join(v.encode('utf-8') + b'\0' for v in values)
+        index += struct.pack('>iiii', tag, tag_type, len(data), len(values))
+        data += value_bytes
+    return struct.pack('>ii', len(entries), len(data)) + index + data
+
+
 @pytest.helpers.register
 def touch(file_path):
     f = None
@@ -394,6 +530,17 @@ def rpm_py(sys_rpm_path):
     return RpmPy(version_str, python, linux)
 
 
+@pytest.fixture
+def site_dir(tmpdir, monkeypatch):
+    site_dir = str(tmpdir.join('site-packages'))
+    os.mkdir(site_dir)
+    monkeypatch.setattr(Python, 'python_lib_arch_dir',
+                        property(lambda self: site_dir))
+    monkeypatch.setattr(Python, 'python_lib_non_arch_dir',
+                        property(lambda self: site_dir))
+    return site_dir
+
+
 @pytest.fixture
 def env():
     pass
@@ -2,28 +2,54 @@
 Tests for install.py
 
 """
+import email.utils
+import fcntl
+import glob
+import hashlib
+import io
+import json
 import os
 import re
+import shutil
+import socket
+import struct
 import subprocess
 import sys
 import tempfile
+import threading
+import time
+import zipfile
 from unittest import mock
 
 import pytest
 
-from install import (Cmd,
+from install import (Application,
+                     Cache,
+                     Cmd,
+                     CmdError,
+                     DownloadError,
                      Downloader,
+                     FedoraInstaller,
+                     FedoraLinux,
+                     FedoraRpm,
                      InstallError,
                      InstallSkipError,
+                     Installer,
                      Linux,
+                     LdSoCache,
+                     LibResolver,
                      Log,
+                     NativeRpm,
                      Python,
                      RemoteFileNotFoundError,
                      Rpm,
+                     RpmDb,
                      RpmPy,
                      RpmPyPackageNotFoundError,
                      RpmPyVersion,
                      SetupPy,
+                     SetupPyPatch,
+                     SystemFacts,
                      SuseRpm,
                      Utils)
 
@@ -71,6 +97,24 @@ def test_utils_version_str2tuple_is_ok(version_str, version_info):
     assert version_tuple == version_info
 
 
+@pytest.mark.parametrize('cpu_max,count', [
+    ('max 100000\n', None),
+    ('200000 100000\n', 2),
+    ('150000 100000\n', 2),
+])
+def test_utils_cpu_count_is_ok_with_cgroup_quota(tmpdir, cpu_max, count):
+    cpu_max_file = str(tmpdir.join('cpu.max'))
+    with open(cpu_max_file, 'w') as f_out:
+        f_out.write(cpu_max)
+    quota_files = [(cpu_max_file, None)]
+    with mock.patch.object(Utils, 'CGROUP_CPU_QUOTA_FILES', new=quota_files):
+        assert Utils._get_cgroup_cpu_quota() == count
+        cpu_count = Utils.cpu_count()
+    assert cpu_count >= 1
+    if count:
+        assert cpu_count <= count
+
+
 def test_cmd_sh_e_is_ok():
     stdout, stderr = Cmd.sh_e('pwd')
     assert not stdout
@@ -141,6 +185,33 @@ def test_cmd_curl_is_failed(file_url):
                     str(ei.value))
 
 
+def test_cmd_copy_stream_is_ok():
+    f_in = io.BytesIO(b'a' * 10)
+    f_out = io.BytesIO()
+    sha256 = hashlib.sha256()
+    size = Cmd.copy_stream(f_in, f_out, hash_obj=sha256, chunk_size=3)
+    assert size == 10
+    assert f_out.getvalue() == b'a' * 10
+    assert sha256.hexdigest() == hashlib.sha256(b'a' * 10).hexdigest()
+
+
+def test_cmd_curl_is_ok_with_hash_obj():
+    response = mock.MagicMock()
+    response.info.return_value = {}
+    response.read.side_effect = [b'abc', b'def', b'']
+    sha256 = hashlib.sha256()
+    with pytest.helpers.work_dir():
+        with mock.patch.object(Cmd, 'urlopen') as mock_urlopen:
+            mock_urlopen.return_value = response
+            file_name = Cmd.curl_remote_name(
+                'https://example.com/a.tar.gz', hash_obj=sha256)
+        assert file_name == 'a.tar.gz'
+        with open(file_name, 'rb') as f_in:
+            assert f_in.read() == b'abcdef'
+    assert response.close.called
+    assert sha256.hexdigest() == hashlib.sha256(b'abcdef').hexdigest()
+
+
 @pytest.mark.parametrize('file_type', ['tar.gz', 'tar.bz2'])
 def test_cmd_tar_archive_is_ok(archive_file_path_dicts, file_type):
     archive_file_path = archive_file_path_dicts[file_type]['valid']
@@ -166,6 +237,291 @@ def test_cmd_tar_archive_is_failed(archive_file_path_dicts, file_type):
     )
 
 
+@pytest.mark.parametrize('paths,found_index', [
+    (['/remote_file', '/archive/valid.tar.gz'], 0),
+    (['/remote_file.dummy', '/archive/valid.tar.gz'], 1),
+    # The redirect to the not found URL is not followed.
+    (['/remote_file.dummy', '/redirect/archive/not_existed.tar.gz'], 1),
+])
+def test_cmd_probe_urls_is_ok(http_server_url, paths, found_index):
+    urls = [http_server_url + path for path in paths]
+    assert Cmd.probe_urls(urls) == found_index
+
+
+def test_cmd_probe_urls_is_error_on_all_not_found(http_server_url):
+    urls = [
+        http_server_url + '/remote_file.dummy',
+        http_server_url + '/archive/valid.tar.gz.dummy',
+    ]
+    with pytest.raises(RemoteFileNotFoundError):
+        Cmd.probe_urls(urls)
+
+
+@pytest.mark.parametrize('results,found_index', [
+    ([False, None], None),
+    ([None, None], None),
+    ([False, False], RemoteFileNotFoundError),
+])
+def test_cmd_probe_urls_on_unknown_result(results, found_index):
+    with mock.patch.object(Cmd, '_probe_url') as mock_probe:
+        mock_probe.side_effect = lambda url, timeout: results[int(url)]
+        if found_index is RemoteFileNotFoundError:
+            with pytest.raises(RemoteFileNotFoundError):
+                Cmd.probe_urls(['0', '1'])
+        else:
+            assert Cmd.probe_urls(['0', '1']) == found_index
+
+
+def test_cmd_probe_urls_does_not_wait_for_slow_url():
+    def mock_probe_url(url, timeout):
+        if url == 'slow':
+            time.sleep(5)
+        return True
+
+    with mock.patch.object(Cmd, '_probe_url') as mock_probe:
+        mock_probe.side_effect = mock_probe_url
+        start_time = time.time()
+        assert Cmd.probe_urls(['slow', 'fast'], grace=0.1) == 1
+        assert time.time() - start_time < 5
+
+
+@pytest.mark.parametrize('is_streamed', [False, True])
+def test_cmd_tar_extract_is_ok_with_sub_dirs(
+    http_server_url, archive_file_path_dicts, is_streamed
+):
+    archive_file_path = archive_file_path_dicts['rpm']['valid']
+    sub_dirs = ['python', 'lib']
+    with pytest.helpers.work_dir():
+        if is_streamed:
+            file_url = '{0}/archive/{1}'.format(
+                http_server_url, os.path.basename(archive_file_path))
+            Cmd.curl_tar_extract(file_url, sub_dirs=sub_dirs)
+        else:
+            Cmd.tar_extract(archive_file_path, sub_dirs=sub_dirs)
+        assert sorted(os.listdir('rpm-1.0')) == ['config.h', 'lib', 'python']
+        assert os.path.isfile('rpm-1.0/python/a.c')
+        assert os.path.isfile('rpm-1.0/lib/sub/b.h')
+
+
+def test_cmd_curl_is_ok_on_local_server(http_server_url):
+    with pytest.helpers.work_dir():
+        file_name = Cmd.curl_remote_name(http_server_url + '/remote_file')
+        assert file_name == 'remote_file'
+        assert os.path.isfile(file_name)
+
+
+def test_cmd_curl_is_failed_on_local_server(http_server_url):
+    with pytest.helpers.work_dir():
+        with pytest.raises(RemoteFileNotFoundError):
+            Cmd.curl_remote_name(http_server_url + '/remote_file.dummy')
+
+
+@pytest.mark.parametrize('part_size', [1, 10])
+@pytest.mark.parametrize('is_changed', [False, True])
+def test_cmd_curl_is_ok_on_resumed_part_file(
+    http_server_url, archive_file_path_dicts, part_size, is_changed
+):
+    archive_file_path = archive_file_path_dicts['tar.gz']['valid']
+    file_url = http_server_url + '/archive/valid.tar.gz'
+    with open(archive_file_path, 'rb') as f_in:
+        content = f_in.read()
+    mtime = int(os.path.getmtime(archive_file_path))
+    if is_changed:
+        mtime -= 60
+    sha256 = hashlib.sha256()
+    with pytest.helpers.work_dir():
+        with open('valid.tar.gz.part', 'wb') as f_out:
+            f_out.write(content[:part_size])
+        with open('valid.tar.gz.part.validator', 'w') as f_out:
+            f_out.write(email.utils.formatdate(mtime, usegmt=True))
+        with mock.patch.object(Log, 'info') as mock_info:
+            file_name = Cmd.curl_remote_name(
+                file_url, hash_obj=sha256, part_file_path='valid.tar.gz.part')
+        is_resumed = ('Resume downloading from {0} bytes.'.format(part_size)
+                      in [c[0][0] for c in mock_info.call_args_list])
+        assert is_resumed is not is_changed
+        assert not os.path.exists('valid.tar.gz.part')
+        assert not os.path.exists('valid.tar.gz.part.validator')
+        assert os.path.exists('valid.tar.gz.part.lock')
+        with open(file_name, 'rb') as f_in:
+            assert f_in.read() == content
+    assert sha256.hexdigest() == hashlib.sha256(content).hexdigest()
+
+
+@pytest.mark.parametrize('status_code', [206, 200])
+def test_cmd_curl_is_ok_on_retry_after_interrupted(status_code):
+    response_1 = mock.MagicMock()
+    response_1.getcode.return_value = 200
+    response_1.info.return_value = {'ETag': '"abc"'}
+    response_1.read.side_effect = [b'abc', IOError('Connection reset.')]
+    response_2 = mock.MagicMock()
+    response_2.getcode.return_value = status_code
+    response_2.info.return_value = {'ETag': '"abc"'}
+    data_2 = b'def' if status_code == 206 else b'abcdef'
+    response_2.read.side_effect = io.BytesIO(data_2).read
+    sha256 = hashlib.sha256()
+    with pytest.helpers.work_dir():
+        with mock.patch.object(Cmd, 'urlopen') as mock_urlopen:
+            mock_urlopen.side_effect = [response_1, response_2]
+            file_name = Cmd.curl_remote_name(
+                'https://example.com/a.tar.gz', hash_obj=sha256, backoff=0)
+        assert mock_urlopen.call_args_list[1][1]['headers'] == {
+            'Range': 'bytes=3-',
+            'If-Range': '"abc"',
+        }
+        with open(file_name, 'rb') as f_in:
+            assert f_in.read() == b'abcdef'
+    assert sha256.hexdigest() == hashlib.sha256(b'abcdef').hexdigest()
+
+
+def test_cmd_curl_is_failed_after_retries():
+    response = mock.MagicMock()
+    response.getcode.return_value = 200
+    response.info.return_value = {}
+    response.read.side_effect = IOError('Connection reset.')
+    with pytest.helpers.work_dir():
+        with mock.patch.object(Cmd, 'urlopen') as mock_urlopen:
+            mock_urlopen.return_value = response
+            with pytest.raises(InstallError) as ei:
+                Cmd.curl_remote_name('https://example.com/a.tar.gz',
+                                     retries=2, backoff=0)
+        assert mock_urlopen.call_count == 3
+    assert 'Connection reset.' in str(ei.value)
+
+
+@pytest.mark.parametrize('retryable', [True, False])
+def test_cmd_curl_raises_download_error_as_it_is(retryable):
+    message = 'Download failed: URL: https://example.com/a.tar.gz, ' \
+        'reason: <urlopen error [Errno 111] Connection refused>'
+    with pytest.helpers.work_dir():
+        with mock.patch.object(Cmd, 'urlopen') as mock_urlopen:
+            mock_urlopen.side_effect = DownloadError(message,
+                                                     retryable=retryable)
+            with pytest.raises(DownloadError) as ei:
+                Cmd.curl_remote_name('https://example.com/a.tar.gz',
+                                     retries=2, backoff=0)
+        assert mock_urlopen.call_count == (3 if retryable else 1)
+    assert str(ei.value) == message
+
+
+def test_cmd_curl_is_ok_on_range_not_satisfiable():
+    response = mock.MagicMock()
+    response.getcode.return_value = 200
+    response.info.return_value = {}
+    response.read.side_effect = [b'abc', b'']
+    with pytest.helpers.work_dir():
+        with open('a.tar.gz.part', 'wb') as f_out:
+            f_out.write(b'abcdef')
+        with open('a.tar.gz.part.validator', 'w') as f_out:
+            f_out.write('"abc"')
+        with mock.patch.object(Cmd, 'urlopen') as mock_urlopen:
+            mock_urlopen.side_effect = [
+                DownloadError('Download failed', status_code=416),
+                response,
+            ]
+            file_name = Cmd.curl_remote_name('https://example.com/a.tar.gz',
+                                             backoff=0)
+        assert mock_urlopen.call_args_list[1][1]['headers'] == {}
+        with open(file_name, 'rb') as f_in:
+            assert f_in.read() == b'abc'
+
+
+def test_cmd_urlopen_is_error_on_refused_connection():
+    # Get a port no one listens on.
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    with pytest.raises(DownloadError) as ei:
+        Cmd.urlopen('http://127.0.0.1:{0}/a.tar.gz'.format(port))
+    assert ei.value.retryable is False
+    assert ei.value.status_code is None
+
+
+@pytest.mark.parametrize('file_type', ['tar.gz', 'tar.bz2'])
+@pytest.mark.parametrize('is_file_saved', [False, True])
+def test_cmd_curl_tar_extract_is_ok(
+    http_server_url, archive_file_path_dicts, file_type, is_file_saved
+):
+    archive_file_path = archive_file_path_dicts[file_type]['valid']
+    file_name = os.path.basename(archive_file_path)
+    file_url = '{0}/archive/{1}'.format(http_server_url, file_name)
+    file_path = file_name if is_file_saved else None
+    sha256 = hashlib.sha256()
+    with pytest.helpers.work_dir():
+        Cmd.curl_tar_extract(file_url, hash_obj=sha256, file_path=file_path)
+        assert os.path.isfile('a/a.txt')
+        assert os.path.isfile(file_name) is is_file_saved
+        if is_file_saved:
+            assert Utils.sha256_file(file_name) == \
+                Utils.sha256_file(archive_file_path)
+    assert sha256.hexdigest() == Utils.sha256_file(archive_file_path)
+
+
+@pytest.mark.parametrize('file_type', ['tar.gz', 'tar.bz2'])
+def test_cmd_curl_tar_extract_is_failed(http_server_url, file_type):
+    file_url = '{0}/archive/invalid.{1}'.format(http_server_url, file_type)
+    with pytest.helpers.work_dir():
+        with pytest.raises(InstallError) as ei:
+            Cmd.curl_tar_extract(file_url)
+    assert str(ei.value).startswith('Extract failed: ')
+
+
+@pytest.mark.parametrize('is_cached', [False, True])
+def test_downloader_download_and_expand_from_archive_url_on_stream(
+    http_server_url, is_cached
+):
+    archive_dict = {
+        'site': 'github',
+        'url': http_server_url + '/archive/valid.tar.gz',
+        'top_dir_name': 'a',
+    }
+    with pytest.helpers.work_dir():
+        cache = Cache('cache') if is_cached else None
+        downloader = Downloader(RpmPyVersion('4.14.0-rc1'), cache=cache,
+                                stream_extracted=True)
+        downloader._get_candidate_archive_dicts = mock.Mock(
+            return_value=[archive_dict]
+        )
+        top_dir_name = downloader._download_and_expand_from_archive_url()
+        assert top_dir_name == 'a'
+        assert os.path.isfile('a/a.txt')
+        if is_cached:
+            assert cache.get_archive(archive_dict['url'])
+
+
+def test_cmd_scan_files_is_ok():
+    with pytest.helpers.work_dir():
+        os.makedirs('a/b')
+        pytest.helpers.touch('a/x.h')
+        pytest.helpers.touch('a/b/y.h')
+        pytest.helpers.touch('a/b/z.c')
+        os.symlink('x.h', 'a/w.h')
+        assert Cmd.scan_files('a', '.h') == ['b/y.h', 'x.h']
+
+
+@pytest.mark.skipif(sys.version_info < (3, 6),
+                    reason="The scandir iterator has close from Python 3.6.")
+def test_cmd_scan_files_closes_scandir():
+    scandir_its = []
+    orig_scandir = os.scandir
+
+    def scandir(path):
+        scandir_it = mock.MagicMock(wraps=orig_scandir(path))
+        scandir_it.__iter__.side_effect = lambda: iter(scandir_it._mock_wraps)
+        scandir_its.append(scandir_it)
+        return scandir_it
+
+    with pytest.helpers.work_dir():
+        os.makedirs('a/b')
+        pytest.helpers.touch('a/b/y.h')
+        with mock.patch.object(os, 'scandir', side_effect=scandir):
+            assert Cmd.scan_files('a', '.h') == ['b/y.h']
+    assert len(scandir_its) == 2
+    for scandir_it in scandir_its:
+        assert scandir_it.close.called
+
+
 def test_cmd_find_is_ok():
     with pytest.helpers.work_dir():
         os.makedirs('dir1/dir2')
@@ -319,6 +675,34 @@ def test_rpm_is_package_installed_returns_false(sys_rpm):
         assert not sys_rpm.is_package_installed('dummy')
 
 
+def test_rpm_query_packages_queries_packages_by_one_command():
+    rpm = NativeRpm('/usr/bin/rpm', check=False)
+    rpm.db = None
+    error = CmdError('test.')
+    error.stdout = (
+        'rpm-libs 4.14.2-1.fc29\n'
+        'package rpm-devel is not installed\n'
+        'popt 1.16-15.fc29\n'
+    )
+    with mock.patch.object(Cmd, 'sh_e') as mock_sh_e:
+        mock_sh_e.side_effect = error
+        assert rpm.is_package_installed('rpm-libs')
+        assert not rpm.is_package_installed('rpm-devel')
+        with pytest.raises(InstallError) as ei:
+            rpm.verify_packages_installed(['rpm-libs', 'popt-devel'])
+        assert rpm.query_packages(['popt', 'dummy']) == {
+            'popt': '1.16-15.fc29',
+            'dummy': None,
+        }
+    assert 'Required RPM not installed: [popt-devel].' in str(ei.value)
+    # The known packages are queried at first, and the rest later.
+    assert mock_sh_e.call_count == 2
+    cmd = mock_sh_e.call_args_list[0][0][0]
+    assert cmd.startswith('/usr/bin/rpm --query --queryformat ')
+    for package_name in NativeRpm.QUERIED_PACKAGE_NAMES:
+        assert package_name in cmd.split()
+
+
 def test_rpm_lib_dir_is_ok(sys_rpm, is_debian, arch):
     if is_debian:
         lib_dir = '/usr/lib/{0}-linux-gnu'.format(arch)
@@ -328,6 +712,272 @@ def test_rpm_lib_dir_is_ok(sys_rpm, is_debian, arch):
         assert re.match(r'^/usr/lib(64)?$', sys_rpm.lib_dir)
 
 
+@pytest.fixture
+def rpmdb_dir(tmpdir):
+    db_dir = str(tmpdir)
+    pytest.helpers.create_rpmdb(db_dir, [
+        {
+            'name': 'rpm-libs',
+            'version': '4.16.1.3',
+            'release': '1.fc34',
+            'files': ['/usr/lib64/librpm.so.9', '/usr/lib64/librpmio.so.9'],
+            'provides': ['librpm.so.9()(64bit)', 'rpm-libs'],
+        },
+        {
+            'name': 'popt',
+            'version': '1.18',
+            'release': '4.fc34',
+            'files': ['/usr/lib64/libpopt.so.0'],
+            'provides': ['popt'],
+        },
+    ])
+    return db_dir
+
+
+def test_rpm_db_is_ok(rpmdb_dir):
+    rpm_db = RpmDb.find(rpmdb_dir)
+    assert rpm_db.query_packages(['rpm-libs', 'rpm-devel']) == {
+        'rpm-libs': '4.16.1.3-1.fc34',
+        'rpm-devel': None,
+    }
+    assert rpm_db.is_provided('librpm.so.9()(64bit)')
+    assert not rpm_db.is_provided('libpopt.so.0()(64bit)')
+    assert rpm_db.get_file_owners('/usr/lib64/librpmio.so.9') == ['rpm-libs']
+    assert rpm_db.get_file_owners('/usr/lib/librpmio.so.9') == []
+    rpm_db.close()
+
+
+def test_rpm_db_get_file_owners_is_ok_on_symlink_dir(tmpdir):
+    usr_lib_dir = str(tmpdir.join('usr', 'lib64'))
+    os.makedirs(usr_lib_dir)
+    os.symlink(usr_lib_dir, str(tmpdir.join('lib64')))
+    db_dir = str(tmpdir.join('rpmdb'))
+    os.mkdir(db_dir)
+    pytest.helpers.create_rpmdb(db_dir, [
+        {
+            'name': 'rpm-libs',
+            'version': '4.16.1.3',
+            'release': '1.fc34',
+            'files': [os.path.join(usr_lib_dir, 'librpm.so.9')],
+            'provides': ['rpm-libs'],
+        },
+    ])
+    rpm_db = RpmDb.find(db_dir)
+    lib_path = str(tmpdir.join('lib64', 'librpm.so.9'))
+    assert rpm_db.get_file_owners(lib_path) == ['rpm-libs']
+    rpm_db.close()
+
+    cache_path = str(tmpdir.join('ld.so.cache'))
+    create_ld_so_cache(cache_path, [
+        ('librpm.so.9', lib_path, 0x0303),
+    ])
+    facts = SystemFacts('/usr/bin/rpm')
+    facts._facts = {'arch': 'x86_64', 'rpm_dbpath': db_dir}
+    rpm = NativeRpm('/usr/bin/rpm', check=False, facts=facts)
+    rpm.rpm_lib_pkg_name = 'rpm-libs'
+    with mock.patch.object(LdSoCache, 'FILE_PATH', cache_path):
+        assert rpm.lib_dir == os.path.realpath(usr_lib_dir)
+
+
+def test_rpm_db_find_returns_none_without_sqlite_db(tmpdir):
+    assert RpmDb.find(str(tmpdir)) is None
+    assert RpmDb.find(None) is None
+
+
+def test_rpm_uses_rpm_db_without_rpm_command(rpmdb_dir):
+    facts = SystemFacts('/usr/bin/rpm')
+    facts._facts = {'arch': 'x86_64', 'rpm_dbpath': rpmdb_dir}
+    rpm = NativeRpm('/usr/bin/rpm', check=False, facts=facts)
+    with mock.patch.object(Cmd, 'sh_e') as mock_sh_e, \
+            mock.patch.object(Cmd, 'sh_e_out') as mock_sh_e_out:
+        assert rpm.is_package_installed('rpm-libs')
+        assert not rpm.is_package_installed('rpm-devel')
+        rpm.verify_packages_installed(['rpm-libs', 'popt'])
+        assert rpm.is_package_provided('popt')
+        assert rpm.get_file_owners('/usr/lib64/libpopt.so.0') == ['popt']
+    assert not mock_sh_e.called
+    assert not mock_sh_e_out.called
+
+
+def test_rpm_falls_back_to_rpm_command_on_invalid_rpm_db(tmpdir):
+    with open(str(tmpdir.join(RpmDb.FILE_NAME)), 'w') as f_out:
+        f_out.write('not a sqlite database')
+    facts = SystemFacts('/usr/bin/rpm')
+    facts._facts = {'arch': 'x86_64', 'rpm_dbpath': str(tmpdir)}
+    rpm = NativeRpm('/usr/bin/rpm', check=False, facts=facts)
+    with mock.patch.object(Cmd, 'sh_e') as mock_sh_e:
+        mock_sh_e.return_value = ('rpm-libs 4.16.1.3-1.fc34\n', '')
+        assert rpm.is_package_installed('rpm-libs')
+    assert mock_sh_e.called
+    assert rpm.db is None
+
+
+def test_system_facts_collects_facts_by_one_command():
+    facts = SystemFacts('/usr/bin/rpm')
+    facts_out = (
+        'arch=x86_64\n'
+        'rpm_version=RPM version 4.14.2\n'
+        'rpm_dbpath=\n'
+    )
+    with mock.patch.object(Cmd, 'sh_e_out') as mock_sh_e_out:
+        mock_sh_e_out.return_value = facts_out
+        rpm = FedoraRpm('/usr/bin/rpm', check=False, facts=facts)
+        # Not collected rpm_arch fact is got by the command.
+        assert mock_sh_e_out.call_count == 2
+        # The shell and the 3 commands in it are started.
+        assert facts.saved_subprocesses == 1 - 4
+        for _ in range(3):
+            assert rpm.version == '4.14.2'
+        assert rpm.version_info == (4, 14, 2)
+        assert mock_sh_e_out.call_count == 2
+    assert facts.get('rpm_dbpath') is None
+    # The facts not replacing the command are not counted.
+    assert facts.saved_subprocesses == 5 - 4
+
+
+@pytest.mark.parametrize('optional_facts,cmds', [
+    ([], []),
+    (['rpm_arch'], ['rpm -q rpm --qf "%{arch}"']),
+    (['rpm_ndb'], ['rpm -q rpm-ndb > /dev/null']),
+])
+def test_system_facts_collects_optional_facts(optional_facts, cmds):
+    facts = SystemFacts('/usr/bin/rpm', optional_facts=optional_facts)
+    script = facts._get_script()
+    assert '"/usr/bin/rpm" --version' in script
+    for cmd in ['rpm -q rpm --qf', 'rpm -q rpm-ndb']:
+        assert (cmd in script) is any(c.startswith(cmd) for c in cmds)
+    for cmd in cmds:
+        assert cmd in script
+
+
+def create_ld_so_cache(file_path, libs, is_old_format_included=False):
+    header_size = struct.calcsize(LdSoCache.NEW_HEADER_FORMAT)
+    entry_size = struct.calcsize(LdSoCache.NEW_ENTRY_FORMAT)
+    strings = b''
+    entries = b''
+    for (soname, path, flags) in libs:
+        key = header_size + entry_size * len(libs) + len(strings)
+        strings += soname.encode('utf-8') + b'\0'
+        value = header_size + entry_size * len(libs) + len(strings)
+        strings += path.encode('utf-8') + b'\0'
+        entries += struct.pack(LdSoCache.NEW_ENTRY_FORMAT, flags, key, value,
+                               0, 0)
+    data = struct.pack(LdSoCache.NEW_HEADER_FORMAT, LdSoCache.NEW_MAGIC,
+                       len(libs), len(strings), 0, 0) + entries + strings
+    if is_old_format_included:
+        # One old format entry and the padding for the 8 bytes alignment.
+        old_data = (LdSoCache.OLD_MAGIC + b'\0' + struct.pack('=I', 1) +
+                    struct.pack('=iII', 0, 0, 0) + b'\0' * 4)
+        data = old_data + data
+    with open(file_path, 'wb') as f_out:
+        f_out.write(data)
+
+
+@pytest.mark.parametrize('is_old_format_included', [False, True])
+def test_ld_so_cache_find_is_ok(tmpdir, is_old_format_included):
+    cache_path = str(tmpdir.join('ld.so.cache'))
+    create_ld_so_cache(cache_path, [
+        ('libz.so.1', '/usr/lib64/libz.so.1', 0x0303),
+        ('librpm.so.9', '/usr/lib/librpm.so.9', 0x0003),
+        ('librpm.so.9', '/usr/lib64/librpm.so.9', 0x0303),
+    ], is_old_format_included=is_old_format_included)
+    ld_so_cache = LdSoCache(cache_path)
+    assert len(ld_so_cache.get_entries()) == 3
+    lib_paths = ld_so_cache.find('librpm.so')
+    if sys.maxsize > 2 ** 32:
+        assert lib_paths == ['/usr/lib64/librpm.so.9', '/usr/lib/librpm.so.9']
+    else:
+        assert lib_paths == ['/usr/lib/librpm.so.9', '/usr/lib64/librpm.so.9']
+
+
+def test_ld_so_cache_get_entries_returns_empty_on_unsupported_file(tmpdir):
+    cache_path = str(tmpdir.join('ld.so.cache'))
+    with open(cache_path, 'wb') as f_out:
+        f_out.write(LdSoCache.OLD_MAGIC + b'\0' + struct.pack('=I', 0))
+    assert LdSoCache(cache_path).get_entries() == []
+    assert LdSoCache(str(tmpdir.join('not_existed'))).get_entries() == []
+
+
+def test_lib_resolver_find_is_ok_by_listing_dirs(tmpdir):
+    lib_dir = str(tmpdir.join('lib'))
+    multiarch_dir = os.path.join(lib_dir, 'x86_64-linux-gnu')
+    os.makedirs(os.path.join(lib_dir, 'python3.9', 'site-packages'))
+    os.makedirs(multiarch_dir)
+    for file_name in ('libpopt.so.0.0.0', 'libpopt.so.0.0.1',
+                      'libpoptx.so.1'):
+        pytest.helpers.touch(os.path.join(multiarch_dir, file_name))
+    os.symlink('libpopt.so.0.0.1', os.path.join(multiarch_dir, 'libpopt.so.0'))
+    pytest.helpers.touch(os.path.join(lib_dir, 'python3.9', 'site-packages',
+                                      'libpopt.so.9'))
+    resolver = LibResolver(LdSoCache(str(tmpdir.join('not_existed'))))
+    with mock.patch.object(os, 'walk') as mock_walk:
+        assert resolver.find(lib_dir, 'libpopt.so') == os.path.join(
+            os.path.realpath(multiarch_dir), 'libpopt.so.0.0.1')
+        assert resolver.find(lib_dir, 'librpm.so') is None
+        assert resolver.find(str(tmpdir.join('not_existed')),
+                             'libpopt.so') is None
+    assert not mock_walk.called
+
+
+def test_lib_resolver_find_is_ok_by_ld_so_cache(tmpdir):
+    lib_dir = str(tmpdir.join('lib64'))
+    os.mkdir(lib_dir)
+    pytest.helpers.touch(os.path.join(lib_dir, 'librpm.so.9.1.0'))
+    os.symlink('librpm.so.9.1.0', os.path.join(lib_dir, 'librpm.so.9'))
+    cache_path = str(tmpdir.join('ld.so.cache'))
+    create_ld_so_cache(cache_path, [
+        ('librpm.so.9', os.path.join(lib_dir, 'librpm.so.9'), 0x0303),
+        ('librpm.so.8', '/other/lib64/librpm.so.8', 0x0303),
+    ])
+    resolver = LibResolver(LdSoCache(cache_path))
+    with mock.patch.object(os, 'listdir') as mock_listdir:
+        assert resolver.find(lib_dir, 'librpm.so') == os.path.join(
+            os.path.realpath(lib_dir), 'librpm.so.9.1.0')
+    assert not mock_listdir.called
+
+
+def test_native_rpm_lib_dir_is_ok_by_ld_so_cache(tmpdir, monkeypatch):
+    cache_path = str(tmpdir.join('ld.so.cache'))
+    create_ld_so_cache(cache_path, [
+        ('librpm.so.9', '/opt/lib/librpm.so.9', 0x0303),
+        ('librpm.so.9', '/usr/lib64/librpm.so.9', 0x0303),
+    ])
+    monkeypatch.setattr(LdSoCache, 'FILE_PATH', cache_path)
+    facts = SystemFacts('/usr/bin/rpm')
+    facts._facts = {'arch': 'x86_64'}
+    rpm = NativeRpm('/usr/bin/rpm', check=False, facts=facts)
+    rpm.rpm_lib_pkg_name = 'rpm-libs'
+    owners = {'/usr/lib64/librpm.so.9': ['rpm-libs']}
+    with mock.patch.object(NativeRpm, 'get_file_owners') as mock_owners, \
+            mock.patch.object(Cmd, 'sh_e_out') as mock_sh_e_out:
+        mock_owners.side_effect = lambda path: owners.get(path, [])
+        assert rpm.lib_dir == '/usr/lib64'
+    assert not mock_sh_e_out.called
+    # The found lib dir is cached in the facts.
+    assert facts.get('rpm_lib_dir') == '/usr/lib64'
+
+
+@pytest.mark.parametrize('is_error', [False, True])
+def test_native_rpm_lib_dir_is_ok_by_package(tmpdir, monkeypatch, is_error):
+    monkeypatch.setattr(LdSoCache, 'FILE_PATH',
+                        str(tmpdir.join('not_existed')))
+    facts = SystemFacts('/usr/bin/rpm')
+    facts._facts = {'arch': 'x86_64'}
+    rpm = NativeRpm('/usr/bin/rpm', check=False, facts=facts)
+    rpm.rpm_lib_pkg_name = 'rpm-libs'
+    with mock.patch.object(Cmd, 'sh_e_out') as mock_sh_e_out:
+        if is_error:
+            mock_sh_e_out.side_effect = CmdError('package rpm-libs is '
+                                                 'not installed')
+            with pytest.raises(CmdError):
+                rpm.lib_dir
+        else:
+            mock_sh_e_out.return_value = \
+                '/usr/lib/.build-id\n/usr/lib64/librpm.so.9\n'
+            assert rpm.lib_dir == '/usr/lib64'
+    assert mock_sh_e_out.call_args[0][0] == '/usr/bin/rpm -ql rpm-libs'
+
+
 @pytest.mark.parametrize('version,info,is_release,git_branch', [
     (
         '4.13.0',
@@ -541,6 +1191,102 @@ def test_downloader_download_and_expand_from_archive_url(
                 downloader._download_and_expand_from_archive_url()
 
 
+@pytest.mark.parametrize('is_http', [False, True])
+def test_downloader_download_and_expand_from_archive_url_on_mirror(
+    http_server_url, archive_file_path_dicts, is_http
+):
+    archive_dir = os.path.dirname(archive_file_path_dicts['rpm']['valid'])
+    mirror = http_server_url + '/archive' if is_http else archive_dir
+    downloader = Downloader(RpmPyVersion('1.0'), mirrors=[mirror])
+
+    archive_dicts = downloader._get_candidate_archive_dicts()
+    assert archive_dicts[0]['site'] == 'mirror'
+    assert archive_dicts[0]['url'].endswith('/rpm-1.0.tar.gz')
+    assert archive_dicts[0]['top_dir_name'] == 'rpm-1.0'
+    assert len(archive_dicts) == 4
+
+    with pytest.helpers.work_dir():
+        with mock.patch.object(Cmd, 'probe_urls') as mock_probe_urls:
+            mock_probe_urls.return_value = 0
+            top_dir_name = downloader._download_and_expand_from_archive_url()
+        assert top_dir_name == 'rpm-1.0'
+        assert os.path.isfile('rpm-1.0/python/a.c')
+
+
+def test_downloader_download_archive_is_error_on_probed_not_found(
+    downloader
+):
+    archive_dicts = [
+        RPM_ORG_INVALID_ARCHIVE_URL_DICT,
+        GIT_HUB_INVALID_ARCHIVE_URL_DICT,
+    ]
+    with mock.patch.object(Cmd, 'probe_urls') as mock_probe_urls, \
+            mock.patch.object(Cmd, 'curl_remote_name') as mock_curl:
+        mock_probe_urls.side_effect = RemoteFileNotFoundError('test.')
+        with pytest.raises(RemoteFileNotFoundError):
+            downloader._download_archive(archive_dicts)
+    # The candidates are not downloaded one by one.
+    assert not mock_curl.called
+
+
+def test_downloader_get_candidate_archive_dicts_skips_invalid_mirror():
+    downloader = Downloader(RpmPyVersion('1.0'),
+                            mirrors=['/dummy/not/existing/mirror'])
+    archive_dicts = downloader._get_candidate_archive_dicts()
+    assert [d['site'] for d in archive_dicts] == ['github', 'github',
+                                                  'rpm.org']
+
+
+def test_downloader_download_archive_is_ok_on_probed_url(downloader):
+    archive_dicts = [
+        RPM_ORG_INVALID_ARCHIVE_URL_DICT,
+        GIT_HUB_VALID_ARCHIVE_URL_DICT,
+    ]
+    with mock.patch.object(Cmd, 'probe_urls') as mock_probe_urls:
+        mock_probe_urls.return_value = 1
+        with mock.patch.object(Cmd, 'curl_remote_name') as mock_curl:
+            mock_curl.return_value = 'rpm-4.13.0.2-release.tar.gz'
+            archive_dict = downloader._download_archive(archive_dicts)
+    assert archive_dict['url'] == GIT_HUB_VALID_ARCHIVE_URL_DICT['url']
+    assert mock_curl.call_count == 1
+    assert mock_curl.call_args[0][0] == GIT_HUB_VALID_ARCHIVE_URL_DICT['url']
+
+
+def test_downloader_download_and_expand_from_archive_url_with_cache(
+    archive_file_path_dicts
+):
+    archive_file_path = archive_file_path_dicts['tar.gz']['valid']
+    archive_dict = {
+        'site': 'github',
+        'url': 'https://example.com/archive/a.tar.gz',
+        'top_dir_name': 'a',
+    }
+
+    def mock_curl_remote_name(file_url, **kwargs):
+        with open(archive_file_path, 'rb') as f_in:
+            with open('a.tar.gz', 'wb') as f_out:
+                Cmd.copy_stream(f_in, f_out, hash_obj=kwargs['hash_obj'])
+        return 'a.tar.gz'
+
+    with pytest.helpers.work_dir():
+        cache = Cache('cache')
+        downloader = Downloader(RpmPyVersion('4.14.0-rc1'), cache=cache)
+        downloader._get_candidate_archive_dicts = mock.Mock(
+            return_value=[archive_dict]
+        )
+        with mock.patch.object(Cmd, 'curl_remote_name') as mock_curl:
+            mock_curl.side_effect = mock_curl_remote_name
+            for work_dir in ['work1', 'work2']:
+                os.mkdir(work_dir)
+                with pytest.helpers.pushd(work_dir):
+                    top_dir_name = \
+                        downloader._download_and_expand_from_archive_url()
+                    assert top_dir_name == 'a'
+                    assert os.path.isfile('a/a.txt')
+            assert mock_curl.call_count == 1
+        assert cache.get_archive(archive_dict['url'])
+
+
 @pytest.mark.parametrize('version,archive_dicts', [
     (
         '4.13.0',
@@ -590,6 +1336,87 @@ def test_downloader_get_candidate_archive_dicts_is_ok(version, archive_dicts):
     assert candidate_archive_dicts == archive_dicts
 
 
+@pytest.mark.parametrize('ls_remote_out,tag_names', [
+    (
+        'aaa\trefs/tags/rpm-4.13.0-release\n'
+        'bbb\trefs/tags/rpm-4.13.0-release^{}\n',
+        ['rpm-4.13.0-release'],
+    ),
+    ('', []),
+])
+def test_downloader_resolve_git_tag_names_is_ok(tmpdir, ls_remote_out,
+                                                tag_names):
+    cache = Cache(str(tmpdir))
+    downloader = Downloader(RpmPyVersion('4.13.0'), cache=cache,
+                            tag_resolved=True)
+    candidate_tag_names = downloader._predict_candidate_git_tag_names()
+    with mock.patch.object(Cmd, 'which', return_value='/usr/bin/git'), \
+            mock.patch.object(Cmd, 'sh_e_out') as mock_sh_e_out:
+        mock_sh_e_out.return_value = ls_remote_out
+        resolved_tag_names = downloader._resolve_git_tag_names(
+            candidate_tag_names)
+    assert resolved_tag_names == tag_names
+    mock_sh_e_out.assert_called_once_with(
+        'git ls-remote --tags {0} rpm-4.13.0-release rpm-4.13.0'.format(
+            Downloader.RPM_GIT_HUB_REPO_URL))
+
+    # The result including the empty result is cached for the next install.
+    downloader = Downloader(RpmPyVersion('4.13.0'), cache=cache,
+                            tag_resolved=True)
+    with mock.patch.object(Cmd, 'sh_e_out') as mock_sh_e_out:
+        assert downloader._resolve_git_tag_names(
+            candidate_tag_names) == tag_names
+    assert not mock_sh_e_out.called
+
+
+def test_downloader_get_candidate_archive_dicts_is_ok_on_tag_resolved():
+    downloader = Downloader(RpmPyVersion('4.13.0'), tag_resolved=True)
+    downloader._resolve_git_tag_names = mock.Mock(
+        return_value=['rpm-4.13.0'])
+    archive_dicts = downloader._get_candidate_archive_dicts()
+    assert [d['url'] for d in archive_dicts] == [
+        'https://github.com/rpm-software-management/rpm'
+        '/archive/rpm-4.13.0.tar.gz',
+        'http://ftp.rpm.org/releases/rpm-4.13.x/rpm-4.13.0.tar.gz',
+    ]
+    # The resolved archive is downloaded without probing the URLs.
+    with mock.patch.object(Cmd, 'probe_urls') as mock_probe_urls:
+        assert downloader._sort_archive_dicts_by_probe(
+            archive_dicts) == archive_dicts
+    assert not mock_probe_urls.called
+
+
+@pytest.mark.parametrize('is_cached', [False, True])
+def test_downloader_download_and_expand_is_ok_on_no_resolved_tag(
+    tmpdir, is_cached
+):
+    cache = Cache(str(tmpdir))
+    downloader = Downloader(RpmPyVersion('4.14.0-rc1'), cache=cache,
+                            tag_resolved=True)
+    if is_cached:
+        # The negative result cached by a previous install.
+        key = ' '.join(downloader._predict_candidate_git_tag_names())
+        cache.put_value(Cache.TAG_NAMESPACE, key, [],
+                        Downloader.TAG_NOT_FOUND_EXPIRED_SECONDS)
+    else:
+        downloader._resolve_git_tag_names = mock.Mock(return_value=[])
+    downloader._download_and_expand_by_git = mock.Mock(return_value='rpm')
+    with mock.patch.object(Cmd, 'sh_e_out') as mock_sh_e_out, \
+            mock.patch.object(Cmd, 'urlopen') as mock_urlopen:
+        assert downloader.download_and_expand() == 'rpm'
+    assert downloader._download_and_expand_by_git.called
+    assert not mock_sh_e_out.called
+    assert not mock_urlopen.called
+
+
+def test_cache_get_value_is_none_on_expired(tmpdir):
+    cache = Cache(str(tmpdir))
+    cache.put_value(Cache.TAG_NAMESPACE, 'a', ['b'], 60)
+    assert cache.get_value(Cache.TAG_NAMESPACE, 'a') == ['b']
+    cache.put_value(Cache.TAG_NAMESPACE, 'a', ['b'], -1)
+    assert cache.get_value(Cache.TAG_NAMESPACE, 'a') is None
+
+
 @pytest.mark.network
 def test_downloader_download_and_expand_by_git_is_ok(downloader):
     # Existed branch
@@ -626,6 +1453,129 @@ def test_downloader_download_and_expand_by_git_is_ok_with_predicted(
         assert top_dir_name == 'rpm'
 
 
+def test_downloader_download_and_expand_by_git_is_ok_on_sparse(
+    downloader
+):
+    downloader.git_branch = 'rpm-4.14.x'
+    downloader.git_sparse = True
+    downloader._is_git_sparse_checkout_ok = mock.MagicMock(return_value=True)
+    with pytest.helpers.work_dir():
+        os.mkdir('rpm')
+        with mock.patch.object(Cmd, 'sh_e') as mock_sh_e:
+            mock_sh_e.return_value = ('stdout', 'stderr')
+            top_dir_name = downloader._download_and_expand_by_git()
+    assert top_dir_name == 'rpm'
+    cmds = [c[0][0] for c in mock_sh_e.call_args_list]
+    assert cmds == [
+        'git clone -b rpm-4.14.x --depth=1 --filter=blob:none '
+        '--no-checkout {0}'.format(Downloader.RPM_GIT_HUB_REPO_URL),
+        'git sparse-checkout init --cone',
+        'git sparse-checkout set {0}'.format(
+            ' '.join(Downloader.EXTRACTED_SUB_DIRS)),
+        'git checkout -q rpm-4.14.x',
+    ]
+
+
+@pytest.mark.parametrize('is_sparse', [False, True])
+def test_downloader_download_and_expand_by_git_is_ok_on_ref(
+    downloader, is_sparse
+):
+    downloader.git_branch = None
+    downloader.git_ref = 'rpm-4.14.0-release'
+    downloader.git_sparse = is_sparse
+    downloader._is_git_sparse_checkout_ok = mock.MagicMock(return_value=True)
+    downloader._predict_git_branch = mock.MagicMock()
+    with pytest.helpers.work_dir():
+        os.mkdir('rpm')
+        with mock.patch.object(Cmd, 'sh_e') as mock_sh_e:
+            mock_sh_e.return_value = ('stdout', 'stderr')
+            top_dir_name = downloader.download_and_expand()
+    assert top_dir_name == 'rpm'
+    assert not downloader._predict_git_branch.called
+    cmds = [c[0][0] for c in mock_sh_e.call_args_list]
+    assert cmds[0] == 'git init -q rpm'
+    assert ('git sparse-checkout init --cone' in cmds) is is_sparse
+    filter_opt = ' --filter=blob:none' if is_sparse else ''
+    assert cmds[-2:] == [
+        'git fetch -q --depth=1{0} origin rpm-4.14.0-release'.format(
+            filter_opt),
+        'git -c advice.detachedHead=false checkout -q FETCH_HEAD',
+    ]
+
+
+def test_downloader_download_and_expand_by_git_is_ok_on_git_cached(
+    downloader, tmpdir
+):
+    if not Cmd.which('git'):
+        pytest.skip('git command not found.')
+    upstream_dir = str(tmpdir.join('upstream'))
+    os.mkdir(upstream_dir)
+    with Cmd.pushd(upstream_dir):
+        Cmd.sh_e('git init -q')
+        Cmd.sh_e('git checkout -q -b rpm-4.14.x')
+        with open('a.txt', 'w') as f_out:
+            f_out.write('a')
+        Cmd.sh_e('git add a.txt')
+        Cmd.sh_e('git -c user.name=a -c user.email=a@a commit -q -m a')
+    downloader.git_branch = 'rpm-4.14.x'
+    downloader.git_cached = True
+    downloader.cache = Cache(str(tmpdir.join('cache')))
+    downloader.RPM_GIT_HUB_REPO_URL = upstream_dir
+    mirror_dir = downloader.cache.get_git_mirror_dir()
+    with pytest.helpers.work_dir():
+        assert downloader._download_and_expand_by_git() == 'rpm'
+        assert os.path.isfile('rpm/a.txt')
+    assert os.path.isfile(os.path.join(mirror_dir, 'HEAD'))
+
+    # The second time fetches the new commits to the mirror.
+    with Cmd.pushd(upstream_dir):
+        with open('b.txt', 'w') as f_out:
+            f_out.write('b')
+        Cmd.sh_e('git add b.txt')
+        Cmd.sh_e('git -c user.name=a -c user.email=a@a commit -q -m b')
+    with pytest.helpers.work_dir():
+        with mock.patch.object(Cmd, 'sh_e', side_effect=Cmd.sh_e) as mock_sh_e:
+            assert downloader._download_and_expand_by_git() == 'rpm'
+        assert os.path.isfile('rpm/b.txt')
+    cmds = [c[0][0] for c in mock_sh_e.call_args_list]
+    assert cmds[0] == 'git --git-dir={0} fetch -q --prune origin'.format(
+        mirror_dir)
+
+
+def test_downloader_download_and_expand_by_git_is_ok_on_git_cached_ref(
+    downloader, tmpdir
+):
+    downloader.git_branch = None
+    downloader.git_ref = 'rpm-4.14.0-release'
+    downloader.git_cached = True
+    downloader.cache = Cache(str(tmpdir))
+    mirror_dir = downloader.cache.get_git_mirror_dir()
+    with pytest.helpers.work_dir():
+        os.mkdir('rpm')
+        with mock.patch.object(Cmd, 'sh_e') as mock_sh_e:
+            mock_sh_e.return_value = ('stdout', 'stderr')
+            top_dir_name = downloader.download_and_expand()
+    assert top_dir_name == 'rpm'
+    cmds = [c[0][0] for c in mock_sh_e.call_args_list]
+    assert cmds == [
+        'git clone -q --mirror {0} {1}'.format(
+            Downloader.RPM_GIT_HUB_REPO_URL, mirror_dir),
+        'git clone -q --shared --no-checkout {0} rpm'.format(mirror_dir),
+        'git -c advice.detachedHead=false checkout -q rpm-4.14.0-release',
+    ]
+
+
+@pytest.mark.parametrize('version_out,is_ok', [
+    ('git version 2.25.0\n', True),
+    ('git version 2.39.5\n', True),
+    ('git version 1.8.3.1\n', False),
+])
+def test_downloader_is_git_sparse_checkout_ok(downloader, version_out, is_ok):
+    with mock.patch.object(Cmd, 'sh_e_out') as mock_sh_e_out:
+        mock_sh_e_out.return_value = version_out
+        assert downloader._is_git_sparse_checkout_ok() is is_ok
+
+
 @pytest.mark.network
 @pytest.mark.parametrize('value_dict', [
     {
@@ -685,10 +1635,66 @@ def test_setup_py_apply_and_save(use_add_patchs):
             assert '@VERSION@' not in content
             assert '@PACKAGE_BUGREPORT@' not in content
 
-        print(setup_py.patches)
-        for patch in setup_py.patches:
-            if patch.get('required'):
-                assert patch.get('applied')
+        assert len(setup_py.patch_results) == len(setup_py.patches)
+        for (patch, applied) in setup_py.patch_results:
+            if patch.required:
+                assert applied
+
+
+def test_setup_py_patches_are_not_shared_between_instances():
+    patches_num = len(SetupPy.PATCHES)
+    setup_py_a = SetupPy(RpmPyVersion('4.11.0'))
+    setup_py_b = SetupPy(RpmPyVersion('4.11.0'))
+    assert len(setup_py_a.patches) == 5
+    setup_py_a.add_patchs_to_build_without_pkg_config('/usr/lib64',
+                                                      '/usr/include')
+    assert len(setup_py_a.patches) == 8
+    assert len(setup_py_b.patches) == 5
+    assert len(SetupPy.PATCHES) == patches_num
+    with pytest.raises(AttributeError):
+        SetupPy.PATCHES[0].required = False
+
+
+def test_setup_py_patch_format_shares_pattern():
+    patch = SetupPy.PATCHES_BUILD_WITHOUT_PKG_CONFIG[0]
+    formatted_patch = patch.format(lib_dir='/usr/lib64',
+                                   include_dir='/usr/include')
+    assert formatted_patch.dest == "['/usr/lib64']"
+    assert formatted_patch.pattern is patch.pattern
+    assert patch.dest == "['{lib_dir}']"
+
+
+def test_setup_py_apply_and_save_is_ok_on_jobs():
+    setup_py = SetupPy(RpmPyVersion('4.14.0-rc1'), jobs=4)
+    with pytest.helpers.work_dir_with_setup_py():
+        setup_py.apply_and_save()
+        with open(setup_py.OUT_PATH) as f_out:
+            content = f_out.read()
+    assert '\n_compile_in_parallel(4)\n' in content
+    assert '\ndef pkgconfig(' in content
+    compile(content, setup_py.OUT_PATH, 'exec')
+
+
+def test_setup_py_apply_and_save_uses_cached_output(tmpdir, monkeypatch):
+    cache = Cache(str(tmpdir.join('cache')))
+    monkeypatch.setattr(SetupPy, '_outputs', {})
+    setup_py = SetupPy(RpmPyVersion('4.14.0-rc1'), cache=cache)
+    with pytest.helpers.work_dir_with_setup_py():
+        setup_py.apply_and_save()
+        with open(setup_py.OUT_PATH) as f_out:
+            content = f_out.read()
+        os.remove(setup_py.OUT_PATH)
+
+        # The content is reused from the cache in another process.
+        monkeypatch.setattr(SetupPy, '_outputs', {})
+        other_setup_py = SetupPy(RpmPyVersion('4.14.0-rc1'), cache=cache)
+        with mock.patch.object(SetupPyPatch, 'apply') as mock_apply:
+            other_setup_py.apply_and_save()
+        assert not mock_apply.called
+        with open(setup_py.OUT_PATH) as f_out:
+            assert f_out.read() == content
+    assert other_setup_py.patch_results == setup_py.patch_results
+    assert all(applied for (_, applied) in other_setup_py.patch_results)
 
 
 def test_installer_init_is_ok(installer):
@@ -735,6 +1741,28 @@ def test_installer_install_from_rpm_py_package(
                 pytest.skip(message)
 
 
+def test_installer_copy_each_include_files_to_include_dir(capsys):
+    installer = Installer(RpmPyVersion('4.14.2'), Python(), mock.Mock())
+    with pytest.helpers.work_dir():
+        for header_file in ['rpmio/a.h', 'lib/b.h', 'lib/sub/c.h',
+                            'lib/d.c']:
+            dir_name = os.path.dirname(header_file)
+            if not os.path.isdir(dir_name):
+                os.makedirs(dir_name)
+            pytest.helpers.touch(header_file)
+        os.symlink('b.h', 'lib/e.h')
+        os.mkdir('python')
+        with pytest.helpers.pushd('python'):
+            installer._copy_each_include_files_to_include_dir()
+
+        assert os.path.realpath('include/rpm/a.h') == os.path.abspath(
+            'rpmio/a.h')
+        assert os.path.islink('include/rpm/sub/c.h')
+        assert not os.path.exists('include/rpm/d.c')
+        assert not os.path.exists('include/rpm/e.h')
+    assert '[INFO] Staged 3 header files.' in capsys.readouterr().out
+
+
 def test_installer_make_dep_lib_file_links_and_copy_include_files(installer):
     installer._rpm_py_has_popt_devel_dep = mock.MagicMock(
         return_value=True
@@ -754,6 +1782,147 @@ install the {0} package [{1}].
     assert expected_message == str(ei.value)
 
 
+def test_installer_install_from_build_cache_is_ok(tmpdir, site_dir):
+    lib_dir = str(tmpdir.join('lib'))
+    os.mkdir(lib_dir)
+    pytest.helpers.touch(os.path.join(lib_dir, 'librpm.so.9.1.0'))
+    cache = Cache(str(tmpdir.join('cache')))
+
+    def create_installer(arch):
+        rpm = mock.Mock(lib_dir=lib_dir, include_dir='/usr/include',
+                        arch=arch)
+        return Installer(RpmPyVersion('4.14.2'), Python(), rpm, cache=cache)
+
+    installer = create_installer('x86_64')
+    with pytest.helpers.work_dir():
+        assert installer.install_from_build_cache() is False
+        os.makedirs('build/lib.linux-x86_64/rpm')
+        pytest.helpers.touch('build/lib.linux-x86_64/rpm/__init__.py')
+        installer._store_build_cache()
+
+    with pytest.helpers.work_dir():
+        assert create_installer('aarch64').install_from_build_cache() is False
+        assert create_installer('x86_64').install_from_build_cache() is True
+    assert os.path.isfile(os.path.join(site_dir, 'rpm', '__init__.py'))
+    assert os.path.isfile(os.path.join(
+        site_dir, 'rpm-4.14.2-py{0}.{1}.egg-info'.format(
+            sys.version_info[0], sys.version_info[1])))
+
+
+@pytest.mark.parametrize('version,soabi,is_linked', [
+    ('4.14.2', None, True),
+    ('4.14.2.1', None, False),
+    ('4.14.2', 'cpython-36m-x86_64-linux-gnu', False),
+])
+def test_installer_install_by_link_is_ok(tmpdir, site_dir, version, soabi,
+                                         is_linked):
+    python = Python()
+    sys_lib_dir = str(tmpdir.join('sys', 'site-packages'))
+    sys_rpm_dir = os.path.join(sys_lib_dir, 'rpm')
+    os.makedirs(sys_rpm_dir)
+    pytest.helpers.touch(os.path.join(
+        sys_rpm_dir, '_rpm.{0}.so'.format(soabi or python.soabi)))
+    sys_egg_info = os.path.join(sys_lib_dir, 'rpm-4.14.2-py3.6.egg-info')
+    pytest.helpers.touch(sys_egg_info)
+    os.makedirs(os.path.join(site_dir, 'rpm'))
+
+    installer = Installer(RpmPyVersion(version), python, mock.Mock())
+    with mock.patch.object(Installer, 'SYS_PYTHON_LIB_DIR_FORMATS',
+                           new=[sys_lib_dir]):
+        assert installer.install_by_link() is is_linked
+    rpm_dir = os.path.join(site_dir, 'rpm')
+    assert os.path.islink(rpm_dir) is is_linked
+    if is_linked:
+        assert os.path.realpath(rpm_dir) == os.path.realpath(sys_rpm_dir)
+        assert os.path.islink(os.path.join(site_dir,
+                                           os.path.basename(sys_egg_info)))
+
+
+@pytest.mark.parametrize('is_stored', [False, True])
+def test_installer_build_and_install_is_ok_by_wheel(tmpdir, site_dir,
+                                                    is_stored):
+    store = None
+    if is_stored:
+        store = Cache(str(tmpdir.join('cache')))
+    installer = Installer(RpmPyVersion('4.14.2'), Python(), mock.Mock(),
+                          store=store)
+    os.makedirs(os.path.join(site_dir, 'rpm'))
+    pytest.helpers.touch(os.path.join(site_dir, 'rpm', 'old.py'))
+
+    def build_wheel(cmd, **kwargs):
+        os.mkdir('dist')
+        with zipfile.ZipFile('dist/rpm-4.14.2-cp39-linux_x86_64.whl',
+                             'w') as whl:
+            whl.writestr('rpm/__init__.py', '')
+            whl.writestr('rpm-4.14.2.dist-info/METADATA', 'Name: rpm\n')
+        return ('', '')
+
+    with pytest.helpers.work_dir():
+        with mock.patch.object(Cmd, 'sh_e', side_effect=build_wheel) \
+                as mock_sh_e:
+            installer._build_and_install()
+    cmds = [c[0][0] for c in mock_sh_e.call_args_list]
+    assert cmds == ['{0} setup.py -q bdist_wheel -d dist'.format(
+        installer.python.python_path)]
+    assert os.path.isfile(os.path.join(site_dir, 'rpm', '__init__.py'))
+    assert not os.path.isfile(os.path.join(site_dir, 'rpm', 'old.py'))
+    assert os.path.isfile(os.path.join(site_dir, 'rpm-4.14.2.dist-info',
+                                       'METADATA'))
+    nlink = os.stat(os.path.join(site_dir, 'rpm', '__init__.py')).st_nlink
+    assert nlink == (2 if is_stored else 1)
+
+
+def test_installer_build_and_install_is_ok_on_ccache(capsys):
+    installer = Installer(RpmPyVersion('4.14.2'), Python(), mock.Mock(),
+                          ccache=True, ccache_dir='/tmp/ccache')
+    error = CmdError('test.')
+    error.stderr = "error: invalid command 'bdist_wheel'\n"
+    with mock.patch.object(Cmd, 'which', return_value='/usr/bin/ccache'), \
+            mock.patch.object(Cmd, 'sh_e') as mock_sh_e, \
+            mock.patch.object(Cmd, 'sh_e_out') as mock_sh_e_out:
+        mock_sh_e.side_effect = [error, ('', ''), ('', '')]
+        mock_sh_e_out.side_effect = [
+            'direct_cache_hit\t1\ncache_miss\t5\n',
+            'direct_cache_hit\t3\npreprocessed_cache_hit\t1\n'
+            'cache_miss\t6\n',
+        ]
+        installer._build_and_install()
+    for call in mock_sh_e.call_args_list:
+        env = call[1]['env']
+        assert env['CC'].startswith('/usr/bin/ccache ')
+        assert env['CCACHE_DIR'] == '/tmp/ccache'
+    assert '[INFO] ccache: 3 hits, 1 misses.' in capsys.readouterr().out
+
+
+def test_installer_build_wheel_is_ok_on_jobs():
+    installer = Installer(RpmPyVersion('4.14.2'), Python(), mock.Mock(),
+                          jobs=4)
+    with pytest.helpers.work_dir():
+        with mock.patch.object(Cmd, 'sh_e') as mock_sh_e:
+            with pytest.raises(InstallError):
+                installer._build_wheel()
+    build_cmd = 'build -j 4' if sys.version_info >= (3, 5) else 'build'
+    mock_sh_e.assert_called_once_with(
+        '{0} setup.py -q {1} bdist_wheel -d dist'.format(
+            installer.python.python_path, build_cmd))
+
+
+def test_installer_build_and_install_is_ok_without_wheel(site_dir):
+    installer = Installer(RpmPyVersion('4.14.2'), Python(), mock.Mock())
+    error = CmdError('test.')
+    error.stderr = "error: invalid command 'bdist_wheel'\n"
+    with mock.patch.object(Cmd, 'sh_e') as mock_sh_e:
+        mock_sh_e.side_effect = [error, ('', ''), ('', '')]
+        installer._build_and_install()
+    cmds = [c[0][0] for c in mock_sh_e.call_args_list]
+    python_path = installer.python.python_path
+    assert cmds == [
+        '{0} setup.py -q bdist_wheel -d dist'.format(python_path),
+        '{0} setup.py -q build'.format(python_path),
+        '{0} setup.py -q install'.format(python_path),
+    ]
+
+
 @pytest.mark.parametrize(
     'is_installed_from_bin,install_from_bin_ok,setup_py_in_exists',
     [
@@ -803,6 +1972,126 @@ def test_rpm_py_download_and_install(
                 assert rpm_py.installer.install_from_rpm_py_package.called
 
 
+@pytest.mark.parametrize('is_failed', [False, True])
+def test_rpm_py_download_and_install_is_ok_on_pythons(capsys, is_failed):
+    pythons = [Python(), Python('/dummy/bin/python3.12')]
+    linux = mock.Mock()
+    linux.create_installer.side_effect = (
+        lambda version, **kwargs: Installer(version, pythons[0], mock.Mock(),
+                                            **kwargs)
+    )
+    rpm_py = RpmPy('4.14.2', pythons[0], linux, pythons=pythons)
+    assert [i.python for i in rpm_py.installers] == pythons
+    rpm_py.downloader.download_and_expand = mock.Mock(
+        return_value='rpm-4.14.2')
+    build_dirs = {}
+
+    def build_and_install(installer, **kwargs):
+        build_dir = kwargs['build_dir']
+        assert os.path.isfile(os.path.join(build_dir, 'setup.py.in'))
+        build_dirs[installer.python.python_path] = build_dir
+        if is_failed and not installer.python.is_current:
+            raise InstallError('test.')
+
+    with pytest.helpers.work_dir():
+        os.makedirs('rpm-4.14.2/python')
+        pytest.helpers.touch('rpm-4.14.2/python/setup.py.in')
+        with mock.patch.object(Installer, 'prepare') as mock_prepare, \
+                mock.patch.object(Installer, '_build_and_install',
+                                  autospec=True,
+                                  side_effect=build_and_install):
+            if is_failed:
+                with pytest.raises(InstallError) as ei:
+                    rpm_py.download_and_install()
+                assert '/dummy/bin/python3.12' in str(ei.value)
+            else:
+                rpm_py.download_and_install()
+    assert mock_prepare.call_count == 1
+    assert sorted(build_dirs) == sorted(p.python_path for p in pythons)
+    assert len(set(build_dirs.values())) == 2
+    out = capsys.readouterr().out
+    assert "Python '{0}': installed in".format(sys.executable) in out
+    if is_failed:
+        assert "Python '/dummy/bin/python3.12': failed in" in out
+
+
+def test_rpm_py_download_and_install_is_error_on_pythons_without_setup_py_in():
+    pythons = [Python(), Python('/dummy/bin/python3.12')]
+    linux = mock.Mock()
+    linux.create_installer.side_effect = (
+        lambda version, **kwargs: Installer(version, pythons[0], mock.Mock(),
+                                            **kwargs)
+    )
+    rpm_py = RpmPy('4.9.1', pythons[0], linux, pythons=pythons)
+    rpm_py.downloader.download_and_expand = mock.Mock(
+        return_value='rpm-4.9.1')
+    with pytest.helpers.work_dir():
+        os.makedirs('rpm-4.9.1/python')
+        with mock.patch.object(Installer, 'install_from_rpm_py_package') \
+                as mock_install:
+            with pytest.raises(InstallError) as ei:
+                rpm_py.download_and_install()
+    assert 'RPM_PY_PYTHONS' in str(ei.value)
+    assert not mock_install.called
+
+
+@pytest.mark.parametrize('git_kwargs,is_build_cached', [
+    ({}, True),
+    ({'git_branch': 'master'}, False),
+    ({'git_ref': 'abc123'}, False),
+])
+def test_rpm_py_skips_build_cache_on_git_source(tmpdir, git_kwargs,
+                                                is_build_cached):
+    cache = Cache(str(tmpdir))
+    python = Python()
+    linux = mock.Mock()
+    linux.create_installer.side_effect = (
+        lambda version, **kwargs: Installer(version, python, mock.Mock(),
+                                            **kwargs)
+    )
+    rpm_py = RpmPy('4.14.2', python, linux, cache=cache, **git_kwargs)
+    assert (rpm_py.installer.cache is cache) is is_build_cached
+    if not is_build_cached:
+        assert not rpm_py.installer.install_from_build_cache()
+
+
+def test_rpm_py_select_pythons():
+    pythons = [Python(), Python('/dummy/bin/python3.12')]
+    linux = mock.Mock()
+    linux.create_installer.side_effect = (
+        lambda version, **kwargs: Installer(version, pythons[0], mock.Mock(),
+                                            **kwargs)
+    )
+    rpm_py = RpmPy('4.14.2', pythons[0], linux, pythons=pythons)
+    rpm_py.select_pythons(pythons[1:])
+    assert [i.python for i in rpm_py.installers] == pythons[1:]
+    assert rpm_py.installer.python is pythons[1]
+
+
+@pytest.mark.parametrize('is_rpm_devel_installed', [False, True])
+def test_fedora_installer_build_and_install_hints_rpm_devel(
+    is_rpm_devel_installed
+):
+    rpm = mock.Mock()
+    rpm.is_package_installed.return_value = is_rpm_devel_installed
+    installer = FedoraInstaller(RpmPyVersion('4.14.2'), Python(), rpm)
+    with mock.patch.object(Installer, '_build_and_install') as mock_build:
+        mock_build.side_effect = InstallError('build failed.')
+        with pytest.raises(InstallError) as ei:
+            installer.build_and_install(build_dir='python-1')
+    mock_build.assert_called_once_with(build_dir='python-1')
+    assert ('rpm-devel' in str(ei.value)) is not is_rpm_devel_installed
+    assert 'build failed.' in str(ei.value)
+
+
+def test_python_info_is_ok_on_other_python():
+    python = Python(sys.executable + ' ')
+    assert not python.is_current
+    assert python.version_info == tuple(sys.version_info[:3])
+    assert python.python_lib_arch_dir == Python().python_lib_arch_dir
+    assert python.soabi == Python().soabi
+
+
 def test_app_init(app):
     assert app
     assert app.verbose is False
@@ -852,6 +2141,14 @@ def test_app_init_env_setup_py_optm(app, env):
     assert app.rpm_py.installer.optimized is value
 
 
+def test_app_init_is_error_on_install_bin_and_pythons(monkeypatch):
+    monkeypatch.setenv('RPM_PY_INSTALL_BIN', 'true')
+    monkeypatch.setenv('RPM_PY_PYTHONS', '{0} {0}'.format(sys.executable))
+    with pytest.raises(InstallError) as ei:
+        Application()
+    assert 'RPM_PY_PYTHONS' in str(ei.value)
+
+
 @pytest.mark.parametrize('env', [{'RPM_PY_VERBOSE': 'true'}])
 def test_app_init_env_verbose(app):
     assert app
@@ -868,6 +2165,27 @@ def test_app_init_env_work_dir_removed(app, env):
     assert app.is_work_dir_removed is value
 
 
+@pytest.mark.parametrize('is_work_dir_removed', [True, False])
+def test_app_run_is_ok(tmpdir, is_work_dir_removed):
+    # Set the attributes without the rpm command used by __init__.
+    app = Application.__new__(Application)
+    app.linux = mock.Mock()
+    app.linux.facts = SystemFacts('/usr/bin/rpm')
+    app.rpm_py = mock.Mock(spec=['download_and_install'])
+    python = mock.Mock()
+    python.is_python_binding_installed.return_value = True
+    app.pythons = [python]
+    app.linux.verify_system_status.return_value = app.pythons
+    app.is_work_dir_removed = is_work_dir_removed
+    with mock.patch.object(tempfile, 'mkdtemp') as mock_mkdtemp:
+        work_dir = str(tmpdir.join('work'))
+        os.mkdir(work_dir)
+        mock_mkdtemp.return_value = work_dir
+        app.run()
+    assert app.rpm_py.download_and_install.called
+    assert os.path.isdir(work_dir) is not is_work_dir_removed
+
+
 @pytest.mark.network
 def test_app_verify_system_status_is_ok(app, monkeypatch):
     monkeypatch.setattr(type(app.linux.rpm), 'version_info',
@@ -913,6 +2231,74 @@ def test_app_verify_system_status_is_ok_on_sys_py_and_sys_installed_true(
     assert True
 
 
+def test_app_run_is_ok_on_skipped_pythons(tmpdir):
+    app = Application.__new__(Application)
+    app.linux = mock.Mock()
+    app.linux.facts = SystemFacts('/usr/bin/rpm')
+    app.rpm_py = mock.Mock(spec=['download_and_install', 'select_pythons'])
+    pythons = [mock.Mock(), mock.Mock()]
+    pythons[0].is_python_binding_installed.return_value = False
+    pythons[1].is_python_binding_installed.return_value = True
+    app.pythons = pythons
+    app.linux.verify_system_status.return_value = pythons[1:]
+    app.is_work_dir_removed = True
+    with mock.patch.object(tempfile, 'mkdtemp') as mock_mkdtemp:
+        work_dir = str(tmpdir.join('work'))
+        os.mkdir(work_dir)
+        mock_mkdtemp.return_value = work_dir
+        app.run()
+    app.linux.verify_system_status.assert_called_once_with(pythons=pythons)
+    app.rpm_py.select_pythons.assert_called_once_with(pythons[1:])
+    assert app.rpm_py.download_and_install.called
+
+
+def _create_linux_for_pythons(rpm_version_info, sys_installed=False):
+    # Set the attributes without the rpm command used by __init__.
+    linux = FedoraLinux.__new__(FedoraLinux)
+    linux.rpm = mock.Mock()
+    linux.rpm.version_info = rpm_version_info
+    linux.rpm.is_system_rpm.return_value = False
+    linux.sys_installed = sys_installed
+    return linux
+
+
+def _create_python_for_status(python_path, version_info, is_installed):
+    python = mock.Mock()
+    python.python_path = python_path
+    python.version_info = version_info
+    python.is_system_python.return_value = \
+        python_path.startswith('/usr/bin/python')
+    python.is_python_binding_installed.return_value = is_installed
+    return python
+
+
+def test_linux_verify_system_status_skips_sys_python_installed():
+    linux = _create_linux_for_pythons((4, 16, 1))
+    pythons = [
+        _create_python_for_status('/venv/bin/python', (3, 9, 1), False),
+        _create_python_for_status('/usr/bin/python3', (3, 9, 1), True),
+    ]
+    assert linux.verify_system_status(pythons=pythons) == pythons[:1]
+    with pytest.raises(InstallSkipError):
+        linux.verify_system_status(pythons=pythons[1:2] * 2)
+
+
+@pytest.mark.parametrize('python_path,version_info,sys_installed', [
+    ('/usr/bin/python3', (3, 9, 1), False),
+    ('/venv2/bin/python', (2, 7, 18), True),
+])
+def test_linux_verify_system_status_is_error_on_second_python(
+    python_path, version_info, sys_installed
+):
+    linux = _create_linux_for_pythons((4, 16, 1), sys_installed)
+    pythons = [
+        _create_python_for_status('/venv/bin/python', (3, 9, 1), False),
+        _create_python_for_status(python_path, version_info, False),
+    ]
+    with pytest.raises(InstallError):
+        linux.verify_system_status(pythons=pythons)
+
+
 def test_app_verify_system_status_is_error_on_sys_py_and_no_rpm_py(
     app, monkeypatch
 ):
@@ -1111,3 +2497,242 @@ def test_app_run_is_ok_on_download_by_rpm_py_version(app, rpm_py_version):
     with pytest.helpers.work_dir():
         app.run()
     assert True
+
+
+def test_cache_put_archive_and_get_archive():
+    url = 'https://example.com/archive/rpm-4.14.0.tar.gz'
+    with pytest.helpers.work_dir():
+        cache = Cache('cache')
+        assert cache.get_archive(url) is None
+
+        with open('rpm-4.14.0.tar.gz', 'wb') as f_out:
+            f_out.write(b'abc')
+        cached_file_path = cache.put_archive(url, 'rpm-4.14.0.tar.gz')
+        assert cached_file_path.startswith(cache.cache_dir)
+        assert cache.get_archive(url) == cached_file_path
+        with open(cached_file_path, 'rb') as f_in:
+            assert f_in.read() == b'abc'
+
+
+def test_cache_get_archive_removes_broken_entry():
+    url = 'https://example.com/archive/rpm-4.14.0.tar.gz'
+    with pytest.helpers.work_dir():
+        cache = Cache('cache')
+        with open('rpm-4.14.0.tar.gz', 'wb') as f_out:
+            f_out.write(b'abc')
+        cached_file_path = cache.put_archive(url, 'rpm-4.14.0.tar.gz')
+        with open(cached_file_path, 'wb') as f_out:
+            f_out.write(b'abd')
+
+        assert cache.get_archive(url) is None
+        assert not os.path.exists(os.path.dirname(cached_file_path))
+
+
+def test_cache_evict_removes_least_recently_used_entry():
+    urls = [
+        'https://example.com/archive/a.tar.gz',
+        'https://example.com/archive/b.tar.gz',
+    ]
+    with pytest.helpers.work_dir():
+        cache = Cache('cache')
+        cache.size_limit = 5
+        for index, url in enumerate(urls):
+            file_name = os.path.basename(url)
+            with open(file_name, 'wb') as f_out:
+                f_out.write(b'abc')
+            cached_file_path = cache.put_archive(url, file_name)
+            meta_path = os.path.join(os.path.dirname(cached_file_path),
+                                     Cache.META_FILE_NAME)
+            os.utime(meta_path, (index, index))
+        cache.evict()
+
+        assert cache.get_archive(urls[0]) is None
+        assert cache.get_archive(urls[1])
+
+
+def test_cache_evict_removes_partial_files_not_in_use():
+    with pytest.helpers.work_dir():
+        cache = Cache('cache')
+        part_paths = [
+            cache.get_partial_file_path('https://example.com/{0}.tar.gz'
+                                        .format(name))
+            for name in ['in_use', 'not_used', 'no_lock', 'new']
+        ]
+        for part_path in part_paths:
+            for file_path in [part_path, part_path + '.validator',
+                              part_path + '.lock']:
+                pytest.helpers.touch(file_path)
+                if part_path != part_paths[3]:
+                    os.utime(file_path, (0, 0))
+        os.remove(part_paths[2] + '.lock')
+
+        with open(part_paths[0] + '.lock') as f_lock:
+            fcntl.flock(f_lock.fileno(), fcntl.LOCK_EX)
+            cache.evict()
+            fcntl.flock(f_lock.fileno(), fcntl.LOCK_UN)
+
+        for index, part_path in enumerate(part_paths):
+            is_kept = index in (0, 3)
+            for file_path in [part_path, part_path + '.validator']:
+                assert os.path.exists(file_path) is is_kept
+        assert os.path.exists(part_paths[0] + '.lock')
+        assert not os.path.exists(part_paths[1] + '.lock')
+
+        # The file removed by another process at the same time is ignored.
+        with mock.patch.object(os, 'listdir') as mock_listdir:
+            mock_listdir.side_effect = [['not_existed.part'], []]
+            cache.evict()
+
+
+def test_cmd_lock_file_locks_new_file_after_removed():
+    events = []
+    with pytest.helpers.work_dir():
+        with open('a.lock', 'a') as f_lock:
+            fcntl.flock(f_lock.fileno(), fcntl.LOCK_EX)
+
+            def lock():
+                with Cmd.lock_file('a.lock'):
+                    events.append(os.path.exists('a.lock'))
+
+            thread = threading.Thread(target=lock)
+            thread.start()
+            time.sleep(0.2)
+            # Removed by the cache eviction while the thread waits.
+            os.remove('a.lock')
+            fcntl.flock(f_lock.fileno(), fcntl.LOCK_UN)
+        thread.join()
+    assert events == [True]
+
+
+def test_cache_evict_removes_stale_entries_and_expired_values():
+    with pytest.helpers.work_dir():
+        cache = Cache('cache')
+        cache.put_value(Cache.TAG_NAMESPACE, 'expired', ['a'], -1)
+        cache.put_value(Cache.TAG_NAMESPACE, 'valid', ['b'], 60)
+        old_tmp_dir = os.path.join('cache', Cache.ARCHIVE_NAMESPACE,
+                                   '.tmp-old')
+        new_tmp_dir = os.path.join('cache', Cache.ARCHIVE_NAMESPACE,
+                                   '.tmp-new')
+        old_tmp_file = os.path.join('cache', Cache.TAG_NAMESPACE,
+                                    '.tmp-old')
+        for tmp_dir in [old_tmp_dir, new_tmp_dir]:
+            os.makedirs(tmp_dir)
+            with open(os.path.join(tmp_dir, Cache.META_FILE_NAME), 'w') as f:
+                json.dump({'key': 'a', 'size': 1}, f)
+        pytest.helpers.touch(old_tmp_file)
+        os.utime(old_tmp_dir, (0, 0))
+        os.utime(old_tmp_file, (0, 0))
+        cache.evict()
+
+        assert not os.path.exists(old_tmp_dir)
+        assert not os.path.exists(old_tmp_file)
+        # The staging entry of the running install is kept.
+        assert os.path.isdir(new_tmp_dir)
+        assert not os.path.exists(
+            cache._get_value_path(Cache.TAG_NAMESPACE, 'expired'))
+        assert cache.get_value(Cache.TAG_NAMESPACE, 'valid') == ['b']
+
+
+def test_cache_link_tree_shares_files_in_store():
+    with pytest.helpers.work_dir():
+        cache = Cache('cache')
+        os.makedirs('src/rpm/sub')
+        with open('src/rpm/__init__.py', 'w') as f_out:
+            f_out.write('a')
+        with open('src/rpm/sub/_rpm.so', 'w') as f_out:
+            f_out.write('b')
+        os.chmod('src/rpm/sub/_rpm.so', 0o755)
+        os.symlink('__init__.py', 'src/rpm/link.py')
+        for dst_dir in ['venv1', 'venv2']:
+            cache.link_tree('src/rpm', dst_dir)
+
+        for name in ['__init__.py', 'sub/_rpm.so']:
+            stat_1 = os.stat(os.path.join('venv1', name))
+            stat_2 = os.stat(os.path.join('venv2', name))
+            assert stat_1.st_ino == stat_2.st_ino
+            assert stat_1.st_nlink == 3
+        assert os.access('venv1/sub/_rpm.so', os.X_OK)
+        assert os.readlink('venv2/link.py') == '__init__.py'
+
+        # The store files not linked from any install are removed.
+        shutil.rmtree('venv1')
+        shutil.rmtree('venv2')
+        store_files = glob.glob('cache/store/*/*')
+        assert len(store_files) == 2
+        for store_file in store_files:
+            os.utime(store_file, (0, 0))
+        cache.evict()
+        assert not glob.glob('cache/store/*/*')
+
+
+def test_cache_link_file_touches_store_file():
+    with pytest.helpers.work_dir():
+        cache = Cache('cache')
+        with open('a.txt', 'w') as f_out:
+            f_out.write('a')
+        os.utime('a.txt', (0, 0))
+        cache.link_file('a.txt', 'b.txt')
+        (store_file,) = glob.glob('cache/store/*/*')
+        # The time of the source file is not kept.
+        assert os.path.getmtime(store_file) > 0
+        os.utime(store_file, (0, 0))
+        cache.link_file('a.txt', 'c.txt')
+        assert os.path.getmtime(store_file) > 0
+
+
+def test_cache_link_file_stores_again_on_evicted_store_file():
+    with pytest.helpers.work_dir():
+        cache = Cache('cache')
+        with open('a.txt', 'w') as f_out:
+            f_out.write('a')
+        cache.link_file('a.txt', 'b.txt')
+        (store_file,) = glob.glob('cache/store/*/*')
+        os.remove('b.txt')
+
+        orig_link_file = Cmd.link_file
+
+        def evict_and_link_file(src_file_path, dst_file_path):
+            if mock_link_file.call_count == 1:
+                # Evicted by another process after it is put.
+                os.remove(src_file_path)
+            return orig_link_file(src_file_path, dst_file_path)
+
+        with mock.patch.object(Cmd, 'link_file') as mock_link_file:
+            mock_link_file.side_effect = evict_and_link_file
+            assert cache.link_file('a.txt', 'b.txt') == 'hardlink'
+        assert mock_link_file.call_count == 2
+        assert os.path.isfile(store_file)
+        with open('b.txt') as f_in:
+            assert f_in.read() == 'a'
+
+
+def test_cache_evict_ignores_store_file_removed_at_same_time():
+    with pytest.helpers.work_dir():
+        cache = Cache('cache')
+        with open('a.txt', 'w') as f_out:
+            f_out.write('a')
+        cache.link_file('a.txt', 'b.txt')
+        os.remove('b.txt')
+        (store_file,) = glob.glob('cache/store/*/*')
+        os.utime(store_file, (0, 0))
+        orig_remove = os.remove
+
+        def remove_by_other(file_path):
+            # Another process removes the file first.
+            orig_remove(file_path)
+            orig_remove(file_path)
+
+        with mock.patch.object(os, 'remove', side_effect=remove_by_other):
+            cache.evict()
+        assert not os.path.exists(store_file)
+
+
+def test_cmd_link_file_is_ok_without_hard_link():
+    with pytest.helpers.work_dir():
+        with open('a.txt', 'w') as f_out:
+            f_out.write('a')
+        with mock.patch.object(os, 'link', side_effect=OSError('test')):
+            method = Cmd.link_file('a.txt', 'b.txt')
+        assert method in ('reflink', 'copy')
+        with open('b.txt') as f_in:
+            assert f_in.read() == 'a'